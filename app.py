@@ -1,9 +1,13 @@
-import os
-from flask import Flask, request, jsonify, abort, make_response, redirect, url_for, session, render_template
+import csv, io, os, re, time
+import click
+from datetime import datetime, timezone
+from flask import Flask, Response, request, jsonify, abort, make_response, redirect, url_for, session, render_template, send_file, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event, func, inspect, literal, text, select, update
+from sqlalchemy.orm import aliased, make_transient_to_detached, selectinload
+from werkzeug.http import is_resource_modified
 from flask_login import logout_user, login_required, login_user, LoginManager, current_user
+from database import load_database_config, install_sqlite_pragmas, RoutingSession, read_only
 
 
 ### For OAUTH2 which I didn't end up using because I need a domain name
@@ -21,8 +25,10 @@ DB_FILE_STORAGE = "./instance/clubreview.db"
 DB_FILE = "clubreview.db"
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{DB_FILE}"
-db = SQLAlchemy(app)
+# The database settings (WAL, pragmas, connection pools, read engine) come from the database profile (see database.py)
+app.config.from_mapping(load_database_config(f"sqlite:///{DB_FILE}"))
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+install_sqlite_pragmas(db, app)
 
 secret_key = os.urandom(24)
 app.secret_key = secret_key
@@ -30,16 +36,151 @@ app.secret_key = secret_key
 # A folder to store all the files when uploading
 UPLOAD_FOLDER = 'folders'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# The file contents are stored in here under their SHA-256 hash
+BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, 'blobs')
+app.config['BLOB_FOLDER'] = BLOB_FOLDER
+# The largest file (in bytes) that can be uploaded
+app.config['MAX_UPLOAD_SIZE'] = 50 * 1024 * 1024
+# The most creates, updates and favorites that can be sent to /api/clubs/bulk in one request
+app.config['BULK_MAX_ITEMS'] = 500
+# The most /api/changes/stream connections that can be open at once in one process, kept below the number of threads
+# that serve requests (e.g. ASGI_WSGI_WORKERS in asgi.py), since every stream holds a thread
+app.config['CHANGES_MAX_STREAMS'] = 5
+
+# The most clubs that can be requested in one page of /api/clubs
+CLUBS_MAX_PAGE_SIZE = 500
+# How many clubs are loaded from the database at a time when streaming the full club list
+CLUBS_STREAM_BATCH_SIZE = 500
+# How many rows the exports fetch from the database cursor at a time
+EXPORT_BATCH_SIZE = 1000
+# The default and the maximum number of search results returned in one page
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+# The default and the maximum number of comment threads returned in one page, and how deep the replies go by default
+THREADS_PAGE_SIZE = 20
+THREADS_MAX_PAGE_SIZE = 100
+THREADS_DEPTH = 3
+THREADS_MAX_DEPTH = 10
+# The default and the maximum number of clubs returned in one page of a tag query, and how many tag counts come with it
+TAG_QUERY_PAGE_SIZE = 20
+TAG_QUERY_MAX_PAGE_SIZE = 100
+TAG_QUERY_FACETS = 50
+# The default and the maximum number of recommended clubs
+RECOMMENDATIONS_PAGE_SIZE = 10
+RECOMMENDATIONS_MAX_PAGE_SIZE = 50
+# The default and the maximum number of changes returned in one page of /api/changes
+CHANGES_PAGE_SIZE = 100
+CHANGES_MAX_PAGE_SIZE = 1000
+# How often (in seconds) a change stream checks for changes from other processes, how often it sends a keepalive when
+# nothing changed, and how long it stays open before the client reconnects (so a stream doesn't hold a thread forever)
+CHANGES_STREAM_POLL_INTERVAL = 1
+CHANGES_STREAM_KEEPALIVE = 15
+CHANGES_STREAM_MAX_SECONDS = 300
 
 login_manager = LoginManager()
 login_manager.init_app(app)
 
 from models import *
+from favorites import favorite_buffer
+from blobstore import BlobStore, UploadError, UploadNotFound, UploadOffsetMismatch
+from cache import response_cache, add_cache_tags, TTLCache
+from hashing import password_hasher, HashingBusy
+from importer import import_clubs, iter_club_records
+from scraper import scrape
+from metrics import metrics
+from recommend import recommendation_index
+from tagindex import tag_index, page_by_favorites, TagQueryError
+from ratelimit import login_rate_limiter
+from thumbnails import thumbnailer, VariantError, FORMATS
+from compression import compression
+from changelog import change_log, ChangesGone
+
+# Likes are buffered in memory and written to the database in batches
+favorite_buffer.init_app(app, db)
+
+blob_store = BlobStore(BLOB_FOLDER)
+
+# Smaller versions of uploaded images are made in the background and kept in a size limited cache next to the blobs
+thumbnailer.init_app(app, os.path.join(BLOB_FOLDER, 'variants'))
+
+# Responses of the read endpoints are cached in memory until a write endpoint changes what they show
+response_cache.init_app(app)
+favorite_buffer.add_commit_listener(lambda club_ids: response_cache.invalidate('clubs'))
+
+# Passwords are hashed and checked in a pool of worker processes
+password_hasher.init_app(app)
+
+# Failed logins are counted by username and by IP outside of the main database, and too many of them are turned away
+# before the password gets hashed
+login_rate_limiter.init_app(app)
+
+# The most similar clubs of every club are precomputed and refreshed in the background when tags or members change
+recommendation_index.init_app(app, db)
+recommendation_index.add_change_listener(lambda: response_cache.invalidate('recommendations'))
+
+# Every tag's clubs are kept in memory as a bitmap for the tag queries
+tag_index.init_app(app, db)
+
+# Every write to the clubs, comments and files is logged, so clients can download only what changed
+change_log.init_app(app, db)
+favorite_buffer.add_flush_listener(change_log.record_favorites)
+favorite_buffer.add_commit_listener(lambda club_ids: change_log.notify())
+
+# Every request's latency, SQL statements, response size and status are recorded and shown on /metrics
+metrics.init_app(app, db)
+metrics.register_stats('clubreview_response_cache', response_cache.stats)
+metrics.register_stats('clubreview_login_rate_limit', login_rate_limiter.stats)
+metrics.register_stats('clubreview_thumbnails', thumbnailer.stats)
+metrics.register_stats('clubreview_change_log', change_log.stats)
+
+# JSON responses are compressed for the clients that accept it (registered after the metrics, so it runs before them)
+compression.init_app(app)
+
+# The background threads (flushing the likes, refreshing the recommendations and the tag index, compacting the change
+# log) are only started by the first request, so the flask commands (e.g. bootstrap on an empty database) don't start
+# them, and under a server that forks its workers every worker gets its own
+@app.before_request
+def start_background_threads():
+    favorite_buffer.start()
+    recommendation_index.start()
+    tag_index.start()
+    change_log.start()
+
+
+# Logged in users are cached for a short time, so that every authenticated request doesn't have to query the user
+user_cache = TTLCache(max_entries=1024, ttl=30)
 
 # Necessary for logging users in
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(user_id)
+    columns = user_cache.get(user_id)
+    if columns is None:
+        user = User.query.get(user_id)
+        if user:
+            user_cache.set(user_id, {column.key: getattr(user, column.key) for column in User.__table__.columns})
+        return user
+
+    # Rebuild the user from the cached columns and attach it to this request's session without querying the database
+    user = User(**columns)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+# Drop a user from the cache whenever it changes
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_cached_user(mapper, connection, user):
+    user_cache.invalidate(str(user.id))
+
+
+# Changing only a club's tags or files doesn't update its row, so its updated_at is set here (for the exports' since)
+@event.listens_for(db.session, 'before_flush')
+def touch_changed_clubs(session, flush_context, instances):
+    for club in session.dirty:
+        if isinstance(club, Club):
+            state = inspect(club)
+            if state.attrs.tags.history.has_changes() or state.attrs.files.history.has_changes():
+                club.updated_at = datetime.utcnow()
 
 
 # Retrieves a list of tag objects from db based on a provided list of tag names.
@@ -53,17 +194,85 @@ def get_all_tags(names):
 
 # Retrieve a file object from db based on a provided file path
 # This method is primarily so that I don't accidentally create another File object when the same object already exists in the database.
-def get_files(path, binary_data, content_type):
+# If the file already exists, it gets pointed at the new contents.
+def get_files(path, digest, size, content_type):
     file = File.query.filter_by(path=path).first()
     if file:
+        file.sha256 = digest
+        file.size = size
+        file.content_type = content_type
+        file.uploaded_at = datetime.utcnow()
         return file, 200
     else:
-        return File(path=path, content=binary_data, content_type=content_type), 201
+        return File(path=path, sha256=digest, size=size, content_type=content_type), 201
+
+
+# Retrieves a batch of clubs ordered by id, starting right after the club with the id `after`.
+# The tags and files of the whole batch are loaded with one query each instead of one query per club.
+def get_club_batch(after, limit):
+    return db.session.execute(club_batch_statement(after, limit)).scalars().all()
+
+
+# The query for get_club_batch (also used by the async routes in asgi.py)
+def club_batch_statement(after, limit):
+    return select(Club) \
+        .options(selectinload(Club.tags), selectinload(Club.files).load_only(File.path)) \
+        .where(Club.id > after) \
+        .order_by(Club.id) \
+        .limit(limit)
+
+
+# Turns the text someone searched for into an FTS5 query where every word has to match the start of a word
+# in the club's name or description (e.g. "penn lor" becomes '"penn"* "lor"*')
+def build_search_query(search_text):
+    words = re.findall(r'\w+', search_text.lower())
+    return ' '.join('"%s"*' % word for word in words)
+
+
+# The ids of a page of clubs matching an FTS5 query, best matches first
+SEARCH_STATEMENT = text("SELECT rowid FROM club_search WHERE club_search MATCH :query ORDER BY rank LIMIT :limit OFFSET :offset")
+
+
+# Finds the ids of the clubs matching the search text, best matches first
+def search_club_ids(search_text, limit, offset):
+    query = build_search_query(search_text)
+    if not query:
+        return []
+
+    rows = db.session.execute(SEARCH_STATEMENT, {'query': query, 'limit': limit, 'offset': offset})
+    return [row[0] for row in rows]
+
+
+# Writes out every club as a JSON array one batch at a time, so the whole list never has to be in memory at once
+def stream_clubs():
+    yield '{"success": true, "data": ['
+    after = 0
+    separator = ''
+    while True:
+        clubs = get_club_batch(after, CLUBS_STREAM_BATCH_SIZE)
+        if clubs:
+            yield separator + ','.join(app.json.dumps(club.to_json()) for club in clubs)
+            separator = ','
+        if len(clubs) < CLUBS_STREAM_BATCH_SIZE:
+            break
+        after = clubs[-1].id
+    yield ']}'
+
+
+# Drops the cached responses that show this club: the club lists, the club's comments and files, and if its tags changed,
+# the tag counts and the club lists of those tags
+def invalidate_club_cache(club_id, tag_names=()):
+    tags = ['clubs', f'club:{club_id}']
+    if tag_names:
+        tags.append('tags')
+        tags.extend(f'tag:{name}' for name in tag_names)
+    response_cache.invalidate(*tags)
 
 
 # Method to create a success response
-def create_success_response(data):
-    return jsonify({'success': True, 'data': data})
+# Any extra keyword arguments are added next to the data (e.g. the cursor for the next page)
+def create_success_response(data, **extra):
+    return jsonify({'success': True, 'data': data, **extra})
 
 
 # Method to create an error response
@@ -71,6 +280,31 @@ def create_error_response(message, status_code):
     return jsonify({'success': False, 'message': message}), status_code
 
 
+# Raised when a query parameter that has to be a whole number isn't one, so the route answers with a 400 instead of
+# acting like the parameter wasn't sent
+class InvalidArgument(Exception):
+    pass
+
+
+# Like request.args.get(name, default, type=int), except that a value that isn't a whole number raises InvalidArgument
+def int_arg(name, default=None):
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise InvalidArgument(f"{name} must be an integer")
+
+
+# Method to create the error response for a failed upload (see blobstore.py)
+def create_upload_error_response(error):
+    # Tell the client where to continue a resumable upload from
+    if isinstance(error, UploadOffsetMismatch):
+        return jsonify({'success': False, 'message': str(error), 'offset': error.offset}), error.status_code
+    return create_error_response(str(error), error.status_code)
+
+
 # Default endpoint
 @app.route('/')
 def main():
@@ -83,20 +317,50 @@ def api():
     return jsonify({"message": "Welcome to the Penn Club Review API!."})
 
 
+# Hit and miss counters of the response cache
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    return create_success_response(response_cache.stats())
+
+
+# Request metrics in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 # Get all the existing clubs' information
+## Sample usage: '/api/clubs' streams every club, '/api/clubs?limit=50&after=120' returns one page of clubs
 @app.route('/api/clubs', methods=['GET'])
+@read_only
+@response_cache.cached('clubs')
 # @oauth.require_oauth()
 def get_clubs():
     try:
-        clubs = Club.query.all()
-        club_data = [club.to_json() for club in clubs]
-        return create_success_response(club_data)
+        limit = int_arg('limit')
+        after = int_arg('after', 0)
+
+        # Without a limit, stream the whole list instead of building it in memory
+        if limit is None:
+            return Response(stream_with_context(stream_clubs()), mimetype='application/json')
+
+        if limit < 1:
+            return create_error_response("limit must be a positive integer", 400)
+
+        clubs = get_club_batch(after, min(limit, CLUBS_MAX_PAGE_SIZE))
+
+        # The id of the last club is the cursor for the next page (None if this is the last page)
+        next_after = clubs[-1].id if len(clubs) == min(limit, CLUBS_MAX_PAGE_SIZE) else None
+        return create_success_response([club.to_json() for club in clubs], next_after=next_after)
+    except InvalidArgument as e:
+        return create_error_response(str(e), 400)
     except Exception as e:
         return create_error_response(str(e), 500)
 
 
 # Get the information about a specific user
 @app.route('/api/users/<string:username>', methods=['GET'])
+@read_only
 def get_username(username):
     user = User.query.filter_by(username=username).first()
     if user:
@@ -105,16 +369,80 @@ def get_username(username):
         return create_error_response(f"User '{username}' not found", 404)
 
 
-# Get a specific club's information based on if the name is a substring
+# Recommend clubs to a user: the clubs most similar (by tags and members) to the clubs they joined, and then the most
+# favorited clubs if that's not enough (e.g. the user hasn't joined any clubs yet)
+## Sample usage: '/api/users/josh/recommendations', '/api/users/josh/recommendations?limit=5'
+@app.route('/api/users/<string:username>/recommendations', methods=['GET'])
+@read_only
+@response_cache.cached('clubs', 'recommendations')
+def get_recommendations(username):
+    try:
+        limit = int_arg('limit', RECOMMENDATIONS_PAGE_SIZE)
+        if limit < 1 or limit > RECOMMENDATIONS_MAX_PAGE_SIZE:
+            return create_error_response(f"limit must be between 1 and {RECOMMENDATIONS_MAX_PAGE_SIZE}", 400)
+
+        user_id = db.session.query(User.id).filter_by(username=username).scalar()
+        if user_id is None:
+            return create_error_response(f"User '{username}' not found", 404)
+
+        joined = select(user_club_association.c.club_id).where(user_club_association.c.user_id == user_id)
+        score = func.sum(ClubSimilarity.score)
+        club_ids = db.session.execute(
+            select(ClubSimilarity.neighbor_id)
+            .where(ClubSimilarity.club_id.in_(joined), ClubSimilarity.neighbor_id.notin_(joined))
+            .group_by(ClubSimilarity.neighbor_id)
+            .order_by(score.desc(), ClubSimilarity.neighbor_id)
+            .limit(limit)
+        ).scalars().all()
+
+        if len(club_ids) < limit:
+            club_ids += db.session.execute(
+                select(Club.id)
+                .where(Club.id.notin_(joined), Club.id.notin_(club_ids))
+                .order_by(Club.favorite_count.desc(), Club.id)
+                .limit(limit - len(club_ids))
+            ).scalars().all()
+
+        clubs = Club.query.filter(Club.id.in_(club_ids)) \
+            .options(selectinload(Club.tags), selectinload(Club.files).load_only(File.path)).all()
+        clubs_by_id = {club.id: club for club in clubs}
+        return create_success_response([clubs_by_id[club_id].to_json() for club_id in club_ids if club_id in clubs_by_id])
+
+    except InvalidArgument as e:
+        return create_error_response(str(e), 400)
+    except Exception as e:
+        return create_error_response(str(e), 500)
+
+
+# Search for clubs whose name or description contains the searched words, best matches first
+## Sample usage: '/api/clubs/lorem ipsum', '/api/clubs/penn?limit=10&offset=10'
 @app.route('/api/clubs/<string:search_name>', methods=['GET'])
+@read_only
+@response_cache.cached('clubs')
 def get_clubs_by_name(search_name):
     try:
-        # The club's name for this method is CASE INSENSITIVE
-        clubs = Club.query.filter(func.lower(Club.name).contains(search_name.lower())).all()
-        if clubs: # If the club exists
-            return create_success_response([club.to_json() for club in clubs])
-        else:
+        limit = min(int_arg('limit', SEARCH_PAGE_SIZE), SEARCH_MAX_PAGE_SIZE)
+        offset = int_arg('offset', 0)
+        if limit < 1 or offset < 0:
+            return create_error_response("limit must be positive and offset can't be negative", 400)
+
+        # The search is CASE INSENSITIVE
+        club_ids = search_club_ids(search_name, limit, offset)
+        if not club_ids:
             return create_error_response(f"No clubs found matching '{search_name}'", 404)
+
+        # Load the whole page of clubs at once and put them back in the order of relevance
+        clubs = Club.query \
+            .options(selectinload(Club.tags), selectinload(Club.files).load_only(File.path)) \
+            .filter(Club.id.in_(club_ids)) \
+            .all()
+        clubs_by_id = {club.id: club for club in clubs}
+        club_data = [clubs_by_id[club_id].to_json() for club_id in club_ids if club_id in clubs_by_id]
+
+        next_offset = offset + limit if len(club_ids) == limit else None
+        return create_success_response(club_data, next_offset=next_offset)
+    except InvalidArgument as e:
+        return create_error_response(str(e), 400)
     except Exception as e:
         return create_error_response(str(e), 500)
 
@@ -149,6 +477,7 @@ def add_club():
 
         db.session.add(club)
         db.session.commit()
+        invalidate_club_cache(club.id, tags)
 
         return create_success_response({"message": f"Added {club_info['name']} to the database."})
 
@@ -161,12 +490,12 @@ def add_club():
 @login_required
 def fav_club(club_name):
     try:
-        club = Club.query.filter_by(name=club_name).first()
+        club_id = db.session.query(Club.id).filter_by(name=club_name).scalar()
 
-        if club:
-            # Increment the favorite count
-            club.favorite_count += 1
-            db.session.commit()
+        if club_id is not None:
+            # Increment the favorite count (it gets written to the database with the next batch of likes, which is also
+            # when the cached club lists get dropped, so a burst of likes doesn't drop them on every like)
+            favorite_buffer.add(club_id)
             return create_success_response(f"{club_name} favorited")
         else:
             return create_error_response(f"{club_name} not in database", 400)
@@ -188,10 +517,13 @@ def modify_club(club_name):
             # Can only modify the code, description, and tags
             club.code = club_info.get('code', club.code)
             club.description = club_info.get('description', club.description)
+            changed_tags = []
             if 'tags' in club_info:
+                changed_tags = [tag.name for tag in club.tags] + club_info['tags']
                 club.tags = get_all_tags(club_info['tags'])
 
             db.session.commit()
+            invalidate_club_cache(club.id, changed_tags)
             return create_success_response(f"{club_name} modified")
         else:
             return create_error_response(f"{club_name} not in database", 400)
@@ -200,15 +532,125 @@ def modify_club(club_name):
         return create_error_response(str(e), 500)
 
 
+# Whether the tags of a bulk item (if it has any) are a list of tag names
+def valid_tags(club_info):
+    tags = club_info.get('tags', [])
+    return isinstance(tags, list) and all(isinstance(name, str) for name in tags)
+
+
+# Create, modify and favorite many clubs at once
+# All the clubs and tags are looked up with one query each and everything is written in a single transaction,
+# and every item gets its own result (in the same order) so the client knows which ones didn't work.
+## Sample usage: '/api/clubs/bulk' with {"create": [{"name": ..., "tags": [...]}], "update": [{"name": ..., "description": ...}], "favorite": [{"name": ..., "count": 3}]}
+@app.route('/api/clubs/bulk', methods=['POST'])
+@login_required
+def bulk_clubs():
+    try:
+        bulk_info = request.get_json()
+        creates = bulk_info.get('create', [])
+        updates = bulk_info.get('update', [])
+        favorites = bulk_info.get('favorite', [])
+
+        if not all(isinstance(items, list) for items in (creates, updates, favorites)):
+            return create_error_response("create, update and favorite have to be lists", 400)
+        if len(creates) + len(updates) + len(favorites) > app.config['BULK_MAX_ITEMS']:
+            return create_error_response(f"At most {app.config['BULK_MAX_ITEMS']} items can be sent at once", 400)
+
+        items = creates + updates + favorites
+        if not all(isinstance(item, dict) and isinstance(item.get('name'), str) for item in items):
+            return create_error_response("Every item needs a name", 400)
+
+        # Look up every club and tag the request mentions in one query each (the items with bad tags get skipped below)
+        names = set(item['name'] for item in items)
+        clubs = {club.name: club for club in Club.query.filter(Club.name.in_(names)).options(selectinload(Club.tags)).all()}
+        tag_names = set(name for item in creates + updates if valid_tags(item) for name in item.get('tags', []))
+        tags = {tag.name: tag for tag in get_all_tags(tag_names)} if tag_names else {}
+
+        created, modified, favorited = [], [], []
+        changed = []  # (club, names of the tags it had or has now) for the cache invalidation
+
+        for club_info in creates:
+            if not valid_tags(club_info):
+                created.append({'name': club_info['name'], 'success': False, 'message': "tags has to be a list of tag names"})
+                continue
+            if club_info['name'] in clubs:
+                created.append({'name': club_info['name'], 'success': False, 'message': "Club name already exists"})
+                continue
+
+            club = Club(
+                code=club_info.get('code', ""),
+                name=club_info['name'],
+                description=club_info.get('description', ""),
+                tags=[tags[name] for name in set(club_info.get('tags', []))]
+            )
+            db.session.add(club)
+            clubs[club.name] = club
+            changed.append((club, club_info.get('tags', [])))
+            created.append({'name': club.name, 'success': True, 'message': f"Added {club.name} to the database."})
+
+        for club_info in updates:
+            club = clubs.get(club_info['name'])
+            if not valid_tags(club_info):
+                modified.append({'name': club_info['name'], 'success': False, 'message': "tags has to be a list of tag names"})
+                continue
+            if club is None:
+                modified.append({'name': club_info['name'], 'success': False, 'message': f"{club_info['name']} not in database"})
+                continue
+
+            # Can only modify the code, description, and tags
+            club.code = club_info.get('code', club.code)
+            club.description = club_info.get('description', club.description)
+            changed_tags = []
+            if 'tags' in club_info:
+                changed_tags = [tag.name for tag in club.tags] + club_info['tags']
+                club.tags = [tags[name] for name in set(club_info['tags'])]
+            changed.append((club, changed_tags))
+            modified.append({'name': club.name, 'success': True, 'message': f"{club.name} modified"})
+
+        # The new clubs need their ids before they can be favorited
+        db.session.flush()
+        # (read now, since the commit expires the clubs and reading their ids afterwards would load every one again)
+        changed = [(club.id, changed_tags) for club, changed_tags in changed]
+
+        increments = []
+        for favorite_info in favorites:
+            club = clubs.get(favorite_info['name'])
+            count = favorite_info.get('count', 1)
+            if club is None:
+                favorited.append({'name': favorite_info['name'], 'success': False, 'message': f"{favorite_info['name']} not in database"})
+            elif not isinstance(count, int) or isinstance(count, bool) or count < 1:
+                favorited.append({'name': club.name, 'success': False, 'message': "count has to be a positive integer"})
+            else:
+                increments.append({'club_id': club.id, 'count': count})
+                favorited.append({'name': club.name, 'success': True, 'message': f"{club.name} favorited"})
+
+        # Add the favorites straight to the counts in the database (in the same transaction)
+        if increments:
+            db.session.execute(text("UPDATE club SET favorite_count = favorite_count + :count WHERE id = :club_id"), increments)
+            change_log.record_favorites(db.session.connection(), [increment['club_id'] for increment in increments])
+
+        db.session.commit()
+
+        for club_id, changed_tags in changed:
+            invalidate_club_cache(club_id, changed_tags)
+        if increments:
+            response_cache.invalidate('clubs')
+            change_log.notify()
+
+        return create_success_response({'create': created, 'update': modified, 'favorite': favorited})
+
+    except Exception as e:
+        return create_error_response(str(e), 500)
+
+
 # Show a list of tags and the number of clubs associated with each tag.
 @app.route('/api/tags/count', methods=['GET'])
+@read_only
+@response_cache.cached('tags')
 def get_tags():
     try:
-        # Get the number of clubs associated with each tag
-        tag_counts = db.session.query(Tag.name, func.count(Club.id)) \
-            .outerjoin(Club.tags) \
-            .group_by(Tag.name) \
-            .all()
+        # Get the number of clubs associated with each tag (the counts are kept up to date by the database)
+        tag_counts = db.session.query(Tag.name, Tag.club_count).all()
 
         result = [{"tag": name, "club_count": count} for name, count in tag_counts]
         return create_success_response(result)
@@ -218,16 +660,52 @@ def get_tags():
 
 # Get all the names of the clubs given a tag
 @app.route('/api/tags/<string:tag_name>/names', methods=['GET'])
+@read_only
+@response_cache.cached('tag:{tag_name}')
 def get_clubs_by_tag(tag_name):
     try:
-        # Find the club objects that have that tag
-        clubs_with_tag = Club.query.filter(Club.tags.any(name=tag_name)).all()
+        # Find the club objects that have that tag (joining from the tag, so only its clubs are read)
+        clubs_with_tag = Club.query.join(Club.tags).filter(Tag.name == tag_name).order_by(Club.id).all()
         club_names = [club.name for club in clubs_with_tag]
         return create_success_response({"clubs": club_names})
     except Exception as e:
         return create_error_response(str(e), 500)
 
 
+# Find the clubs whose tags match an expression with AND, OR, NOT and parentheses (a comma also means AND, and tag
+# names with spaces go in quotes). The clubs come back with the most favorited first, one page at a time, together with
+# how many of the matching clubs have each tag (facets) so the UI can show how many clubs every extra filter would leave.
+## Sample usage: '/api/tags/query?q=Undergraduate AND (Arts OR "Performing Arts"), NOT Graduate&limit=20&offset=0'
+@app.route('/api/tags/query', methods=['GET'])
+@read_only
+@response_cache.cached('clubs', 'tags')
+def query_tags():
+    try:
+        limit = int_arg('limit', TAG_QUERY_PAGE_SIZE)
+        offset = int_arg('offset', 0)
+        if limit < 1 or limit > TAG_QUERY_MAX_PAGE_SIZE:
+            return create_error_response(f"limit must be between 1 and {TAG_QUERY_MAX_PAGE_SIZE}", 400)
+        if offset < 0:
+            return create_error_response("offset can't be negative", 400)
+
+        try:
+            clubs = tag_index.query(request.args.get('q', ''))
+        except TagQueryError as e:
+            return create_error_response(f"Invalid tag expression: {e}", 400)
+
+        total = len(clubs)
+        page = page_by_favorites(db.session, clubs, limit, offset)
+        facets = [{"tag": name, "club_count": count} for name, count in tag_index.facets(clubs, TAG_QUERY_FACETS)]
+        next_offset = offset + limit if offset + limit < total else None
+
+        return create_success_response({"clubs": [name for _, name in page], "total": total, "facets": facets},
+                                       next_offset=next_offset)
+    except InvalidArgument as e:
+        return create_error_response(str(e), 400)
+    except Exception as e:
+        return create_error_response(str(e), 500)
+
+
 # Delete a club if it exists
 @app.route('/api/clubs/<string:club_name>', methods=['DELETE'])
 @login_required
@@ -236,8 +714,11 @@ def delete_club(club_name):
         club = Club.query.filter_by(name=club_name).first()
 
         if club:
+            tag_names = [tag.name for tag in club.tags]
             db.session.delete(club)
             db.session.commit()
+            favorite_buffer.discard(club.id)
+            invalidate_club_cache(club.id, tag_names)
             return create_success_response(f"{club_name} deleted.")
         else:
             return create_error_response(f"{club_name} not in database", 400)
@@ -286,8 +767,8 @@ def signup():
         if user:
             return create_error_response("Username already exists", 409)
 
-        # Hash the password with the sha256 algorithm and save it to the database
-        hashed_password = generate_password_hash(user_info['password'], method='sha256')
+        # Hash the password with scrypt (werkzeug's default, in the hashing pool) and save it to the database
+        hashed_password = password_hasher.hash(user_info['password'])
         new_user = User(username=user_info['username'], password=hashed_password)
 
         db.session.add(new_user)
@@ -295,6 +776,8 @@ def signup():
 
         return create_success_response({'message': 'User registered successfully'})
 
+    except HashingBusy as e:
+        return create_error_response(str(e), 503)
     except Exception as e:
         return create_error_response(str(e), 500)
 
@@ -357,6 +840,13 @@ def login():
         if not user_info.get('username') or not user_info.get('password'):
             return create_error_response("Not all required fields were sent", 400)
 
+        # Turn the client away before doing any work if this username or IP has failed too many times recently
+        ip = request.remote_addr or 'unknown'
+        wait = login_rate_limiter.check(user_info['username'], ip)
+        if wait:
+            message, status = create_error_response("Too many failed login attempts. Try again later.", 429)
+            return message, status, {'Retry-After': str(wait)}
+
         user = User.query.filter_by(username=user_info['username']).first()
 
         # Check if the user account is locked
@@ -364,16 +854,20 @@ def login():
             return create_error_response("Account is locked. Try again later.", 400)
 
         # Combine this together so the person won't know if it's the username or password that's wrong (for security reasons)
-        if not user or not check_password_hash(user.password, user_info['password']):
-            # Increase login attempts if the user exists
-            if user:
-                user.increase_login_attempts()
+        if not user or not password_hasher.verify(user.password, user_info['password']):
+            # Only lock the account (the one write to the database) once there were too many failures
+            if login_rate_limiter.record_failure(user_info['username'], ip) and user:
+                user.lock_account(login_rate_limiter.lock_minutes)
                 db.session.commit()
+                login_rate_limiter.account_locked(user_info['username'])
             return create_error_response("Wrong username or password.", 400)
 
+        login_rate_limiter.reset(user_info['username'])
         login_user(user)
         return create_success_response({"message": "Logged in."})
 
+    except HashingBusy as e:
+        return create_error_response(str(e), 503)
     except Exception as e:
         return create_error_response(str(e), 500)
 
@@ -399,45 +893,137 @@ def logout():
 ##### File Management #####
 ## NOTE: Normally, I would upload the files to a file server like S3, but in this case, I am just going to save it under "folders"
 
+# Saves an uploaded file's information and adds it to the club's files, returning 201 if it's a new file or 200 if it replaced one
+def save_club_file(club, file_path, digest, size, content_type):
+    file_obj, response_code = get_files(file_path, digest, size, content_type)
+    if file_obj not in club.files:
+        club.files.append(file_obj)
+    db.session.commit()
+    invalidate_club_cache(club.id)
+    # Start making the smaller versions of images right away, so they're ready when the club's page asks for them
+    thumbnailer.queue(blob_store.path_for(digest), digest, content_type)
+    return response_code
+
+
+# Checks that a resumable upload was started for this file, and returns the information saved when it was started
+def get_upload_info(upload_id, file_path):
+    info = blob_store.upload_info(upload_id)
+    if info['path'] != file_path:
+        raise UploadNotFound(f"Upload {upload_id} does not exist for {file_path}")
+    return info
+
+
 # Upload a file to a specific club
+# The request body is streamed into the blob store while it's being hashed instead of being read into memory all at once.
+# With an upload_id and an offset, the body is one part of a resumable upload instead (see start_or_finish_upload).
+## Sample usage: PUT '/api/clubs/Penn Memes Club/files/logo.png', PUT '/api/clubs/Penn Memes Club/files/logo.png?upload_id=<id>&offset=0'
 @app.route('/api/clubs/<string:club_name>/files/<path:resource_path>', methods=['PUT'])
 def upload_file(club_name, resource_path):
     try:
         club = Club.query.filter_by(name=club_name).first()
 
-        file_path = club_name + "_" + resource_path
+        # Get everything after "upload" as the file name
+        file_path = os.path.join(UPLOAD_FOLDER, club_name + "_" + resource_path)
+        max_size = app.config['MAX_UPLOAD_SIZE']
 
         if club:
-            # Get the binary data and the content type header
-            binary_data = request.data
+            # Upload one part of a resumable upload
+            if 'upload_id' in request.args:
+                offset = request.args.get('offset', type=int)
+                if offset is None:
+                    return create_error_response("The offset of the part is required", 400)
+
+                upload_id = request.args['upload_id']
+                get_upload_info(upload_id, file_path)
+                new_offset = blob_store.write_part(upload_id, offset, request.stream, max_size)
+                return create_success_response({'upload_id': upload_id, 'offset': new_offset})
+
+            # Get the content type header
             content_type = request.headers.get('Content-Type')
 
+            # Reject files that are too big before reading anything if the size was sent
+            if request.content_length and request.content_length > max_size:
+                return create_error_response(f"The file is larger than {max_size} bytes", 413)
+
+            # Write the binary data to the blob store (if nobody uploaded the same contents before)
+            digest, size = blob_store.put_stream(request.stream, max_size)
+
             # Check if the file is empty
-            if not binary_data:
+            if not size:
                 return create_error_response(f"{club_name} file is empty.", 400)
 
-            # Get everything after "upload" as the file name
-            file_path = os.path.join(UPLOAD_FOLDER, file_path)
+            # Append the file_path to the club's files
+            return "", save_club_file(club, file_path, digest, size, content_type)
+        else:
+            return create_error_response(f"{club_name} not in database.", 400)
 
-            # Write the binary data to a file
-            with open(file_path, 'wb') as f:
-                f.write(binary_data)
+    except UploadError as e:
+        return create_upload_error_response(e)
+    except Exception as e:
+        return create_error_response(str(e), 500)
 
-            # Append the file_path to the club's files
-            file_obj, response_code = get_files(file_path, binary_data, content_type)
-            club.files.append(file_obj)
-            db.session.commit()
 
-            return "", response_code
+# Start or finish a resumable upload of a file to a specific club
+# Starting an upload returns its upload_id, then the parts are sent with PUT (see upload_file), and finishing
+# the upload saves the file just like a normal upload. The unfinished upload is kept on disk, so if the connection
+# drops, the upload can continue from the offset returned by GET '...?upload_id=<id>'.
+## Sample usage: POST '/api/clubs/Penn Memes Club/files/logo.png?uploads', POST '/api/clubs/Penn Memes Club/files/logo.png?upload_id=<id>'
+@app.route('/api/clubs/<string:club_name>/files/<path:resource_path>', methods=['POST'])
+def start_or_finish_upload(club_name, resource_path):
+    try:
+        club = Club.query.filter_by(name=club_name).first()
+
+        file_path = os.path.join(UPLOAD_FOLDER, club_name + "_" + resource_path)
+
+        if club:
+            # Start a new upload (the content type of the file is given when starting it)
+            if 'upload_id' not in request.args:
+                upload_id = blob_store.begin_upload({
+                    'path': file_path,
+                    'content_type': request.headers.get('Content-Type')
+                })
+                return create_success_response({'upload_id': upload_id, 'offset': 0}), 201
+
+            # Finish the upload
+            upload_id = request.args['upload_id']
+            get_upload_info(upload_id, file_path)
+            if blob_store.upload_offset(upload_id) == 0:
+                return create_error_response(f"{club_name} file is empty.", 400)
+
+            info, digest, size = blob_store.finish_upload(upload_id)
+            return "", save_club_file(club, file_path, digest, size, info['content_type'])
         else:
             return create_error_response(f"{club_name} not in database.", 400)
 
+    except UploadError as e:
+        return create_upload_error_response(e)
+    except Exception as e:
+        return create_error_response(str(e), 500)
+
+
+# Cancel a resumable upload
+## Sample usage: DELETE '/api/clubs/Penn Memes Club/files/logo.png?upload_id=<id>'
+@app.route('/api/clubs/<string:club_name>/files/<path:resource_path>', methods=['DELETE'])
+def abort_upload(club_name, resource_path):
+    try:
+        file_path = os.path.join(UPLOAD_FOLDER, club_name + "_" + resource_path)
+        upload_id = request.args.get('upload_id')
+
+        get_upload_info(upload_id, file_path)
+        blob_store.abort_upload(upload_id)
+        return create_success_response(f"Cancelled upload {upload_id}.")
+
+    except UploadError as e:
+        return create_upload_error_response(e)
     except Exception as e:
         return create_error_response(str(e), 500)
 
 
 # Retrieve all the file contents for a specific club
+# The file is streamed from disk instead of being read into memory, and it supports partial downloads (Range headers)
+# and conditional requests (If-None-Match/If-Modified-Since) using the file's hash as its ETag
 @app.route('/api/clubs/<string:club_name>/files/<path:resource_path>', methods=['GET'])
+@read_only
 def retrieve_file(club_name, resource_path):
     try:
         club = Club.query.filter_by(name=club_name).first()
@@ -447,29 +1033,65 @@ def retrieve_file(club_name, resource_path):
         if club:
             file_path = os.path.join(UPLOAD_FOLDER, file_path)
 
-            # Check if the file path exists
-            if not os.path.exists(file_path):
-                return create_error_response(f"{file_path} file does not exist.", 400)
+            # Check how much of a resumable upload has been received so far
+            if 'upload_id' in request.args:
+                upload_id = request.args['upload_id']
+                get_upload_info(upload_id, file_path)
+                return create_success_response({'upload_id': upload_id, 'offset': blob_store.upload_offset(upload_id)})
 
             file_obj = File.query.filter_by(path=file_path).first()
 
-            if not file_obj:
+            # Check if the file exists
+            if not file_obj or not blob_store.exists(file_obj.sha256):
                 return create_error_response(f"{file_path} file does not exist.", 400)
 
-            content_type = file_obj.content_type
-
-            with open(file_path, 'rb') as f:
-                binary_data = f.read()
+            # The hash only changes when the contents change, so it works as a strong ETag
+            etag = file_obj.sha256
+            last_modified = file_obj.uploaded_at
+
+            # A smaller or recompressed version of an image (e.g. '?w=128&format=webp') has its own ETag
+            variant = 'w' in request.args or 'format' in request.args
+            if variant:
+                width = request.args.get('w', 0, type=int) if 'w' in request.args else None
+                width, format = thumbnailer.variant_for(file_obj.content_type, width, request.args.get('format'))
+                etag = f"{file_obj.sha256}-{width or 'full'}.{format}"
+
+            # If the client already has this version of the file, answer without opening the file
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = Response(status=304)
+                response.set_etag(etag)
+                response.last_modified = last_modified
+                return response
+
+            # Variants are made the first time they're asked for (if the upload didn't make them already),
+            # and sent to be shown inline (e.g. as a logo) instead of downloaded
+            if variant:
+                return send_file(
+                    thumbnailer.get(blob_store.path_for(file_obj.sha256), file_obj.sha256, width, format),
+                    mimetype=FORMATS[format][1],
+                    download_name=f"{os.path.splitext(file_path)[0]}-{width or 'full'}.{format}",
+                    conditional=True,
+                    etag=etag,
+                    last_modified=last_modified
+                )
 
             # Get the content type for specifying how the binary data should be stored
-            response = make_response(binary_data)
-            response.headers.set('Content-Type', content_type)
-            response.headers.set(
-                'Content-Disposition', 'attachment', filename=file_path)
-            return response
+            return send_file(
+                blob_store.path_for(file_obj.sha256),
+                mimetype=file_obj.content_type,
+                as_attachment=True,
+                download_name=file_path,
+                conditional=True,
+                etag=etag,
+                last_modified=last_modified
+            )
         else:
             return create_error_response(f"{club_name} not in database.", 400)
 
+    except UploadError as e:
+        return create_upload_error_response(e)
+    except VariantError as e:
+        return create_error_response(str(e), 400)
     except Exception as e:
         return create_error_response(str(e), 500)
 
@@ -500,6 +1122,7 @@ def create_comment(club_name):
             )
             db.session.add(comment)
             db.session.commit()
+            response_cache.invalidate(f'club:{club.id}')
 
             return create_success_response(f"Added comment to {club_name}.")
 
@@ -512,11 +1135,14 @@ def create_comment(club_name):
 
 # Retrieve all comments for a club
 @app.route('/api/clubs/<string:club_name>/comments', methods=['GET'])
+@read_only
+@response_cache.cached()
 def retrieve_comments(club_name):
     try:
         club = Club.query.filter_by(name=club_name).first()
 
         if club:
+            add_cache_tags(f'club:{club.id}')
             # Find the comments
             comments = Comment.query.filter_by(club_id=club.id).all()
             return create_success_response([comment.to_json() for comment in comments])
@@ -527,8 +1153,92 @@ def retrieve_comments(club_name):
         return create_error_response(str(e), 500)
 
 
+# Loads a page of comment threads for a club with one query.
+# A recursive query walks down from the top level comments (the ones after the comment id `after`) through all of their replies,
+# counting how many replies each thread has, and only the replies up to `max_depth` levels deep are returned.
+# Returns (comment, root comment id, depth, number of replies in the thread, number of direct replies) for each comment.
+def get_comment_threads(club_id, after, limit, max_depth):
+    roots = select(Comment.id) \
+        .where(Comment.club_id == club_id, Comment.parent_id.is_(None), Comment.id > after) \
+        .order_by(Comment.id) \
+        .limit(limit)
+
+    tree = select(Comment.id, Comment.parent_id, Comment.id.label('root_id'), literal(0).label('depth')) \
+        .where(Comment.id.in_(roots)) \
+        .cte('tree', recursive=True)
+    reply = aliased(Comment)
+    tree = tree.union_all(
+        select(reply.id, reply.parent_id, tree.c.root_id, tree.c.depth + 1).where(reply.parent_id == tree.c.id)
+    )
+
+    # Count the replies of every thread before cutting it off at max_depth
+    thread = select(
+        tree.c.id,
+        tree.c.root_id,
+        tree.c.depth,
+        (func.count().over(partition_by=tree.c.root_id) - 1).label('thread_reply_count')
+    ).subquery()
+
+    direct_replies = aliased(Comment)
+    reply_count = select(func.count()).where(direct_replies.parent_id == thread.c.id).scalar_subquery()
+
+    return db.session.execute(
+        select(Comment, thread.c.root_id, thread.c.depth, thread.c.thread_reply_count, reply_count)
+        .join(thread, Comment.id == thread.c.id)
+        .where(thread.c.depth <= max_depth)
+        .order_by(thread.c.depth, Comment.id)
+    ).all()
+
+
+# Retrieve the comments of a club as threads, where every comment has its replies nested inside of it
+# Every comment also has its number of direct replies (reply_count), and every thread its total number of replies,
+# so clients know when replies were cut off by the depth limit
+## Sample usage: '/api/clubs/Penn Memes Club/comments/threads?limit=20&after=100&depth=2'
+@app.route('/api/clubs/<string:club_name>/comments/threads', methods=['GET'])
+@read_only
+@response_cache.cached()
+def retrieve_comment_threads(club_name):
+    try:
+        limit = min(int_arg('limit', THREADS_PAGE_SIZE), THREADS_MAX_PAGE_SIZE)
+        after = int_arg('after', 0)
+        max_depth = min(int_arg('depth', THREADS_DEPTH), THREADS_MAX_DEPTH)
+        if limit < 1 or max_depth < 0:
+            return create_error_response("limit must be positive and depth can't be negative", 400)
+
+        club = Club.query.filter_by(name=club_name).first()
+
+        if club:
+            add_cache_tags(f'club:{club.id}')
+            threads = []
+            comments_by_id = {}
+
+            # The rows come ordered by depth, so every reply comes after the comment it replies to
+            for comment, root_id, depth, thread_reply_count, reply_count in get_comment_threads(club.id, after, limit, max_depth):
+                comment_data = comment.to_json()
+                comment_data['reply_count'] = reply_count
+                comment_data['replies'] = []
+                comments_by_id[comment.id] = comment_data
+
+                if depth == 0:
+                    comment_data['thread_reply_count'] = thread_reply_count
+                    threads.append(comment_data)
+                else:
+                    comments_by_id[comment.parent_id]['replies'].append(comment_data)
+
+            next_after = threads[-1]['comment id'] if len(threads) == limit else None
+            return create_success_response(threads, next_after=next_after)
+        else:
+            return create_error_response(f"{club_name} not in database.", 400)
+
+    except InvalidArgument as e:
+        return create_error_response(str(e), 400)
+    except Exception as e:
+        return create_error_response(str(e), 500)
+
+
 # Retrieve a specific comment
 @app.route('/api/clubs/comments/<int:comment_id>', methods=['GET'])
+@read_only
 @login_required
 def retrieve_specific_comment(comment_id):
     try:
@@ -560,6 +1270,7 @@ def update_comment(comment_id):
 
             comment.content = comment_info['comment']
             db.session.commit()
+            response_cache.invalidate(f'club:{comment.club_id}')
 
             return create_success_response(f"Updated comment {comment_id}.")
 
@@ -580,6 +1291,7 @@ def delete_comment(comment_id):
         if comment:
             db.session.delete(comment)
             db.session.commit()
+            response_cache.invalidate(f'club:{comment.club_id}')
             return create_success_response(f"Deleted comment {comment_id}.")
 
         else:
@@ -612,6 +1324,7 @@ def reply_comment(comment_id):
             )
             db.session.add(reply)
             db.session.commit()
+            response_cache.invalidate(f'club:{comment.club_id}')
 
             return create_success_response(f"Added reply to comment {comment_id}.")
 
@@ -622,5 +1335,448 @@ def reply_comment(comment_id):
         return create_error_response(str(e), 500)
 
 
+##### Exports #####
+# The columns of every export, in the order they're written to the CSV files
+EXPORT_COLUMNS = {
+    'clubs': ['id', 'code', 'name', 'description', 'likes', 'tags', 'files', 'created_at', 'updated_at'],
+    'comments': ['id', 'club_id', 'user_id', 'parent_id', 'content', 'created_at', 'updated_at'],
+    'memberships': ['user_id', 'username', 'club_id', 'club_name', 'joined_at'],
+}
+EXPORT_MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+
+# Every club with its tags and file paths in one query: the tags and paths of each club are gathered into JSON arrays
+# by the database, so no club objects (or their relationships) have to be loaded
+def club_export_statement(since):
+    tags = select(func.json_group_array(Tag.name)) \
+        .select_from(club_tag_association.join(Tag)) \
+        .where(club_tag_association.c.club_id == Club.id) \
+        .scalar_subquery()
+    files = select(func.json_group_array(File.path)) \
+        .select_from(club_file_association.join(File)) \
+        .where(club_file_association.c.club_id == Club.id) \
+        .scalar_subquery()
+    statement = select(Club.id, Club.code, Club.name, Club.description, Club.favorite_count,
+                       tags.label('tags'), files.label('files'), Club.created_at, Club.updated_at)
+    return order_export(statement, Club.id, Club.updated_at, since)
+
+
+def comment_export_statement(since):
+    statement = select(Comment.id, Comment.club_id, Comment.user_id, Comment.parent_id, Comment.content,
+                       Comment.created_at, Comment.updated_at)
+    return order_export(statement, Comment.id, Comment.updated_at, since)
+
+
+def membership_export_statement(since):
+    association = user_club_association.c
+    statement = select(association.user_id, User.username, association.club_id, Club.name, association.joined_at) \
+        .join(User, User.id == association.user_id) \
+        .join(Club, Club.id == association.club_id)
+    return order_export(statement, (association.user_id, association.club_id), association.joined_at, since)
+
+
+# A full export is read in the order of the primary key, and an export since a time in the order of the timestamp's
+# index, so the database never has to sort (and hold) the rows before sending the first one
+def order_export(statement, key, timestamp, since):
+    key = key if isinstance(key, tuple) else (key,)
+    if since is None:
+        return statement.order_by(*key)
+    return statement.where(timestamp >= since).order_by(timestamp, *key)
+
+
+def club_export_row(row):
+    return {'id': row.id, 'code': row.code, 'name': row.name, 'description': row.description,
+            'likes': row.favorite_count + favorite_buffer.get(row.id), # includes the likes that haven't been written yet
+            'tags': app.json.loads(row.tags), 'files': app.json.loads(row.files),
+            'created_at': export_time(row.created_at), 'updated_at': export_time(row.updated_at)}
+
+
+def comment_export_row(row):
+    return {'id': row.id, 'club_id': row.club_id, 'user_id': row.user_id, 'parent_id': row.parent_id,
+            'content': row.content, 'created_at': export_time(row.created_at), 'updated_at': export_time(row.updated_at)}
+
+
+def membership_export_row(row):
+    return {'user_id': row.user_id, 'username': row.username, 'club_id': row.club_id, 'club_name': row.name,
+            'joined_at': export_time(row.joined_at)}
+
+
+EXPORTS = {
+    'clubs': (club_export_statement, club_export_row),
+    'comments': (comment_export_statement, comment_export_row),
+    'memberships': (membership_export_statement, membership_export_row),
+}
+
+
+# The times are exported in ISO 8601 (UTC), which is also what `since` takes
+def export_time(value):
+    return value.isoformat() if value else None
+
+
+# Reads the `since` parameter (e.g. "2024-09-01T12:00:00" or "2024-09-01T08:00:00-04:00") as a UTC time
+def parse_since(value):
+    since = datetime.fromisoformat(value)
+    if since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    return since
+
+
+# Writes out the rows one batch at a time. The rows come from the database cursor EXPORT_BATCH_SIZE at a time,
+# so the memory used stays the same however many rows there are.
+def stream_export(result, columns, make_row, format):
+    if format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for rows in result.partitions():
+            for row in rows:
+                values = make_row(row)
+                # The lists (tags and files) are written as JSON arrays
+                writer.writerow([app.json.dumps(values[column]) if isinstance(values[column], list) else values[column]
+                                 for column in columns])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+    else:
+        for rows in result.partitions():
+            yield ''.join(app.json.dumps(make_row(row)) + '\n' for row in rows)
+
+
+# Export every club (with its tags and file paths), comment or membership as NDJSON (one JSON object per line) or CSV,
+# in one streamed response. With `since`, only the rows added or changed since then are exported (deleted rows aren't).
+# The whole export is read in one read transaction, so it's a consistent snapshot even while other requests write.
+## Sample usage: '/api/export/clubs', '/api/export/comments?format=csv', '/api/export/memberships?since=2024-09-01T00:00:00'
+@app.route('/api/export/<string:kind>', methods=['GET'])
+@read_only
+@login_required
+def export(kind):
+    try:
+        if kind not in EXPORTS:
+            return create_error_response(f"Can only export {', '.join(EXPORTS)}", 404)
+
+        format = request.args.get('format', 'ndjson')
+        if format not in EXPORT_MIMETYPES:
+            return create_error_response(f"format has to be one of {', '.join(EXPORT_MIMETYPES)}", 400)
+
+        since = request.args.get('since')
+        try:
+            since = parse_since(since) if since else None
+        except ValueError:
+            return create_error_response("since has to be an ISO 8601 time (e.g. 2024-09-01T12:00:00)", 400)
+
+        make_statement, make_row = EXPORTS[kind]
+        result = db.session.execute(make_statement(since), execution_options={'yield_per': EXPORT_BATCH_SIZE})
+        response = Response(stream_with_context(stream_export(result, EXPORT_COLUMNS[kind], make_row, format)),
+                            mimetype=EXPORT_MIMETYPES[format])
+        response.headers['Content-Disposition'] = f'attachment; filename="{kind}.{format}"'
+        return response
+
+    except Exception as e:
+        return create_error_response(str(e), 500)
+
+
+##### Changes #####
+# Get the changes to the clubs, comments and files after the sequence number `since` (see changelog.py), oldest first.
+# Every change has the object's JSON after the change (deletes only have what's needed to find the object), and
+# next_since is what to send as `since` the next time. Without `since`, there are no changes and next_since is the
+# newest sequence number, so a client can ask for that first, download the clubs once, and from then on only the changes.
+## Sample usage: '/api/changes', '/api/changes?since=1200', '/api/changes?since=1200&limit=500'
+@app.route('/api/changes', methods=['GET'])
+@read_only
+def get_changes():
+    try:
+        since = int_arg('since')
+        limit = int_arg('limit', CHANGES_PAGE_SIZE)
+        if limit < 1:
+            return create_error_response("limit must be a positive integer", 400)
+
+        if since is None:
+            return create_success_response([], next_since=change_log.latest(), has_more=False)
+
+        limit = min(limit, CHANGES_MAX_PAGE_SIZE)
+        changes = change_log.read(since, limit)
+        return create_success_response(changes, next_since=changes[-1]['seq'] if changes else since,
+                                       has_more=len(changes) == limit)
+
+    except ChangesGone as e:
+        # The changes the client missed were compacted away, so it has to download everything again
+        return create_error_response(str(e), 410)
+    except InvalidArgument as e:
+        return create_error_response(str(e), 400)
+    except Exception as e:
+        return create_error_response(str(e), 500)
+
+
+def change_event(change):
+    return f"id: {change['seq']}\nevent: change\ndata: {app.json.dumps(change)}\n\n"
+
+
+# Sends the changes as server-sent events as soon as they're committed. Commits from this process wake the stream up
+# right away, and commits from other processes are picked up every CHANGES_STREAM_POLL_INTERVAL seconds.
+def stream_change_events(since, changes, version):
+    # EventSource reconnects this many milliseconds after the stream ends, with the last id as Last-Event-ID
+    yield "retry: 1000\n\n"
+    deadline = time.monotonic() + CHANGES_STREAM_MAX_SECONDS
+    last_sent = time.monotonic()
+    while True:
+        if changes:
+            yield ''.join(change_event(change) for change in changes)
+            since = changes[-1]['seq']
+            last_sent = time.monotonic()
+        elif time.monotonic() - last_sent >= CHANGES_STREAM_KEEPALIVE:
+            # A comment line, so proxies don't close a stream that has been quiet for a while
+            yield ": keepalive\n\n"
+            last_sent = time.monotonic()
+
+        if time.monotonic() >= deadline:
+            break
+        # A full page means there are more changes waiting already
+        if len(changes) < CHANGES_MAX_PAGE_SIZE:
+            version = change_log.wait(version, CHANGES_STREAM_POLL_INTERVAL)
+        try:
+            changes = change_log.read(since, CHANGES_MAX_PAGE_SIZE)
+        except ChangesGone as e:
+            yield f"event: gone\ndata: {app.json.dumps({'message': str(e)})}\n\n"
+            break
+
+
+# Stream the changes after `since` (or the Last-Event-ID an EventSource sends when it reconnects) as they happen,
+# as server-sent events. Without either, the stream starts with the next change.
+## Sample usage: 'new EventSource("/api/changes/stream?since=1200")'
+@app.route('/api/changes/stream', methods=['GET'])
+@read_only
+def stream_changes():
+    try:
+        since = request.headers.get('Last-Event-ID', type=int)
+        if since is None:
+            since = int_arg('since')
+
+        # Taken before the first read, so a commit right after it still wakes the stream up
+        version = change_log.version
+        if since is None:
+            since, changes = change_log.latest(), []
+        else:
+            changes = change_log.read(since, CHANGES_MAX_PAGE_SIZE)
+
+        # Every stream holds one of the server's threads, so only CHANGES_MAX_STREAMS of them can be open at once and the
+        # other requests always have threads left (asgi.py streams without a thread, see stream_changes there)
+        if not change_log.stream_started(app.config['CHANGES_MAX_STREAMS']):
+            return create_error_response("Too many change streams are open. Poll /api/changes instead, or try again later.", 503)
+
+        response = Response(stream_with_context(stream_change_events(since, changes, version)), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.call_on_close(change_log.stream_ended)
+        return response
+
+    except ChangesGone as e:
+        return create_error_response(str(e), 410)
+    except InvalidArgument as e:
+        return create_error_response(str(e), 400)
+    except Exception as e:
+        return create_error_response(str(e), 500)
+
+
+##### Maintenance Commands #####
+# Creates the club search index if it is missing (e.g. for a database made before it existed) and rebuilds it from the club table
+## Sample usage: 'flask --app app rebuild-search'
+@app.cli.command('rebuild-search')
+def rebuild_search():
+    with db.engine.begin() as connection:
+        for statement in CLUB_SEARCH_DDL:
+            connection.execute(text(statement))
+        connection.execute(text("INSERT INTO club_search(club_search) VALUES ('rebuild')"))
+    print("Rebuilt the club search index.")
+
+
+# Recounts the clubs for every tag from scratch, prints the tags whose stored count had drifted and fixes them.
+# It also adds the club_count column and creates the triggers that keep the counts up to date if they are missing
+# (e.g. for a database made before they existed).
+## Sample usage: 'flask --app app check-tag-counts'
+@app.cli.command('check-tag-counts')
+def check_tag_counts():
+    with db.engine.begin() as connection:
+        columns = [row[1] for row in connection.execute(text("PRAGMA table_info(tag)"))]
+        if 'club_count' not in columns:
+            connection.execute(text("ALTER TABLE tag ADD COLUMN club_count INTEGER NOT NULL DEFAULT 0"))
+        for statement in TAG_COUNT_DDL:
+            connection.execute(text(statement))
+
+        actual_counts = select(func.count()) \
+            .select_from(club_tag_association) \
+            .where(club_tag_association.c.tag_id == Tag.id) \
+            .scalar_subquery()
+        drifted = connection.execute(
+            select(Tag.name, Tag.club_count, actual_counts).where(Tag.club_count != actual_counts)
+        ).all()
+
+        for name, stored, actual in drifted:
+            print(f"{name}: stored {stored}, actual {actual}")
+        connection.execute(update(Tag).values(club_count=actual_counts))
+
+    print(f"Rebuilt the tag counts ({len(drifted)} tag(s) had drifted).")
+
+
+# Creates the recommendation tables, their index and triggers if they are missing (e.g. for a database made before they existed)
+# and computes the most similar clubs of every club from scratch
+## Sample usage: 'flask --app app build-recommendations'
+@app.cli.command('build-recommendations')
+def build_recommendations():
+    ClubSimilarity.__table__.create(db.engine, checkfirst=True)
+    recommendation_dirty.create(db.engine, checkfirst=True)
+    for index in recommendation_dirty.indexes:
+        index.create(db.engine, checkfirst=True)
+    with db.engine.begin() as connection:
+        for statements in RECOMMENDATION_DIRTY_DDL.values():
+            for statement in statements:
+                connection.execute(text(statement))
+
+    started = time.monotonic()
+    clubs = recommendation_index.build()
+    print(f"Computed the similar clubs of {clubs} clubs in {time.monotonic() - started:.1f}s.")
+
+
+# Adds the indexes to a database made before they existed: the association tables get a unique index on their pairs
+# (after dropping the pairs that were stored twice) and an index on their second column, the comments get the
+# indexes on their club and parent, and the clubs get the index on their likes
+## Sample usage: 'flask --app app add-indexes'
+@app.cli.command('add-indexes')
+def add_indexes():
+    tables = [club_tag_association, user_club_association, club_file_association]
+    with db.engine.begin() as connection:
+        for table in tables:
+            if any(row[5] for row in connection.execute(text(f"PRAGMA table_info({table.name})"))):
+                continue  # the pairs are already the primary key
+
+            first, second = [column.name for column in table.primary_key.columns]
+            removed = connection.execute(text(
+                f"DELETE FROM {table.name} WHERE {first} IS NULL OR {second} IS NULL OR rowid NOT IN "
+                f"(SELECT min(rowid) FROM {table.name} GROUP BY {first}, {second})"
+            )).rowcount
+            connection.execute(text(
+                f"CREATE UNIQUE INDEX IF NOT EXISTS ix_{table.name}_pair ON {table.name} ({first}, {second})"
+            ))
+            print(f"{table.name}: removed {removed} duplicate or incomplete pair(s)")
+
+        for table in tables + [Comment.__table__]:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+        club_favorites_index.create(connection, checkfirst=True)
+    print("Added the indexes.")
+
+
+# Adds the timestamps the exports filter on to a database made before they existed. The rows that are already there
+# get the current time, so the first export with `since` after this includes all of them.
+## Sample usage: 'flask --app app add-timestamps'
+@app.cli.command('add-timestamps')
+def add_timestamps():
+    timestamps = {
+        Club.__table__: ['created_at', 'updated_at'],
+        Comment.__table__: ['created_at', 'updated_at'],
+        user_club_association: ['joined_at'],
+    }
+    now = datetime.utcnow()
+    with db.engine.begin() as connection:
+        for table, names in timestamps.items():
+            columns = [row[1] for row in connection.execute(text(f"PRAGMA table_info({table.name})"))]
+            for name in names:
+                if name not in columns:
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {name} DATETIME"))
+                connection.execute(text(f"UPDATE {table.name} SET {name} = :now WHERE {name} IS NULL"), {'now': now})
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+    print("Added the timestamps.")
+
+
+# Creates the change log table for a database made before it existed (until then, the writes aren't logged)
+## Sample usage: 'flask --app app create-change-log'
+@app.cli.command('create-change-log')
+def create_change_log():
+    Change.__table__.create(db.engine, checkfirst=True)
+    print("Created the change log.")
+
+
+# Deletes the changes that are older than CHANGE_LOG_RETENTION or beyond the newest CHANGE_LOG_MAX_ENTRIES (the server
+# also does this every CHANGE_LOG_COMPACT_INTERVAL seconds)
+## Sample usage: 'flask --app app compact-changes'
+@app.cli.command('compact-changes')
+def compact_changes():
+    print(f"Compacted the change log ({change_log.compact()} change(s) deleted).")
+
+
+# Moves the contents of files uploaded before the blob store existed out of the database and into the blob store,
+# then drops the old content column and shrinks the database file
+## Sample usage: 'flask --app app migrate-file-blobs'
+@app.cli.command('migrate-file-blobs')
+def migrate_file_blobs():
+    with db.engine.begin() as connection:
+        columns = [row[1] for row in connection.execute(text("PRAGMA table_info(file)"))]
+        # Added after the blobs were, so a database that was already migrated may not have it yet
+        if 'uploaded_at' not in columns:
+            connection.execute(text("ALTER TABLE file ADD COLUMN uploaded_at DATETIME"))
+            connection.execute(text("UPDATE file SET uploaded_at = :now"), {'now': datetime.utcnow()})
+
+        if 'content' not in columns:
+            print("The file contents are already in the blob store.")
+            return
+
+        if 'sha256' not in columns:
+            connection.execute(text("ALTER TABLE file ADD COLUMN sha256 VARCHAR(64)"))
+            connection.execute(text("ALTER TABLE file ADD COLUMN size INTEGER"))
+
+        # Move one file at a time so that only one blob is ever in memory
+        file_ids = connection.execute(text("SELECT id FROM file WHERE sha256 IS NULL")).scalars().all()
+        for file_id in file_ids:
+            content = connection.execute(text("SELECT content FROM file WHERE id = :id"), {'id': file_id}).scalar()
+            digest, size = blob_store.put(content or b'')
+            connection.execute(
+                text("UPDATE file SET sha256 = :digest, size = :size WHERE id = :id"),
+                {'digest': digest, 'size': size, 'id': file_id}
+            )
+
+        connection.execute(text("ALTER TABLE file DROP COLUMN content"))
+        connection.execute(text("CREATE INDEX IF NOT EXISTS ix_file_sha256 ON file (sha256)"))
+
+    # VACUUM can't run inside a transaction
+    with db.engine.connect() as connection:
+        connection.execution_options(isolation_level='AUTOCOMMIT').execute(text("VACUUM"))
+
+    print(f"Moved {len(file_ids)} file(s) into the blob store.")
+
+
+# Imports clubs from a JSON array file (like clubs.json) or an NDJSON file, in batches of --chunk-size clubs
+## Sample usage: 'flask --app app import-clubs clubs.json'
+@app.cli.command('import-clubs')
+@click.argument('path')
+@click.option('--chunk-size', default=1000, help="How many clubs are written per transaction")
+def import_clubs_command(path, chunk_size):
+    imported, skipped = import_clubs(iter_club_records(path), db.engine, chunk_size=chunk_size)
+    response_cache.bump_version()
+    print(f"Done: imported {imported} clubs, skipped {skipped} that already existed.")
+
+
+# Scrapes clubs from web pages or saved HTML files and imports them, e.g. to test the scraper offline against a
+# directory of saved pages or a local server. "{page}" in a URL is replaced with every page number up to --pages.
+## Sample usage: 'flask --app app scrape-clubs https://ocwp.pennlabs.org/', 'flask --app app scrape-clubs saved_pages/ --dry-run'
+@app.cli.command('scrape-clubs')
+@click.argument('sources', nargs=-1, required=True)
+@click.option('--pages', default=1, help="How many pages to scrape for URLs with {page} in them")
+@click.option('--workers', default=8, help="How many pages are downloaded at the same time")
+@click.option('--dry-run', is_flag=True, help="Only scrape and count the clubs without saving them")
+def scrape_clubs_command(sources, pages, workers, dry_run):
+    clubs = scrape(sources, pages=pages, fetch_workers=workers)
+    if dry_run:
+        started = time.monotonic()
+        count = sum(1 for club in clubs)
+        elapsed = time.monotonic() - started
+        print(f"Scraped {count} clubs in {elapsed:.2f}s ({count / elapsed if elapsed else 0:.0f} clubs/sec).")
+        return
+
+    imported, skipped = import_clubs(clubs, db.engine)
+    response_cache.bump_version()
+    print(f"Done: imported {imported} clubs, skipped {skipped} that already existed.")
+
+
 if __name__ == '__main__':
     app.run()
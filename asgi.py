@@ -0,0 +1,456 @@
+import asyncio, json, os, time, unicodedata
+from contextlib import asynccontextmanager
+from urllib.parse import quote
+from a2wsgi import WSGIMiddleware
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import selectinload
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.http import dump_options_header, http_date, is_resource_modified, quote_etag
+from app import app as flask_app, db, blob_store, build_search_query, club_batch_statement, SEARCH_STATEMENT, \
+    UPLOAD_FOLDER, CLUBS_MAX_PAGE_SIZE, CLUBS_STREAM_BATCH_SIZE, SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE, \
+    TAG_QUERY_PAGE_SIZE, TAG_QUERY_MAX_PAGE_SIZE, TAG_QUERY_FACETS, InvalidArgument, start_background_threads, \
+    CHANGES_MAX_PAGE_SIZE, CHANGES_STREAM_POLL_INTERVAL, CHANGES_STREAM_KEEPALIVE, CHANGES_STREAM_MAX_SECONDS, change_event
+from cache import response_cache, CacheEntry
+from changelog import change_log, changes_after, check_since, ChangesGone, LATEST_SEQ, LOG_BOUNDS
+from compression import compression, compress, compress_for_cache, is_compressible, negotiate, StreamEncoder
+from database import make_pragma_listener
+from models import Club, Comment, File, Tag, User
+from tagindex import tag_index, PAGE_NAMES, TagQueryError, order_page
+
+
+# An ASGI version of the app, e.g. 'uvicorn asgi:application --workers 2'.
+# The read endpoints that get the most traffic are async here: while one request waits on SQLite (through aiosqlite) or
+# on a file being sent, the same worker keeps serving the others, instead of needing a thread (or a process) per request.
+# They return exactly the same responses as the Flask routes and share the response cache with them.
+# Every other request (logins, writes, uploads, ...) goes to the Flask app, which runs in a pool of threads
+# (ASGI_WSGI_WORKERS) so it doesn't block the async requests either.
+
+
+# Async engine for the same database with the read engine's settings (see database.py)
+def create_engine():
+    with flask_app.app_context():
+        engine = db.engines.get('read', db.engine)
+    options = dict(flask_app.config['SQLALCHEMY_BINDS'].get('read', flask_app.config['SQLALCHEMY_ENGINE_OPTIONS']))
+    options.pop('url', None)
+
+    async_engine = create_async_engine(engine.url.set(drivername='sqlite+aiosqlite'), **options)
+    pragmas = dict(flask_app.config['SQLITE_PRAGMAS'], query_only=1)
+    event.listen(async_engine.sync_engine, 'connect', make_pragma_listener(pragmas))
+    return async_engine
+
+
+engine = create_engine()
+Session = async_sessionmaker(engine, expire_on_commit=False)
+flask_wsgi = WSGIMiddleware(flask_app, workers=flask_app.config.setdefault('ASGI_WSGI_WORKERS', 10))
+
+
+# Same body as jsonify in the Flask app (sorted keys, no spaces, newline at the end)
+def json_response(data, status_code=200):
+    return Response(flask_app.json.dumps(data, separators=(',', ':')) + '\n', status_code, media_type='application/json')
+
+
+def create_success_response(data, **extra):
+    return json_response({'success': True, 'data': data, **extra})
+
+
+def create_error_response(message, status_code):
+    return json_response({'success': False, 'message': message}, status_code)
+
+
+# Like int_arg in the Flask app
+def int_arg(request, name, default=None):
+    value = request.query_params.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise InvalidArgument(f"{name} must be an integer")
+
+
+# The async version of ResponseCache.cached: the view returns (response, tags), and successful responses are cached
+# under the same key the Flask routes use, so both versions of a route share their cached responses
+def cached(view):
+    async def wrapper(request):
+        key = request.scope['path'] + '?' + request.scope['query_string'].decode('utf-8', 'replace')
+        entry = response_cache.get(key)
+        if entry is not None:
+            response = Response(entry.body, entry.status, media_type=entry.mimetype)
+            response.cache_entry = entry  # so the compressed body can be reused
+            return response
+
+        generation = response_cache.start_response()
+        try:
+            response, tags = await view(request)
+            if response.status_code == 200 and not isinstance(response, StreamingResponse):
+                expires = time.monotonic() + response_cache.default_ttl
+                entry = CacheEntry(response.body, 200, 'application/json', frozenset(tags), expires)
+                response_cache.set(key, entry, generation)
+                response.cache_entry = entry
+            return response
+        finally:
+            response_cache.finish_response(generation)
+    return wrapper
+
+
+# An endpoint that handles the request itself, or lets the Flask app handle it when the view returns None
+class AsyncEndpoint:
+    def __init__(self, view):
+        self.view = view
+
+    async def __call__(self, scope, receive, send):
+        request = Request(scope, receive)
+        response = await self.view(request)
+        if response is None:
+            await flask_wsgi(scope, receive, send)
+        else:
+            await compress_response(request, response)(scope, receive, send)
+
+
+# Compresses the response the same way the Flask app does (see compression.py)
+def compress_response(request, response):
+    if (response.status_code != 200 or isinstance(response, FileResponse) or 'content-encoding' in response.headers
+            or not is_compressible(response.media_type)):
+        return response
+
+    response.headers.add_vary_header('Accept-Encoding')
+    encoding = negotiate(request.headers.get('accept-encoding'))
+    if encoding is None:
+        return response
+
+    if isinstance(response, StreamingResponse):
+        response.body_iterator = compress_chunks(response.body_iterator, encoding)
+        if 'content-length' in response.headers:
+            del response.headers['content-length']
+    else:
+        if len(response.body) < compression.min_size:
+            return response
+        entry = getattr(response, 'cache_entry', None)
+        response.body = response_cache.compressed(entry, encoding, compress_for_cache) if entry else compress(response.body, encoding)
+        response.headers['content-length'] = str(len(response.body))
+
+    response.headers['content-encoding'] = encoding
+    return response
+
+
+async def compress_chunks(chunks, encoding):
+    encoder = StreamEncoder(encoding)
+    async for chunk in chunks:
+        data = encoder.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield encoder.finish()
+
+
+# Writes out every club as a JSON array one batch at a time (like stream_clubs in app.py)
+async def stream_clubs():
+    yield '{"success": true, "data": ['
+    after = 0
+    separator = ''
+    async with Session() as session:
+        while True:
+            clubs = (await session.execute(club_batch_statement(after, CLUBS_STREAM_BATCH_SIZE))).scalars().all()
+            if clubs:
+                yield separator + ','.join(flask_app.json.dumps(club.to_json()) for club in clubs)
+                separator = ','
+            if len(clubs) < CLUBS_STREAM_BATCH_SIZE:
+                break
+            after = clubs[-1].id
+    yield ']}'
+
+
+@cached
+async def get_clubs(request):
+    try:
+        limit = int_arg(request, 'limit')
+        after = int_arg(request, 'after', 0)
+
+        if limit is None:
+            return StreamingResponse(stream_clubs(), media_type='application/json'), ()
+        if limit < 1:
+            return create_error_response("limit must be a positive integer", 400), ()
+
+        async with Session() as session:
+            clubs = (await session.execute(club_batch_statement(after, min(limit, CLUBS_MAX_PAGE_SIZE)))).scalars().all()
+
+        next_after = clubs[-1].id if len(clubs) == min(limit, CLUBS_MAX_PAGE_SIZE) else None
+        return create_success_response([club.to_json() for club in clubs], next_after=next_after), ('clubs',)
+    except InvalidArgument as e:
+        return create_error_response(str(e), 400), ()
+    except Exception as e:
+        return create_error_response(str(e), 500), ()
+
+
+async def get_username(request):
+    username = request.path_params['username']
+    async with Session() as session:
+        user = (await session.execute(
+            select(User).options(selectinload(User.clubs)).where(User.username == username)
+        )).scalars().first()
+    if user:
+        return create_success_response(user.to_json())
+    else:
+        return create_error_response(f"User '{username}' not found", 404)
+
+
+@cached
+async def get_clubs_by_name(request):
+    try:
+        search_name = request.path_params['search_name']
+        limit = min(int_arg(request, 'limit', SEARCH_PAGE_SIZE), SEARCH_MAX_PAGE_SIZE)
+        offset = int_arg(request, 'offset', 0)
+        if limit < 1 or offset < 0:
+            return create_error_response("limit must be positive and offset can't be negative", 400), ()
+
+        query = build_search_query(search_name)
+        async with Session() as session:
+            club_ids = []
+            if query:
+                rows = await session.execute(SEARCH_STATEMENT, {'query': query, 'limit': limit, 'offset': offset})
+                club_ids = [row[0] for row in rows]
+            if not club_ids:
+                return create_error_response(f"No clubs found matching '{search_name}'", 404), ()
+
+            clubs = (await session.execute(
+                select(Club)
+                .options(selectinload(Club.tags), selectinload(Club.files).load_only(File.path))
+                .where(Club.id.in_(club_ids))
+            )).scalars().all()
+
+        clubs_by_id = {club.id: club for club in clubs}
+        club_data = [clubs_by_id[club_id].to_json() for club_id in club_ids if club_id in clubs_by_id]
+
+        next_offset = offset + limit if len(club_ids) == limit else None
+        return create_success_response(club_data, next_offset=next_offset), ('clubs',)
+    except InvalidArgument as e:
+        return create_error_response(str(e), 400), ()
+    except Exception as e:
+        return create_error_response(str(e), 500), ()
+
+
+@cached
+async def get_tags(request):
+    try:
+        async with Session() as session:
+            tag_counts = (await session.execute(select(Tag.name, Tag.club_count))).all()
+        result = [{"tag": name, "club_count": count} for name, count in tag_counts]
+        return create_success_response(result), ('tags',)
+    except Exception as e:
+        return create_error_response(str(e), 500), ()
+
+
+@cached
+async def get_clubs_by_tag(request):
+    try:
+        tag_name = request.path_params['tag_name']
+        statement = select(Club.name).join(Club.tags).where(Tag.name == tag_name).order_by(Club.id)
+        async with Session() as session:
+            names = (await session.execute(statement)).scalars().all()
+        return create_success_response({"clubs": names}), (f'tag:{tag_name}',)
+    except Exception as e:
+        return create_error_response(str(e), 500), ()
+
+
+@cached
+async def query_tags(request):
+    try:
+        limit = int_arg(request, 'limit', TAG_QUERY_PAGE_SIZE)
+        offset = int_arg(request, 'offset', 0)
+        if limit < 1 or limit > TAG_QUERY_MAX_PAGE_SIZE:
+            return create_error_response(f"limit must be between 1 and {TAG_QUERY_MAX_PAGE_SIZE}", 400), ()
+        if offset < 0:
+            return create_error_response("offset can't be negative", 400), ()
+
+        # The bitmap operations are plain Python, so they run in a thread to keep the event loop free
+        try:
+            clubs = await run_in_threadpool(tag_index.query, request.query_params.get('q', ''))
+        except TagQueryError as e:
+            return create_error_response(f"Invalid tag expression: {e}", 400), ()
+        facets = await run_in_threadpool(tag_index.facets, clubs, TAG_QUERY_FACETS)
+
+        total = len(clubs)
+        page = await run_in_threadpool(tag_index.page, clubs, limit, offset)
+        async with Session() as session:
+            page = order_page(page, (await session.execute(PAGE_NAMES, {'ids': json.dumps(page)})).all())
+        facets = [{"tag": name, "club_count": count} for name, count in facets]
+        next_offset = offset + limit if offset + limit < total else None
+
+        return create_success_response({"clubs": [name for _, name in page], "total": total, "facets": facets},
+                                       next_offset=next_offset), ('clubs', 'tags')
+    except InvalidArgument as e:
+        return create_error_response(str(e), 400), ()
+    except Exception as e:
+        return create_error_response(str(e), 500), ()
+
+
+@cached
+async def retrieve_comments(request):
+    try:
+        club_name = request.path_params['club_name']
+        async with Session() as session:
+            club_id = (await session.execute(select(Club.id).where(Club.name == club_name))).scalar()
+            if club_id is None:
+                return create_error_response(f"{club_name} not in database.", 400), ()
+            comments = (await session.execute(select(Comment).where(Comment.club_id == club_id))).scalars().all()
+        return create_success_response([comment.to_json() for comment in comments]), (f'club:{club_id}',)
+    except Exception as e:
+        return create_error_response(str(e), 500), ()
+
+
+# The Content-Disposition header Flask's send_file would send for a download
+def content_disposition(download_name):
+    try:
+        download_name.encode('ascii')
+        names = {'filename': download_name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        names = {'filename': simple, 'filename*': "UTF-8''" + quote(download_name, safe="!#$&+^`|~")}
+    return dump_options_header('attachment', names)
+
+
+# Sends the file from disk without blocking the event loop (resumable upload status requests and image variants, which
+# may have to be made first, go to the Flask app)
+async def retrieve_file(request):
+    if any(name in request.query_params for name in ('upload_id', 'w', 'format')):
+        return None
+
+    try:
+        club_name = request.path_params['club_name']
+        file_path = os.path.join(UPLOAD_FOLDER, club_name + "_" + request.path_params['resource_path'])
+        async with Session() as session:
+            club_id = (await session.execute(select(Club.id).where(Club.name == club_name))).scalar()
+            if club_id is None:
+                return create_error_response(f"{club_name} not in database.", 400)
+            file_obj = (await session.execute(select(File).where(File.path == file_path))).scalars().first()
+
+        if not file_obj or not blob_store.exists(file_obj.sha256):
+            return create_error_response(f"{file_path} file does not exist.", 400)
+
+        headers = {
+            'etag': quote_etag(file_obj.sha256),
+            'last-modified': http_date(file_obj.uploaded_at),
+            'content-disposition': content_disposition(file_path)
+        }
+
+        # If the client already has this version of the file, answer without opening the file
+        environ = {'REQUEST_METHOD': request.method}
+        for name in ('if-none-match', 'if-modified-since', 'if-range', 'range'):
+            if name in request.headers:
+                environ['HTTP_' + name.upper().replace('-', '_')] = request.headers[name]
+        if not is_resource_modified(environ, etag=file_obj.sha256, last_modified=file_obj.uploaded_at):
+            return Response(status_code=304, headers=headers)
+
+        return FileResponse(blob_store.path_for(file_obj.sha256), media_type=file_obj.content_type, headers=headers)
+    except Exception as e:
+        return create_error_response(str(e), 500)
+
+
+# Set (and replaced by a new event) whenever this process commits changes, to wake up the change streams
+changes_committed = None
+
+
+def wake_change_streams():
+    global changes_committed
+    changes_committed.set()
+    changes_committed = asyncio.Event()
+
+
+async def read_changes(since, limit):
+    async with Session() as session:
+        check_since(since, *(await session.execute(LOG_BOUNDS)).one())
+        rows = (await session.execute(changes_after(since, limit))).all()
+    return [change_log.to_json(change) for change in rows]
+
+
+# Like stream_change_events in app.py, but a stream only waits on the event loop, so it doesn't hold one of the
+# Flask app's threads (and there's no limit on how many can be open)
+async def stream_change_events(since, changes, committed):
+    change_log.stream_started()
+    try:
+        yield "retry: 1000\n\n"
+        deadline = time.monotonic() + CHANGES_STREAM_MAX_SECONDS
+        last_sent = time.monotonic()
+        while True:
+            if changes:
+                yield ''.join(change_event(change) for change in changes)
+                since = changes[-1]['seq']
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent >= CHANGES_STREAM_KEEPALIVE:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+
+            if time.monotonic() >= deadline:
+                break
+            if len(changes) < CHANGES_MAX_PAGE_SIZE:
+                try:
+                    await asyncio.wait_for(committed.wait(), CHANGES_STREAM_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            # Taken before the read, so a commit during it still wakes the stream up
+            committed = changes_committed
+            try:
+                changes = await read_changes(since, CHANGES_MAX_PAGE_SIZE)
+            except ChangesGone as e:
+                yield f"event: gone\ndata: {flask_app.json.dumps({'message': str(e)})}\n\n"
+                break
+    finally:
+        change_log.stream_ended()
+
+
+async def stream_changes(request):
+    try:
+        try:
+            since = int(request.headers['last-event-id'])
+        except (KeyError, ValueError):
+            since = int_arg(request, 'since')
+
+        committed = changes_committed
+        if since is None:
+            async with Session() as session:
+                since, changes = (await session.execute(LATEST_SEQ)).scalar(), []
+        else:
+            changes = await read_changes(since, CHANGES_MAX_PAGE_SIZE)
+
+        return StreamingResponse(stream_change_events(since, changes, committed), media_type='text/event-stream',
+                                 headers={'Cache-Control': 'no-cache'})
+    except ChangesGone as e:
+        return create_error_response(str(e), 410)
+    except InvalidArgument as e:
+        return create_error_response(str(e), 400)
+    except Exception as e:
+        return create_error_response(str(e), 500)
+
+
+# The async routes don't go through the Flask app's before_request, so the background threads are started here.
+# Commits happen on other threads, so they wake the change streams up through the event loop.
+@asynccontextmanager
+async def lifespan(application):
+    global changes_committed
+    start_background_threads()
+    changes_committed = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    listener = lambda: loop.call_soon_threadsafe(wake_change_streams)
+    change_log.add_notify_listener(listener)
+    try:
+        yield
+    finally:
+        change_log.remove_notify_listener(listener)
+
+
+application = Starlette(lifespan=lifespan, routes=[
+    Route('/api/clubs', AsyncEndpoint(get_clubs), methods=['GET']),
+    Route('/api/users/{username}', AsyncEndpoint(get_username), methods=['GET']),
+    Route('/api/clubs/{search_name}', AsyncEndpoint(get_clubs_by_name), methods=['GET']),
+    Route('/api/tags/count', AsyncEndpoint(get_tags), methods=['GET']),
+    Route('/api/tags/query', AsyncEndpoint(query_tags), methods=['GET']),
+    Route('/api/tags/{tag_name}/names', AsyncEndpoint(get_clubs_by_tag), methods=['GET']),
+    Route('/api/clubs/{club_name}/comments', AsyncEndpoint(retrieve_comments), methods=['GET']),
+    Route('/api/clubs/{club_name}/files/{resource_path:path}', AsyncEndpoint(retrieve_file), methods=['GET']),
+    Route('/api/changes/stream', AsyncEndpoint(stream_changes), methods=['GET']),
+    Mount('/', app=flask_wsgi),
+])
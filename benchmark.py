@@ -0,0 +1,325 @@
+import argparse, json, math, os, random, subprocess, sys, tempfile, threading, time
+from datetime import datetime
+
+
+# Benchmarks every route of the app against a synthetic dataset (see synthetic.py) and saves the results as JSON,
+# so the numbers of two commits can be compared with --compare.
+#
+# Sample usage:
+#   python benchmark.py --clubs 10000 --comments 50000 --concurrency 8
+#   python benchmark.py --server --only comments
+#   python benchmark.py --asgi --concurrency 64 (compare with --server --concurrency 64)
+#   python benchmark.py --compare benchmark-abc1234.json benchmark-def5678.json
+
+
+# Returns the value below which the given percentage of the (sorted) values fall
+def percentile(values, percent):
+    if not values:
+        return 0
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+# The commit the benchmark runs on, so the results can be compared across commits
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+# Sends requests with the Flask test client (no HTTP in between)
+class TestClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, url, json=None, data=None):
+        response = self.client.open(url, method=method, json=json, data=data)
+        body = response.get_data()
+        response.close()
+        return response.status_code, response.headers, len(body)
+
+
+# Sends requests over HTTP to the local WSGI server
+class HTTPClient:
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def request(self, method, url, json=None, data=None):
+        response = self.session.request(method, self.base_url + url, json=json, data=data)
+        return response.status_code, response.headers, len(response.content)
+
+
+# The requests the benchmark sends. Each scenario is (name, needs a login, function that builds a request), and the
+# function gets a random generator and the dataset, and returns (method, url, json body, raw body).
+def make_scenarios(dataset):
+    from synthetic import WORDS, skewed_weights
+
+    clubs = dataset['clubs']
+    club_weights = skewed_weights(len(clubs), exponent=0.8)
+    tag_weights = skewed_weights(len(dataset['tags']))
+    counter = iter(range(sys.maxsize))
+
+    # Popular clubs and tags are requested more often, like they would be for real
+    def club(rng):
+        return rng.choices(clubs, weights=club_weights)[0]
+
+    def comment(rng):
+        return rng.choice(dataset['comments'])
+
+    return [
+        ('GET /api/clubs?limit', False, lambda rng: ('GET', f"/api/clubs?limit=50&after={rng.randrange(len(clubs))}", None, None)),
+        ('GET /api/clubs', False, lambda rng: ('GET', '/api/clubs', None, None)),
+        ('GET /api/clubs/<search_name>', False, lambda rng: ('GET', f"/api/clubs/{rng.choice(WORDS)[:rng.randint(3, 6)]}", None, None)),
+        ('GET /api/users/<username>', False, lambda rng: ('GET', f"/api/users/{rng.choice(dataset['users'])}", None, None)),
+        ('GET /api/users/<username>/recommendations', False, lambda rng: ('GET', f"/api/users/{rng.choice(dataset['users'])}/recommendations", None, None)),
+        ('GET /api/tags/count', False, lambda rng: ('GET', '/api/tags/count', None, None)),
+        ('GET /api/tags/<tag_name>/names', False, lambda rng: ('GET', f"/api/tags/{rng.choices(dataset['tags'], weights=tag_weights)[0]}/names", None, None)),
+        ('GET /api/tags/query', False, lambda rng: ('GET', '/api/tags/query?q={} AND NOT {}'.format(*rng.choices(dataset['tags'], weights=tag_weights, k=2)), None, None)),
+        ('GET /api/changes', False, lambda rng: ('GET', '/api/changes?since=0', None, None)),
+        ('GET /api/clubs/<club_name>/comments', False, lambda rng: ('GET', f"/api/clubs/{club(rng)}/comments", None, None)),
+        ('GET /api/clubs/<club_name>/comments/threads', False, lambda rng: ('GET', f"/api/clubs/{club(rng)}/comments/threads", None, None)),
+        ('GET /api/clubs/comments/<comment_id>', True, lambda rng: ('GET', f"/api/clubs/comments/{comment(rng)}", None, None)),
+        ('GET /api/clubs/<club_name>/files/<path>', False, lambda rng: ('GET', "/api/clubs/{}/files/{}".format(*rng.choice(dataset['files'])), None, None)),
+        ('PUT /api/clubs/<club_name>/files/<path>', True, lambda rng: ('PUT', f"/api/clubs/{club(rng)}/files/upload-{next(counter)}.bin", None, os.urandom(rng.randint(1024, 256 * 1024)))),
+        ('POST /api/clubs/new', True, lambda rng: ('POST', '/api/clubs/new', {'name': f"Benchmark Club {next(counter)}", 'description': ' '.join(rng.choices(WORDS, k=8)), 'tags': rng.sample(dataset['tags'], 2)}, None)),
+        ('PUT /api/clubs/mod/<club_name>', True, lambda rng: ('PUT', f"/api/clubs/mod/{club(rng)}", {'description': ' '.join(rng.choices(WORDS, k=8))}, None)),
+        ('POST /api/clubs/bulk', True, lambda rng: ('POST', '/api/clubs/bulk', {'update': [{'name': club(rng), 'description': ' '.join(rng.choices(WORDS, k=8))} for _ in range(20)], 'favorite': [{'name': club(rng)} for _ in range(20)]}, None)),
+        ('POST /api/clubs/fav/<club_name>', True, lambda rng: ('POST', f"/api/clubs/fav/{club(rng)}", None, None)),
+        ('POST /api/clubs/<club_name>/comments', True, lambda rng: ('POST', f"/api/clubs/{club(rng)}/comments", {'comment': ' '.join(rng.choices(WORDS, k=6))}, None)),
+        ('POST /api/clubs/comments/<comment_id>/reply', True, lambda rng: ('POST', f"/api/clubs/comments/{comment(rng)}/reply", {'comment': ' '.join(rng.choices(WORDS, k=6))}, None)),
+        ('PUT /api/clubs/comments/<comment_id>', True, lambda rng: ('PUT', f"/api/clubs/comments/{comment(rng)}", {'comment': ' '.join(rng.choices(WORDS, k=6))}, None)),
+    ]
+
+
+# The SQL statements and the requests the metrics (see metrics.py) have counted so far, leaving out the logins.
+# A request is only recorded once its response is closed, so the statements a streamed response runs while it's being
+# sent are counted too.
+def sql_totals():
+    from metrics import metrics
+
+    with metrics.lock:
+        histograms = [histogram for (route, method), histogram in metrics.statements.items() if route != '/login']
+        return sum(histogram.sum for histogram in histograms), sum(histogram.count for histogram in histograms)
+
+
+# The average number of SQL statements of the `requests` requests sent since the totals were `before`
+def sql_statements_per_request(before, requests):
+    # The last responses can be closed (and recorded) right after the client got them
+    deadline = time.monotonic() + 0.5
+    statements, count = sql_totals()
+    while count - before[1] < requests and time.monotonic() < deadline:
+        time.sleep(0.01)
+        statements, count = sql_totals()
+
+    count -= before[1]
+    return (statements - before[0]) / count if count else 0
+
+
+# Sends the requests of one scenario from `concurrency` threads at once, each with its own (logged in) client
+def run_scenario(make_client, login, make_request, requests, concurrency, warmup, seed):
+    results = []
+    lock = threading.Lock()
+    remaining = iter(range(requests))
+    ready = threading.Barrier(concurrency + 1)
+
+    def worker(number):
+        rng = random.Random(seed * 1000 + number)
+        client = make_client()
+        if login:
+            login(client)
+
+        for _ in range(warmup):
+            client.request(*make_request(rng))
+        ready.wait()
+
+        own_results = []
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    break
+            method, url, json_body, data = make_request(rng)
+            started = time.perf_counter()
+            status, headers, size = client.request(method, url, json=json_body, data=data)
+            own_results.append((time.perf_counter() - started, status, size))
+
+        with lock:
+            results.extend(own_results)
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(concurrency)]
+    for thread in threads:
+        thread.start()
+
+    # Every thread logs in and finishes its warmup before the clock starts
+    ready.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(result[0] * 1000 for result in results)
+    return {
+        'requests': len(results),
+        'concurrency': concurrency,
+        'throughput': len(results) / elapsed if elapsed else 0,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': latencies[-1] if latencies else 0,
+        'bytes_per_request': sum(result[2] for result in results) / len(results) if results else 0,
+        'errors': sum(1 for result in results if result[1] >= 400),
+    }
+
+
+def print_header():
+    print(f"{'route':<48} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'sql/req':>8} {'errors':>7}")
+
+
+def print_results(results):
+    for name, result in results.items():
+        print(f"{name:<48} {result['throughput']:>9.1f} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} "
+              f"{result['p99_ms']:>9.2f} {result['sql_statements_per_request']:>8.1f} {result['errors']:>7}")
+
+
+# Prints how much every route changed between two result files
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    print(f"{(old['commit'] or '?')[:10]} ({old.get('mode')}) -> {(new['commit'] or '?')[:10]} ({new.get('mode')})")
+    print(f"max RSS: {old.get('max_rss_kb')} KB -> {new.get('max_rss_kb')} KB")
+    print(f"{'route':<48} {'req/s':>16} {'p95 ms':>18} {'sql/req':>14}")
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        before = old['results'][name]
+
+        def change(key):
+            return (result[key] - before[key]) / before[key] * 100 if before[key] else 0
+
+        print(f"{name:<48} {result['throughput']:>9.1f} ({change('throughput'):+4.0f}%) "
+              f"{result['p95_ms']:>9.2f} ({change('p95_ms'):+4.0f}%) "
+              f"{before['sql_statements_per_request']:>5.1f} -> {result['sql_statements_per_request']:<5.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the routes of the app against a synthetic dataset")
+    parser.add_argument('--clubs', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--comments', type=int, default=5000)
+    parser.add_argument('--files', type=int, default=50)
+    parser.add_argument('--tags', type=int, default=None, help="number of tags (default: clubs / 100)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=200, help="requests per route")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=2, help="requests per thread before the clock starts")
+    parser.add_argument('--only', default=None, help="only run the routes whose name contains this")
+    parser.add_argument('--server', action='store_true', help="send the requests over HTTP to a local WSGI server")
+    parser.add_argument('--asgi', action='store_true', help="send the requests over HTTP to a local ASGI server (asgi.py)")
+    parser.add_argument('--no-cache', action='store_true', help="turn off the response cache")
+    parser.add_argument('--output', default=None, help="where to save the results (default: benchmark-<commit>.json)")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two result files instead")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    # The app has to be pointed at a new database before it's imported
+    directory = tempfile.mkdtemp(prefix='clubreview-benchmark-')
+    os.environ['CLUBREVIEW_DATABASE_URI'] = f"sqlite:///{os.path.join(directory, 'benchmark.db')}"
+
+    import app as clubreview
+    from blobstore import BlobStore
+    from cache import response_cache
+    from recommend import recommendation_index
+    from synthetic import generate_dataset, PASSWORD
+
+    app, db = clubreview.app, clubreview.db
+    clubreview.blob_store = BlobStore(os.path.join(directory, 'blobs'))
+    if args.no_cache:
+        response_cache.max_bytes = 0
+
+    started = time.perf_counter()
+    with app.app_context():
+        db.create_all()
+        dataset = generate_dataset(db.engine, clubreview.blob_store, clubs=args.clubs, users=args.users,
+                                   comments=args.comments, files=args.files, tags=args.tags, seed=args.seed)
+    recommendation_index.build()
+    print(f"Generated {args.clubs} clubs, {args.users} users, {args.comments} comments and {args.files} files "
+          f"in {time.perf_counter() - started:.1f}s")
+
+    if args.server:
+        from werkzeug.serving import make_server, WSGIRequestHandler
+
+        # Don't print a line for every request
+        class QuietRequestHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        make_client = lambda: HTTPClient(base_url)
+    elif args.asgi:
+        import socket, uvicorn
+        import asgi
+
+        # Find a free port for the server
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+
+        server = uvicorn.Server(uvicorn.Config(asgi.application, host='127.0.0.1', port=port, log_level='warning', access_log=False))
+        threading.Thread(target=server.run, daemon=True).start()
+        while not server.started:
+            time.sleep(0.05)
+        base_url = f"http://127.0.0.1:{port}"
+        make_client = lambda: HTTPClient(base_url)
+    else:
+        make_client = lambda: TestClient(app)
+
+    def login(client):
+        client.request('POST', '/login', json={'username': dataset['users'][0], 'password': PASSWORD})
+
+    print_header()
+    results = {}
+    for number, (name, needs_login, make_request) in enumerate(make_scenarios(dataset)):
+        if args.only and args.only not in name:
+            continue
+        # Getting every club is a lot slower than everything else, so it gets fewer requests
+        requests = max(1, args.requests // 20) if name == 'GET /api/clubs' else args.requests
+        before = sql_totals()
+        results[name] = run_scenario(make_client, login if needs_login else None, make_request,
+                                     requests, args.concurrency, args.warmup, args.seed + number)
+        # The warmup requests run the same statements, so they're counted too
+        results[name]['sql_statements_per_request'] = sql_statements_per_request(before, requests + args.warmup * args.concurrency)
+        print_results({name: results[name]})
+
+    try:
+        import resource
+        max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        max_rss_kb = None
+
+    commit = git_commit()
+    output = args.output or f"benchmark-{(commit or 'unknown')[:10]}.json"
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'date': datetime.now().isoformat(),
+            'mode': 'server' if args.server else 'asgi' if args.asgi else 'test_client',
+            'dataset': {'clubs': args.clubs, 'users': args.users, 'comments': args.comments, 'files': args.files,
+                        'tags': len(dataset['tags']), 'seed': args.seed},
+            'cache': not args.no_cache,
+            'max_rss_kb': max_rss_kb,
+            'results': results,
+        }, f, indent=2)
+    print(f"Saved the results to {output}")
+
+
+if __name__ == '__main__':
+    main()
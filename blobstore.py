@@ -0,0 +1,185 @@
+import hashlib, io, json, os, re, tempfile, time, uuid
+
+
+# How many bytes are read from a stream at a time
+CHUNK_SIZE = 64 * 1024
+
+# Unfinished resumable uploads older than this (in seconds) get cleaned up
+UPLOAD_MAX_AGE = 24 * 60 * 60
+
+
+# Base class for the errors that can happen while uploading, with the HTTP status code that goes with each of them
+class UploadError(Exception):
+    status_code = 400
+
+
+# Raised when an upload goes over the size limit
+class BlobTooLarge(UploadError):
+    status_code = 413
+
+
+# Raised when a resumable upload id doesn't exist (or already finished)
+class UploadNotFound(UploadError):
+    status_code = 404
+
+
+# Raised when a part of a resumable upload starts after the end of what has been uploaded so far
+class UploadOffsetMismatch(UploadError):
+    status_code = 409
+
+    def __init__(self, offset):
+        super().__init__(f"The upload is currently at offset {offset}")
+        self.offset = offset
+
+
+# Stores the contents of uploaded files on disk, named after the SHA-256 hash of their bytes.
+# Since the name only depends on the content, uploading the same file twice (even to different clubs) only stores it once,
+# and the database only has to keep the hash, size, and content type of each file.
+class BlobStore:
+    def __init__(self, root):
+        self.root = root
+        self.upload_root = os.path.join(root, 'uploads')
+
+    # Blobs are spread over two levels of sub folders (e.g. "ab/cd/abcd1234...") so no folder gets too big
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path_for(digest))
+
+    # Save the bytes and return their hash and size
+    def put(self, data):
+        return self.put_stream(io.BytesIO(data))
+
+    # Save everything read from the stream and return its hash and size.
+    # The stream is written to a temporary file while it's being hashed, so it never has to fit in memory,
+    # and it stops as soon as it goes over max_size. Empty streams aren't stored (the hash is None).
+    def put_stream(self, stream, max_size=None):
+        os.makedirs(self.root, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.root)
+        try:
+            sha256 = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    size += len(chunk)
+                    if max_size is not None and size > max_size:
+                        raise BlobTooLarge(f"The file is larger than {max_size} bytes")
+                    sha256.update(chunk)
+                    f.write(chunk)
+
+            if size == 0:
+                os.remove(temp_path)
+                return None, 0
+
+            digest = sha256.hexdigest()
+            self.move_into_place(temp_path, digest)
+            return digest, size
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    # Rename a finished temporary file to its blob path, so that nobody can ever see a half written blob
+    def move_into_place(self, temp_path, digest):
+        path = self.path_for(digest)
+        if os.path.exists(path):
+            # Somebody already uploaded the same contents
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+
+
+    ##### Resumable uploads #####
+    # A resumable upload is a ".part" file that the parts get written into, plus a ".json" file with the information
+    # needed to finish it. Both live on disk, so any worker can continue an upload that another worker started.
+
+    def upload_paths(self, upload_id):
+        # Upload ids are always generated by begin_upload, so anything else (e.g. "../") is rejected
+        if not re.fullmatch(r'[0-9a-f]{32}', upload_id or ''):
+            raise UploadNotFound(f"Upload {upload_id} does not exist")
+        base = os.path.join(self.upload_root, upload_id)
+        return base + '.part', base + '.json'
+
+    # Start a new upload and return its id
+    def begin_upload(self, metadata):
+        os.makedirs(self.upload_root, exist_ok=True)
+        self.prune_uploads()
+
+        upload_id = uuid.uuid4().hex
+        part_path, info_path = self.upload_paths(upload_id)
+        open(part_path, 'wb').close()
+        with open(info_path, 'w') as f:
+            json.dump(metadata, f)
+        return upload_id
+
+    # The information given when the upload was started
+    def upload_info(self, upload_id):
+        part_path, info_path = self.upload_paths(upload_id)
+        try:
+            with open(info_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise UploadNotFound(f"Upload {upload_id} does not exist")
+
+    # How many bytes of the upload have been received so far
+    def upload_offset(self, upload_id):
+        part_path, info_path = self.upload_paths(upload_id)
+        try:
+            return os.path.getsize(part_path)
+        except FileNotFoundError:
+            raise UploadNotFound(f"Upload {upload_id} does not exist")
+
+    # Write a part of the upload starting at the given offset and return the new offset.
+    # A part can start anywhere up to the current end of the upload, so a part that failed halfway can just be sent again.
+    def write_part(self, upload_id, offset, stream, max_size=None):
+        current = self.upload_offset(upload_id)
+        if offset < 0 or offset > current:
+            raise UploadOffsetMismatch(current)
+
+        part_path, info_path = self.upload_paths(upload_id)
+        with open(part_path, 'r+b') as f:
+            f.seek(offset)
+            f.truncate()
+            size = offset
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise BlobTooLarge(f"The file is larger than {max_size} bytes")
+                f.write(chunk)
+        return size
+
+    # Move the finished upload into the blob store and return its information, hash and size
+    def finish_upload(self, upload_id):
+        info = self.upload_info(upload_id)
+        part_path, info_path = self.upload_paths(upload_id)
+
+        sha256 = hashlib.sha256()
+        size = 0
+        with open(part_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                size += len(chunk)
+                sha256.update(chunk)
+
+        digest = sha256.hexdigest()
+        self.move_into_place(part_path, digest)
+        os.remove(info_path)
+        return info, digest, size
+
+    # Throw away an unfinished upload
+    def abort_upload(self, upload_id):
+        for path in self.upload_paths(upload_id):
+            if os.path.exists(path):
+                os.remove(path)
+
+    # Clean up uploads that were started but never finished
+    def prune_uploads(self):
+        cutoff = time.time() - UPLOAD_MAX_AGE
+        for name in os.listdir(self.upload_root):
+            path = os.path.join(self.upload_root, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
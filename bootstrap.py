@@ -1,47 +1,15 @@
-import os, json, requests
-from bs4 import BeautifulSoup
+import os
 from app import db, DB_FILE, DB_FILE_STORAGE, app
 from models import *
+from importer import import_clubs, iter_club_records
+from scraper import scrape
+from recommend import recommendation_index
 
 
 # Scrape all the clubs from the website using BeautifulSoup
+# The pages are downloaded and parsed in parallel (see scraper.py) and written with the same bulk importer as clubs.json
 def scrape_clubs():
-    url = "https://ocwp.pennlabs.org/"
-    response = requests.get(url)
-
-    if response.status_code == 200:
-        with db.session() as session:
-            soup = BeautifulSoup(response.content, 'html.parser')
-            box_divs = soup.find_all('div', class_='box')
-
-            # Loop through all the boxes
-            for box_div in box_divs:
-                name = box_div.find('strong').text
-                tags = box_div.find('span').text
-                description = box_div.find('em').text
-
-                # Since all the scraping data only have 1 tag, I'm just going to split the tags by commas
-                tags = get_all_tags(tags.split(','))
-
-                # Create new club objects
-                club = Club(
-                    name=name,
-                    description=description,
-                    tags=tags
-                )
-                session.add(club)
-
-            session.commit()
-    else:
-        print("Failed to retrieve the page. Status code:", response.status_code)
-
-
-# Retrieves a list of tag objects from db based on a provided list of tag names.
-def get_all_tags(names):
-    tags = Tag.query.filter(Tag.name.in_(names)).all()
-    newTagNames = set(names) - set([tag.name for tag in tags])
-    tags.extend([Tag(name=name) for name in newTagNames])
-    return tags
+    import_clubs(scrape(["https://ocwp.pennlabs.org/"]), db.engine)
 
 
 # Create a dummy user
@@ -59,32 +27,9 @@ def create_user():
 
 
 # Load the data from the json file
+# The file is read a few clubs at a time and written in batches (see importer.py)
 def load_data():
-    # Read the whole clubs.json file
-    with open('clubs.json', 'r') as file:
-        clubs = json.load(file)
-
-    with db.session() as session:
-        for club_info in clubs:
-            # Put in information about Clubs
-            club = Club(
-                code=club_info['code'],
-                name=club_info['name'],
-                description=club_info['description']
-            )
-
-            session.add(club)
-
-            # Put in information about Tags
-            for tag_name in club_info['tags']:
-                tag = Tag.query.filter_by(name=tag_name).first()
-                if not tag:
-                    tag = Tag(name=tag_name)
-
-                club.tags.append(tag)
-
-
-        session.commit()
+    import_clubs(iter_club_records('clubs.json'), db.engine)
 
 
 # def create_client():
@@ -107,6 +52,11 @@ if __name__ == '__main__':
         print("Deleting existing database file.")
         os.remove(DB_FILE_STORAGE)
 
+    # Also delete the write-ahead log files so they don't get replayed into the new database
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(DB_FILE_STORAGE + suffix):
+            os.remove(DB_FILE_STORAGE + suffix)
+
     with app.app_context():
         db.create_all()
         print("Created new database.")
@@ -114,4 +64,6 @@ if __name__ == '__main__':
         create_user()
         scrape_clubs()
         load_data()
+        recommendation_index.build()
+        print("Built the recommendation index.")
         # create_client()  # For OAuth2
\ No newline at end of file
@@ -0,0 +1,287 @@
+import os, threading, time
+from collections import Counter, OrderedDict
+from functools import wraps
+from flask import Response, g, make_response, request
+
+
+# One cached response
+class CacheEntry:
+    __slots__ = ('body', 'status', 'mimetype', 'tags', 'expires', 'size', 'encodings', 'stored')
+
+    def __init__(self, body, status, mimetype, tags, expires):
+        self.body = body
+        self.status = status
+        self.mimetype = mimetype
+        self.tags = tags
+        self.expires = expires
+        self.size = len(body)        # including the compressed bodies
+        self.encodings = {}          # content encoding -> compressed body (see compression.py)
+        self.stored = False          # whether it's in the cache right now
+
+
+# Caches the responses of read endpoints in memory, so identical requests don't have to go to the database again.
+# Every cached response depends on some tags (e.g. "clubs", "club:3" or "tag:Literary"), and the write endpoints
+# invalidate the tags they change, which drops exactly the responses that are now out of date.
+# The cache holds at most max_bytes of responses (dropping the least recently used ones first), and every response
+# also expires after its TTL, which bounds how stale a response can get in the other worker processes
+# (invalidations only reach the cache of the process that made the change).
+# Commands that change lots of data outside of the server (like import-clubs) call bump_version, which rewrites the
+# version file, and every server process clears its whole cache when it sees the file change (it checks at most every
+# RESPONSE_CACHE_VERSION_CHECK_INTERVAL seconds).
+class ResponseCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> CacheEntry, least recently used first
+        self.keys_by_tag = {}         # tag -> keys of the entries that depend on it
+        self.invalidated_at = OrderedDict()  # tag -> generation it was last invalidated at, oldest first
+        self.generation = 0           # goes up by one with every invalidation
+        self.in_flight = Counter()    # generation -> responses being computed that started at it
+        self.cleared_at = 0           # generation the whole cache was last cleared at
+        self.size = 0
+        self.max_bytes = 32 * 1024 * 1024
+        self.default_ttl = 60
+        self.version_file = None
+        self.version = None           # mtime of the version file when it was last checked
+        self.version_check_interval = 1
+        self.version_checked_at = 0
+
+        # Counters for monitoring
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def init_app(self, app):
+        self.max_bytes = app.config.setdefault('RESPONSE_CACHE_MAX_BYTES', self.max_bytes)
+        self.default_ttl = app.config.setdefault('RESPONSE_CACHE_TTL', self.default_ttl)
+        self.version_file = app.config.setdefault('RESPONSE_CACHE_VERSION_FILE',
+                                                  os.path.join(app.instance_path, 'response-cache-version'))
+        self.version_check_interval = app.config.setdefault('RESPONSE_CACHE_VERSION_CHECK_INTERVAL', 1)
+        self.version = self.read_version()
+
+    def read_version(self):
+        try:
+            return os.stat(self.version_file).st_mtime_ns
+        except OSError:
+            return None
+
+    # Makes every server process clear its cache (see check_version)
+    def bump_version(self):
+        os.makedirs(os.path.dirname(self.version_file), exist_ok=True)
+        with open(self.version_file, 'w') as file:
+            file.write(str(time.time_ns()))
+        self.clear()
+
+    # Clears the cache if another process bumped the version since the last check
+    def check_version(self):
+        now = time.monotonic()
+        if self.version_file is None or now - self.version_checked_at < self.version_check_interval:
+            return
+        self.version_checked_at = now
+        version = self.read_version()
+        if version != self.version:
+            self.version = version
+            self.clear()
+
+    # Returns the cached entry for the key, or None if it isn't cached (or expired)
+    def get(self, key):
+        self.check_version()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.expires < time.monotonic():
+                if entry is not None:
+                    self.remove(key)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    # Caches an entry, unless one of its tags got invalidated after the response started being computed
+    # (the response might have read the data from before the change)
+    def set(self, key, entry, generation):
+        if entry.size > self.max_bytes:
+            return
+
+        with self.lock:
+            if self.cleared_at > generation or any(self.invalidated_at.get(tag, -1) > generation for tag in entry.tags):
+                return
+
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = entry
+            entry.stored = True
+            self.size += entry.size
+            for tag in entry.tags:
+                self.keys_by_tag.setdefault(tag, set()).add(key)
+
+            # Make room by dropping the least recently used responses
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    # Must be called with the lock held
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        entry.stored = False
+        self.size -= entry.size
+        for tag in entry.tags:
+            keys = self.keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_tag[tag]
+
+    # Drop every cached response that depends on any of the tags
+    def invalidate(self, *tags):
+        with self.lock:
+            self.generation += 1
+            for tag in tags:
+                self.invalidated_at[tag] = self.generation
+                self.invalidated_at.move_to_end(tag)
+                for key in list(self.keys_by_tag.get(tag, ())):
+                    self.remove(key)
+                    self.invalidations += 1
+            self.prune_invalidations()
+
+    # Forgets the invalidations that can't stop any response from being cached anymore: the ones from before the oldest
+    # response still being computed (every other response started after them). Must be called with the lock held.
+    def prune_invalidations(self):
+        oldest = min(self.in_flight) if self.in_flight else self.generation
+        while self.invalidated_at:
+            tag, generation = next(iter(self.invalidated_at.items()))
+            if generation > oldest:
+                break
+            del self.invalidated_at[tag]
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.cleared_at = self.generation
+            for entry in self.entries.values():
+                entry.stored = False
+            self.entries.clear()
+            self.keys_by_tag.clear()
+            self.invalidated_at.clear()
+            self.size = 0
+
+    # The entry's body compressed with the encoding (by compress(body, encoding)). It's only compressed the first time
+    # and then kept with the entry (counting towards max_bytes), so a cached response isn't compressed on every request.
+    def compressed(self, entry, encoding, compress):
+        body = entry.encodings.get(encoding)
+        if body is not None:
+            return body
+
+        body = compress(entry.body, encoding)
+        with self.lock:
+            if encoding not in entry.encodings:
+                entry.encodings[encoding] = body
+                entry.size += len(body)
+                if entry.stored:
+                    self.size += len(body)
+                    while self.size > self.max_bytes:
+                        self.remove(next(iter(self.entries)))
+                        self.evictions += 1
+        return body
+
+    # The generation to pass to set() for a response that starts being computed now.
+    # Every call has to be followed by finish_response once the response is done (whether it was cached or not).
+    def start_response(self):
+        with self.lock:
+            self.in_flight[self.generation] += 1
+            return self.generation
+
+    def finish_response(self, generation):
+        with self.lock:
+            self.in_flight[generation] -= 1
+            if not self.in_flight[generation]:
+                del self.in_flight[generation]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes
+            }
+
+    # Decorator for a read endpoint that caches its successful responses under the request's path and query string.
+    # The tags can use the route's arguments (e.g. 'tag:{tag_name}'), and the endpoint can add more tags while it runs
+    # with add_cache_tags (e.g. once it knows the club's id). Streamed responses aren't cached.
+    def cached(self, *tags, ttl=None):
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                key = request.full_path
+                entry = self.get(key)
+                if entry is not None:
+                    response = Response(entry.body, status=entry.status, mimetype=entry.mimetype)
+                    response.cache_entry = entry  # so the compressed body can be reused
+                    return response
+
+                generation = self.start_response()
+                try:
+                    g.cache_tags = set(tag.format(**kwargs) for tag in tags)
+
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code == 200 and not response.is_streamed:
+                        expires = time.monotonic() + (ttl if ttl is not None else self.default_ttl)
+                        entry = CacheEntry(response.get_data(), response.status_code, response.mimetype, frozenset(g.cache_tags), expires)
+                        self.set(key, entry, generation)
+                        response.cache_entry = entry
+                    return response
+                finally:
+                    self.finish_response(generation)
+            return wrapper
+        return decorator
+
+
+# A small cache where every value expires after ttl seconds and only the max_entries most recently used values are kept
+class TTLCache:
+    def __init__(self, max_entries, ttl):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (expires, value), least recently used first
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# Adds more tags to the response that is currently being cached
+def add_cache_tags(*tags):
+    if 'cache_tags' in g:
+        g.cache_tags.update(tags)
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,283 @@
+import atexit, json, threading
+from datetime import datetime, timedelta
+from sqlalchemy import delete, event, func, insert, inspect, select, text
+from models import Change, Club, Comment, File, Tag, club_file_association, club_tag_association
+
+
+# The objects whose changes are logged, and the kind they're logged as
+KINDS = {Club: 'club', Comment: 'comment', File: 'file'}
+
+# How many of the oldest changes are deleted per transaction when compacting (so writes don't wait on one huge delete)
+COMPACT_BATCH_SIZE = 10000
+
+# Logs the new like count of every club in a batch of favorites (in the transaction that writes them, see favorites.py)
+RECORD_FAVORITES = text(
+    "INSERT INTO change (kind, action, object_id, data, created_at) "
+    "SELECT 'club', 'favorite', id, json_object('name', name, 'likes', favorite_count), :now FROM club WHERE id = :club_id"
+)
+# The newest sequence number ever given out (the log can be empty after compacting, but the numbers keep going up)
+LATEST_SEQ = text("SELECT coalesce((SELECT seq FROM sqlite_sequence WHERE name = 'change'), 0)")
+# The newest sequence number that was compacted away (a client that has seen less than that missed changes), and the
+# newest one given out
+LOG_BOUNDS = text(
+    "SELECT coalesce((SELECT min(seq) FROM change) - 1, latest), latest "
+    "FROM (SELECT coalesce((SELECT seq FROM sqlite_sequence WHERE name = 'change'), 0) AS latest)"
+)
+
+
+# Raised when a client asks for the changes since a sequence number that was already compacted away (or that was never
+# given out), so it has to download everything again
+class ChangesGone(Exception):
+    pass
+
+
+# The statement for up to `limit` changes after the sequence number `since`, oldest first
+def changes_after(since, limit):
+    return select(*Change.__table__.columns).where(Change.seq > since).order_by(Change.seq).limit(limit)
+
+
+# Raises ChangesGone if a client that has seen up to `since` can't get every change it missed (see LOG_BOUNDS)
+def check_since(since, compacted, latest):
+    if since < compacted or since > latest:
+        raise ChangesGone(f"The changes since {since} are gone, download everything again and continue from {latest}")
+
+
+# The JSON of an object after the change (files don't have a to_json since they're never listed on their own).
+# `lists` has the tag names and file paths of the clubs that didn't have them loaded (see load_club_lists).
+def change_data(obj, lists):
+    if isinstance(obj, File):
+        return {'path': obj.path, 'size': obj.size, 'content_type': obj.content_type, 'sha256': obj.sha256,
+                'uploaded_at': obj.uploaded_at.isoformat() if obj.uploaded_at else None}
+    if isinstance(obj, Club):
+        return obj.to_json(tags=lists['tags'].get(obj.id), files=lists['files'].get(obj.id))
+    return obj.to_json()
+
+
+# Loads the tag names and file paths of the clubs that don't have them loaded yet, with one query each for all the
+# clubs (to_json would otherwise load them one club at a time). Returns {'tags': {club id: names}, 'files': {...}}.
+# A new club that wasn't given any tags or files doesn't have any, so it doesn't need a query.
+def load_club_lists(connection, clubs, new_clubs):
+    lists = {'tags': {}, 'files': {}}
+    statements = {
+        'tags': select(club_tag_association.c.club_id, Tag.name).join(Tag, Tag.id == club_tag_association.c.tag_id),
+        'files': select(club_file_association.c.club_id, File.path).join(File, File.id == club_file_association.c.file_id),
+    }
+    columns = {'tags': club_tag_association.c.club_id, 'files': club_file_association.c.club_id}
+    for name, statement in statements.items():
+        for club in new_clubs:
+            if name in inspect(club).unloaded:
+                lists[name][club.id] = []
+        club_ids = [club.id for club in clubs if name in inspect(club).unloaded]
+        if club_ids:
+            found = lists[name]
+            for club_id in club_ids:
+                found[club_id] = []
+            for club_id, value in connection.execute(statement.where(columns[name].in_(club_ids))):
+                found[club_id].append(value)
+    return lists
+
+
+# What a client needs to find a deleted object (a tombstone)
+def tombstone(obj):
+    if isinstance(obj, Club):
+        return {'name': obj.name}
+    if isinstance(obj, Comment):
+        return {'club_id': obj.club_id, 'parent id': obj.parent_id}
+    return {'path': obj.path}
+
+
+# A log of every write to the clubs, comments and files, so clients can download only what changed instead of the
+# whole catalog. Every flush that creates, changes or deletes one of them adds its changes to the change table in the
+# same transaction, so a change is logged exactly when it's committed. SQLite only lets one transaction write at a
+# time, so the sequence numbers are given out in commit order and a client that has seen up to a number never misses
+# an older change that commits later. Likes are logged with their new count when the buffered likes are written.
+# The log is kept bounded by compacting it every CHANGE_LOG_COMPACT_INTERVAL seconds: only the newest
+# CHANGE_LOG_MAX_ENTRIES changes from the last CHANGE_LOG_RETENTION seconds are kept.
+class ChangeLog:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.version = 0            # goes up whenever this process commits changes (to wake up the streams)
+        self.stopped = threading.Event()
+        self.app = None
+        self.db = None
+        self.max_entries = 100000
+        self.retention = timedelta(days=7)
+        self.recorded = 0
+        self.compacted = 0
+        self.streams = 0
+        self.interval = 0
+        self.thread = None
+        self.table_created = False
+        self.notify_listeners = []
+        self.warned = False
+
+    def init_app(self, app, db):
+        self.app = app
+        self.db = db
+        self.max_entries = app.config.setdefault('CHANGE_LOG_MAX_ENTRIES', self.max_entries)
+        self.retention = timedelta(seconds=app.config.setdefault('CHANGE_LOG_RETENTION', 7 * 24 * 3600))
+        self.interval = app.config.setdefault('CHANGE_LOG_COMPACT_INTERVAL', 600)
+        atexit.register(self.stopped.set)
+
+        event.listen(db.session, 'after_flush', self.collect_changes)
+        event.listen(db.session, 'after_commit', self.notify_committed)
+        event.listen(db.session, 'after_soft_rollback', self.discard_changes)
+
+    # Starts the periodic compactions (called on every request, see start_background_threads in app.py)
+    def start(self):
+        if self.thread is None and self.interval:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, args=(self.interval,), daemon=True)
+                    self.thread.start()
+
+    # Whether the change table exists. A database made before the log existed doesn't have it until
+    # 'flask --app app create-change-log' is run, and until then the writes just aren't logged (instead of failing).
+    # Once the table is there it's never checked again.
+    def has_table(self, connection):
+        if not self.table_created:
+            self.table_created = inspect(connection).has_table(Change.__tablename__)
+            if not self.table_created and not self.warned:
+                self.warned = True
+                self.app.logger.warning("The change table is missing, so nothing is logged. "
+                                        "Run 'flask --app app create-change-log' to create it.")
+        return self.table_created
+
+    # Logs what the flush created, changed and deleted (the session state is only readable here)
+    def collect_changes(self, session, flush_context):
+        created = [obj for obj in session.new if type(obj) in KINDS]
+        updated = [obj for obj in session.dirty if type(obj) in KINDS and session.is_modified(obj)]
+        deleted = [obj for obj in session.deleted if type(obj) in KINDS]
+        if not (created or updated or deleted) or not self.has_table(session.connection()):
+            return
+
+        now = datetime.utcnow()
+        lists = load_club_lists(session.connection(), [obj for obj in updated if isinstance(obj, Club)],
+                                [obj for obj in created if isinstance(obj, Club)])
+        rows = [self.row(obj, 'create', change_data(obj, lists), now) for obj in created]
+        rows += [self.row(obj, 'update', change_data(obj, lists), now) for obj in updated]
+        rows += [self.row(obj, 'delete', tombstone(obj), now) for obj in deleted]
+
+        if rows:
+            session.connection().execute(insert(Change), rows)
+            session.info['change_log_changes'] = session.info.get('change_log_changes', 0) + len(rows)
+
+    def row(self, obj, action, data, now):
+        return {'kind': KINDS[type(obj)], 'action': action, 'object_id': obj.id, 'data': json.dumps(data), 'created_at': now}
+
+    def notify_committed(self, session):
+        changes = session.info.pop('change_log_changes', 0)
+        if changes:
+            with self.lock:
+                self.recorded += changes
+            self.notify()
+
+    def discard_changes(self, session, previous_transaction):
+        session.info.pop('change_log_changes', None)
+
+    # Logs the favorites written outside of the ORM (by the favorite buffer and the bulk endpoint), in the transaction of
+    # the connection. The streams are woken up once it commits (see the commit listener in app.py and bulk_clubs).
+    def record_favorites(self, connection, club_ids):
+        if club_ids and self.has_table(connection):
+            now = datetime.utcnow()
+            connection.execute(RECORD_FAVORITES, [{'club_id': club_id, 'now': now} for club_id in club_ids])
+            with self.lock:
+                self.recorded += len(club_ids)
+
+    def notify(self):
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+        for function in self.notify_listeners:
+            function()
+
+    # Runs the function (on the committing thread) whenever this process commits changes, e.g. to wake up the streams
+    # of the ASGI app, which don't wait on the condition
+    def add_notify_listener(self, function):
+        self.notify_listeners.append(function)
+
+    def remove_notify_listener(self, function):
+        self.notify_listeners.remove(function)
+
+    # Waits until this process commits new changes (returns right away if it did since `version`) or the timeout passes
+    def wait(self, version, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    # Every read gets its own connection (and so its own snapshot), so a stream that keeps polling sees new commits
+    def connect(self):
+        return self.db.engines.get('read', self.db.engine).connect()
+
+    def latest(self):
+        with self.connect() as connection:
+            return connection.execute(LATEST_SEQ).scalar()
+
+    # Up to `limit` changes after the sequence number `since`, oldest first
+    def read(self, since, limit):
+        with self.connect() as connection:
+            check_since(since, *connection.execute(LOG_BOUNDS).one())
+            rows = connection.execute(changes_after(since, limit)).all()
+        return [self.to_json(change) for change in rows]
+
+    def to_json(self, change):
+        return {'seq': change.seq,
+                'kind': change.kind,
+                'action': change.action,
+                'id': change.object_id,
+                'data': json.loads(change.data) if change.data else None,
+                'time': change.created_at.isoformat()}
+
+    # Deletes the changes that are older than the retention or beyond the newest max_entries, oldest first.
+    # Returns how many were deleted.
+    def compact(self):
+        cutoff = datetime.utcnow() - self.retention
+        with self.app.app_context():
+            with self.db.engine.connect() as connection:
+                if not self.has_table(connection):
+                    return 0
+                latest = connection.execute(LATEST_SEQ).scalar()
+                expired = connection.execute(select(func.max(Change.seq)).where(Change.created_at < cutoff)).scalar() or 0
+            upto = max(latest - self.max_entries, expired)
+
+            removed = 0
+            while True:
+                with self.db.engine.begin() as connection:
+                    oldest = connection.execute(select(func.min(Change.seq))).scalar()
+                    if oldest is None or oldest > upto:
+                        break
+                    removed += connection.execute(
+                        delete(Change).where(Change.seq <= min(upto, oldest + COMPACT_BATCH_SIZE - 1))
+                    ).rowcount
+
+        with self.lock:
+            self.compacted += removed
+        return removed
+
+    # Compact periodically until the server stops
+    def run(self, interval):
+        while not self.stopped.wait(interval):
+            try:
+                self.compact()
+            except Exception:
+                self.app.logger.exception("Failed to compact the change log")
+
+    # Counts a new stream, unless `limit` streams are open already (then it returns False)
+    def stream_started(self, limit=None):
+        with self.lock:
+            if limit is not None and self.streams >= limit:
+                return False
+            self.streams += 1
+            return True
+
+    def stream_ended(self):
+        with self.lock:
+            self.streams -= 1
+
+    def stats(self):
+        with self.lock:
+            return {'recorded': self.recorded, 'compacted': self.compacted, 'streams': self.streams}
+
+
+change_log = ChangeLog()
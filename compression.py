@@ -0,0 +1,135 @@
+import gzip, zlib
+from flask import request
+from werkzeug.http import parse_accept_header
+from werkzeug.wsgi import ClosingIterator
+from cache import response_cache
+
+# Brotli and Zstandard are optional (without them, responses are only ever gzipped)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# The content types worth compressing (images and other files are compressed already)
+COMPRESSIBLE_TYPES = {'application/json', 'application/x-ndjson', 'text/csv', 'text/plain', 'text/html', 'text/event-stream'}
+
+# How hard each encoding compresses. These favor speed, since the uncached responses are compressed on every request.
+LEVELS = {'br': 5, 'zstd': 3, 'gzip': 6}
+# Cached responses are only compressed once, so they're worth compressing harder
+CACHED_LEVELS = {'br': 9, 'zstd': 12, 'gzip': 9}
+
+
+# Compresses one response body a chunk at a time, so streamed responses can be compressed while they're being sent.
+# Every chunk is flushed right away, so the client gets each batch as soon as it's ready.
+class StreamEncoder:
+    def __init__(self, encoding, level=None):
+        level = LEVELS[encoding] if level is None else level
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # 16 + means a gzip header
+        elif encoding == 'br':
+            self.compressor = brotli.Compressor(quality=level)
+        else:
+            self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, chunk):
+        if self.encoding == 'gzip':
+            return self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self.encoding == 'br':
+            return self.compressor.process(chunk) + self.compressor.flush()
+        return self.compressor.compress(chunk) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        if self.encoding == 'gzip':
+            return self.compressor.flush()
+        if self.encoding == 'br':
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+
+# The encodings this server can use, best first (Brotli and Zstandard make smaller JSON than gzip)
+def available_encodings():
+    return [encoding for encoding, module in (('br', brotli), ('zstd', zstandard), ('gzip', zlib)) if module is not None]
+
+
+# The best encoding the client accepts (from its Accept-Encoding header), or None to send the response as it is
+def negotiate(accept_encoding):
+    if not accept_encoding:
+        return None
+    return parse_accept_header(accept_encoding).best_match(available_encodings())
+
+
+def compress(body, encoding, level=None):
+    level = LEVELS[encoding] if level is None else level
+    if encoding == 'gzip':
+        return gzip.compress(body, level)
+    if encoding == 'br':
+        return brotli.compress(body, quality=level)
+    return zstandard.ZstdCompressor(level=level).compress(body)
+
+
+def compress_for_cache(body, encoding):
+    return compress(body, encoding, CACHED_LEVELS[encoding])
+
+
+def compress_chunks(chunks, encoding):
+    encoder = StreamEncoder(encoding)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = encoder.compress(chunk)
+        if data:
+            yield data
+    yield encoder.finish()
+
+
+def is_compressible(mimetype):
+    return mimetype in COMPRESSIBLE_TYPES
+
+
+# Compresses the responses of the app with the best encoding the client accepts (Brotli, Zstandard or gzip).
+# Responses smaller than COMPRESSION_MIN_SIZE aren't worth it and are sent as they are, and streamed responses
+# (like the full club list) are compressed while they're streamed. Cached responses (see cache.py) are only compressed
+# once per encoding: the compressed bytes are kept with the cached response until a write invalidates it.
+class Compression:
+    def __init__(self):
+        self.min_size = 1024
+
+    # Call this after the other after_request hooks are registered, so it runs before them (Flask runs them in reverse)
+    # and e.g. the metrics count the compressed bytes
+    def init_app(self, app):
+        self.min_size = app.config.setdefault('COMPRESSION_MIN_SIZE', self.min_size)
+        app.after_request(self.compress_response)
+
+    def compress_response(self, response):
+        if (response.status_code != 200 or response.direct_passthrough or 'Content-Encoding' in response.headers
+                or not is_compressible(response.mimetype)):
+            return response
+
+        # Caches in between have to keep the compressed and the uncompressed responses apart
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate(request.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            # (closing the compressed body closes the body it wraps, e.g. so a streamed response's request context ends)
+            response.response = ClosingIterator(compress_chunks(response.response, encoding), getattr(response.response, 'close', None))
+            response.headers.pop('Content-Length', None)
+        else:
+            body = response.get_data()
+            if len(body) < self.min_size:
+                return response
+            entry = getattr(response, 'cache_entry', None)
+            response.set_data(response_cache.compressed(entry, encoding, compress_for_cache) if entry else compress(body, encoding))
+
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+
+compression = Compression()
@@ -0,0 +1,99 @@
+import os
+from functools import wraps
+from flask import g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+
+# The database settings for each profile. The profile is picked with the CLUBREVIEW_DB_PROFILE environment variable.
+# - production: WAL mode so readers never wait on the writer (and the writer doesn't wait on readers), faster syncing,
+#   waiting on the lock instead of failing with "database is locked", a bigger page cache and memory mapped reads,
+#   bounded connection pools, and a separate pool of read only connections for the read endpoints.
+# - simple: SQLite's default settings and a single engine (e.g. for debugging)
+PROFILES = {
+    'production': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': 5000,          # milliseconds
+            'cache_size': -64 * 1024,      # negative means KiB, so 64 MiB
+            'mmap_size': 256 * 1024 * 1024,
+            'temp_store': 'MEMORY',
+        },
+        'engine_options': {'pool_size': 4, 'max_overflow': 4, 'pool_timeout': 10},
+        'read_engine_options': {'pool_size': 8, 'max_overflow': 8, 'pool_timeout': 10},
+    },
+    'simple': {
+        'pragmas': {},
+        'engine_options': {},
+        'read_engine_options': None,
+    },
+}
+
+
+# Builds the Flask config for the database from the profile (and lets CLUBREVIEW_DATABASE_URI point at another database)
+def load_database_config(default_uri):
+    profile_name = os.environ.get('CLUBREVIEW_DB_PROFILE', 'production')
+    if profile_name not in PROFILES:
+        raise ValueError(f"Unknown database profile '{profile_name}', expected one of {', '.join(PROFILES)}")
+    profile = PROFILES[profile_name]
+
+    uri = os.environ.get('CLUBREVIEW_DATABASE_URI', default_uri)
+    config = {
+        'DB_PROFILE': profile_name,
+        'SQLALCHEMY_DATABASE_URI': uri,
+        'SQLALCHEMY_ENGINE_OPTIONS': dict(profile['engine_options']),
+        'SQLITE_PRAGMAS': dict(profile['pragmas']),
+        'SQLALCHEMY_BINDS': {},
+    }
+
+    # A second engine on the same database file for the read endpoints (an in-memory database can't be shared)
+    if profile['read_engine_options'] is not None and ':memory:' not in uri and uri != 'sqlite://':
+        config['SQLALCHEMY_BINDS']['read'] = dict(profile['read_engine_options'], url=uri)
+
+    return config
+
+
+# Runs the profile's pragmas on every new connection of the engines (the read engine's connections are also made read only)
+def install_sqlite_pragmas(db, app):
+    pragmas = app.config['SQLITE_PRAGMAS']
+
+    with app.app_context():
+        for name, engine in db.engines.items():
+            if engine.dialect.name != 'sqlite':
+                continue
+
+            engine_pragmas = dict(pragmas)
+            if name == 'read':
+                engine_pragmas['query_only'] = 1
+
+            event.listen(engine, 'connect', make_pragma_listener(engine_pragmas))
+
+
+def make_pragma_listener(pragmas):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+    return set_pragmas
+
+
+# A session that sends the queries of read only requests (see read_only) to the read engine,
+# so they never wait on the write lock held by another request's commit
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context() and g.get('read_only'):
+            engine = self._db.engines.get('read')
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+# Decorator for endpoints that only read from the database
+def read_only(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_only = True
+        return view(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,110 @@
+import atexit, threading
+from collections import Counter
+from sqlalchemy import text
+
+
+# Adds the buffered favorites onto the stored counts. Doing the addition inside the database makes it atomic,
+# so favorites can't get lost when several workers flush at the same time.
+FLUSH_STATEMENT = text("UPDATE club SET favorite_count = favorite_count + :count WHERE id = :club_id")
+
+
+# Buffers club favorites in memory and writes them to the database in batches.
+# Favoriting a club used to be one write transaction per like, which during busy times (e.g. the club fair) made every
+# request wait on the SQLite write lock. Now a like only increments a counter here, and all the likes collected
+# since the last flush are written with one batched UPDATE every few seconds (and when the server shuts down).
+class FavoriteBuffer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()  # only one flush can run at a time
+        self.pending = Counter()   # likes that haven't been written yet
+        self.flushing = Counter()  # likes that are currently being written
+        self.stopped = threading.Event()
+        self.app = None
+        self.db = None
+        self.flush_listeners = []
+        self.commit_listeners = []
+        self.interval = 0
+        self.thread = None
+
+    def init_app(self, app, db):
+        self.app = app
+        self.db = db
+        self.interval = app.config.setdefault('FAVORITE_FLUSH_INTERVAL', 2)
+        atexit.register(self.stop)
+
+    # Starts the periodic flushes (called on every request, see start_background_threads in app.py)
+    def start(self):
+        if self.thread is None and self.interval:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, args=(self.interval,), daemon=True)
+                    self.thread.start()
+
+    # Calls function(connection, club_ids) in the transaction that writes the likes (e.g. to log the new counts)
+    def add_flush_listener(self, function):
+        self.flush_listeners.append(function)
+
+    # Calls function(club_ids) once the likes are committed (e.g. to drop the cached responses that show the old counts)
+    def add_commit_listener(self, function):
+        self.commit_listeners.append(function)
+
+    # Record likes for a club
+    def add(self, club_id, count=1):
+        with self.lock:
+            self.pending[club_id] += count
+
+    # The number of likes for a club that aren't in the database yet (so reads can add them to the stored count)
+    def get(self, club_id):
+        with self.lock:
+            return self.pending[club_id] + self.flushing[club_id]
+
+    # Forget the buffered likes of a club (e.g. when it gets deleted)
+    def discard(self, club_id):
+        with self.lock:
+            self.pending.pop(club_id, None)
+
+    # Write all the buffered likes to the database in one transaction
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+                self.flushing, self.pending = self.pending, Counter()
+                batch = [{'club_id': club_id, 'count': count} for club_id, count in self.flushing.items()]
+
+            try:
+                with self.app.app_context(), self.db.engine.connect() as connection:
+                    connection.execute(FLUSH_STATEMENT, batch)
+                    for function in self.flush_listeners:
+                        function(connection, [item['club_id'] for item in batch])
+                    # The likes leave the buffer in the same step they show up in the stored counts, so get() never
+                    # counts them twice
+                    with self.lock:
+                        connection.commit()
+                        club_ids = list(self.flushing)
+                        self.flushing = Counter()
+            except Exception:
+                # Put the likes back so that the next flush tries again
+                with self.lock:
+                    self.pending.update(self.flushing)
+                    self.flushing = Counter()
+                raise
+
+            for function in self.commit_listeners:
+                function(club_ids)
+
+    # Flush periodically until the server stops
+    def run(self, interval):
+        while not self.stopped.wait(interval):
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception("Failed to flush favorites")
+
+    # Stop the periodic flushes and write whatever is left
+    def stop(self):
+        self.stopped.set()
+        self.flush()
+
+
+favorite_buffer = FavoriteBuffer()
@@ -0,0 +1,77 @@
+import atexit, multiprocessing, os, threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+# Raised when too many passwords are already waiting to be hashed
+class HashingBusy(Exception):
+    pass
+
+
+# Hashes and checks passwords in a pool of worker processes.
+# Password hashing is slow on purpose, so doing it on the request thread meant a burst of logins stalled every other
+# request in the worker. The number of passwords waiting for the pool is limited (PASSWORD_HASH_MAX_QUEUE), and once it
+# is full, new logins are turned away right away instead of piling up. With PASSWORD_HASH_WORKERS set to 0, the
+# hashing happens on the request thread like before (e.g. for debugging).
+class PasswordHasher:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.workers = 0
+        self.slots = None
+        self.timeout = None
+
+    def init_app(self, app):
+        self.workers = app.config.setdefault('PASSWORD_HASH_WORKERS', min(4, os.cpu_count() or 1))
+        max_queue = app.config.setdefault('PASSWORD_HASH_MAX_QUEUE', 16 * max(self.workers, 1))
+        self.timeout = app.config.setdefault('PASSWORD_HASH_TIMEOUT', 10)
+        self.slots = threading.BoundedSemaphore(max_queue)
+        atexit.register(self.shutdown)
+
+    # The pool is only started when it is first needed, so that it gets started after the server forks its workers.
+    # The server process already runs other threads by then (e.g. the favorite flushes), so the workers are started by a
+    # forkserver instead of forking it, which could copy a lock one of those threads was holding.
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                context = multiprocessing.get_context('forkserver')
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self.executor
+
+    def run(self, function, *args, **kwargs):
+        if not self.slots.acquire(blocking=False):
+            raise HashingBusy("Too many login attempts are being processed. Try again later.")
+        if self.workers == 0:
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.slots.release()
+
+        # The slot is only given back once the pool is done with the password, so a login that timed out still counts
+        # towards the queue while its hash runs
+        try:
+            future = self.get_executor().submit(function, *args, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()  # (only works if the pool hasn't started it yet)
+            raise HashingBusy("Logging in took too long. Try again later.")
+
+    def hash(self, password, **kwargs):
+        return self.run(generate_password_hash, password, **kwargs)
+
+    def verify(self, password_hash, password):
+        return self.run(check_password_hash, password_hash, password)
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+                self.executor = None
+
+
+password_hasher = PasswordHasher()
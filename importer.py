@@ -0,0 +1,134 @@
+import json, time
+from itertools import islice
+from sqlalchemy import insert, select
+from models import Club, Tag, club_tag_association
+
+
+# How many characters are read from the file at a time
+READ_SIZE = 64 * 1024
+
+
+# Reads the clubs from a file one at a time, so the whole file never has to be in memory.
+# The file can either be a JSON array of clubs (like clubs.json) or have one JSON club per line (NDJSON).
+def iter_club_records(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        # Look at the first character to tell the two formats apart
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        f.seek(0)
+
+        if first == '[':
+            yield from iter_json_array(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+# Parses the elements of a JSON array one at a time, reading more of the file whenever the buffer runs out
+def iter_json_array(f):
+    decoder = json.JSONDecoder()
+    buffer = f.read(READ_SIZE)
+    position = buffer.index('[') + 1
+    at_end = False
+
+    while True:
+        # Skip the whitespace and commas between elements
+        while position < len(buffer) and (buffer[position].isspace() or buffer[position] == ','):
+            position += 1
+
+        if position < len(buffer) and buffer[position] == ']':
+            return
+
+        try:
+            if position >= len(buffer):
+                raise json.JSONDecodeError("Need more data", buffer, position)
+            record, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if at_end:
+                raise
+            # The element is cut off, so drop what was already parsed and read more of the file
+            more = f.read(READ_SIZE)
+            at_end = not more
+            buffer = buffer[position:] + more
+            position = 0
+            continue
+
+        yield record
+
+
+# Splits the records into lists of chunk_size records
+def iter_chunks(records, chunk_size):
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# Prints how the import is going
+def print_progress(imported, skipped, elapsed):
+    rate = imported / elapsed if elapsed else 0
+    print(f"Imported {imported} clubs ({skipped} skipped) in {elapsed:.1f}s, {rate:.0f} clubs/sec")
+
+
+# Writes the club records to the database in chunks, with one transaction per chunk.
+# Instead of adding ORM objects one at a time and looking up every tag separately, all the tags are kept in a
+# name -> id map, and the clubs, new tags and club/tag associations of a chunk are each written with one batched insert.
+# Clubs whose name already exists (in the database or earlier in the file) are skipped.
+# Returns the number of clubs imported and skipped.
+def import_clubs(records, engine, chunk_size=1000, progress=print_progress):
+    started = time.monotonic()
+    imported = 0
+    skipped = 0
+
+    with engine.connect() as connection:
+        tag_ids = dict(connection.execute(select(Tag.name, Tag.id)).all())
+
+    for chunk in iter_chunks(records, chunk_size):
+        with engine.begin() as connection:
+            names = [record['name'] for record in chunk]
+            seen = set(connection.execute(select(Club.name).where(Club.name.in_(names))).scalars())
+
+            clubs = []
+            for record in chunk:
+                if record['name'] in seen:
+                    skipped += 1
+                    continue
+                seen.add(record['name'])
+                clubs.append(record)
+
+            if not clubs:
+                continue
+
+            # Add the tags that don't exist yet, and look up their ids
+            new_tags = set(name for club in clubs for name in club.get('tags', [])) - tag_ids.keys()
+            if new_tags:
+                connection.execute(insert(Tag).prefix_with('OR IGNORE'), [{'name': name} for name in new_tags])
+                tag_ids.update(connection.execute(select(Tag.name, Tag.id).where(Tag.name.in_(new_tags))).all())
+
+            connection.execute(insert(Club), [{
+                'code': club.get('code', ""),
+                'name': club['name'],
+                'description': club.get('description', "")
+            } for club in clubs])
+
+            club_ids = dict(connection.execute(
+                select(Club.name, Club.id).where(Club.name.in_([club['name'] for club in clubs]))
+            ).all())
+
+            associations = [
+                {'club_id': club_ids[club['name']], 'tag_id': tag_ids[tag_name]}
+                for club in clubs
+                for tag_name in set(club.get('tags', []))
+            ]
+            if associations:
+                connection.execute(insert(club_tag_association), associations)
+
+        imported += len(clubs)
+        if progress:
+            progress(imported, skipped, time.monotonic() - started)
+
+    return imported, skipped
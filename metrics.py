@@ -0,0 +1,204 @@
+import threading, time
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from werkzeug.wsgi import ClosingIterator
+
+
+# Upper bounds of the histogram buckets
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+# How many statements a request keeps for the slow request log
+MAX_LOGGED_STATEMENTS = 50
+
+
+# Counts how many observed values fall in each bucket (like a Prometheus histogram)
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    # The lines of the histogram in the Prometheus text format (the bucket counts are cumulative)
+    def render(self, name, labels):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {total}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+# What one request did so far (kept in g while the request runs)
+class RequestMetrics:
+    __slots__ = ('started', 'statements', 'sql_duration', 'logged_statements')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.sql_duration = 0.0
+        self.logged_statements = []
+
+
+# Records how long every route takes, how many SQL statements it runs and how long they take (from the engine events),
+# how big its responses are and how often it fails, and shows all of it on /metrics in the Prometheus text format.
+# With SLOW_REQUEST_MS set, requests that take longer than that are logged with the SQL statements they ran.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}       # (route, method, status) -> count
+        self.errors = {}         # (route, method) -> count of 5xx responses
+        self.durations = {}      # (route, method) -> Histogram of seconds
+        self.statements = {}     # (route, method) -> Histogram of statements per request
+        self.sql_durations = {}  # (route, method) -> Histogram of seconds spent in SQL per request
+        self.sizes = {}          # (route, method) -> Histogram of response bytes
+        self.stats = []          # (prefix, function returning a dict of numbers) shown as gauges
+        self.slow_request_ms = None
+        self.logger = None
+
+    def init_app(self, app, db):
+        self.slow_request_ms = app.config.setdefault('SLOW_REQUEST_MS', None)
+        self.logger = app.logger
+
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+        with app.app_context():
+            for engine in db.engines.values():
+                event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+                event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    # Adds the numbers returned by the function (e.g. the response cache's stats) to /metrics
+    def register_stats(self, prefix, function):
+        self.stats.append((prefix, function))
+
+    def start_request(self):
+        g.request_metrics = RequestMetrics()
+
+    def before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        if has_app_context() and g.get('request_metrics') is not None:
+            context._metrics_started = time.perf_counter()
+
+    def after_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        current = g.get('request_metrics') if has_app_context() else None
+        if current is None or not hasattr(context, '_metrics_started'):
+            return
+
+        duration = time.perf_counter() - context._metrics_started
+        current.statements += 1
+        current.sql_duration += duration
+        if self.slow_request_ms is not None and len(current.logged_statements) < MAX_LOGGED_STATEMENTS:
+            current.logged_statements.append((duration, statement))
+
+    # The numbers are recorded once the response is sent, so streamed responses are measured until their last byte
+    def finish_request(self, response):
+        current = g.get('request_metrics')
+        if current is None:
+            return response
+
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        method = request.method
+        status = response.status_code
+
+        # Files (send_file) are passed to the server as they are, so it can still send them with sendfile. Werkzeug
+        # doesn't call the close callbacks of those, so they're recorded now, without the time to send the file.
+        if response.direct_passthrough:
+            self.record(route, method, status, response.content_length or 0, current)
+            return response
+
+        if response.is_streamed:
+            size = [0]
+            # (closing the counter closes the body it wraps, e.g. so a streamed response's request context ends)
+            response.response = ClosingIterator(self.count_bytes(response.response, size), getattr(response.response, 'close', None))
+        else:
+            size = [response.content_length or 0]
+
+        response.call_on_close(lambda: self.record(route, method, status, size[0], current))
+        return response
+
+    def count_bytes(self, chunks, size):
+        for chunk in chunks:
+            size[0] += len(chunk)
+            yield chunk
+
+    def record(self, route, method, status, size, current):
+        duration = time.perf_counter() - current.started
+        key = (route, method)
+
+        with self.lock:
+            self.requests[(route, method, status)] = self.requests.get((route, method, status), 0) + 1
+            if status >= 500:
+                self.errors[key] = self.errors.get(key, 0) + 1
+            self.histogram(self.durations, key, DURATION_BUCKETS).observe(duration)
+            self.histogram(self.statements, key, STATEMENT_BUCKETS).observe(current.statements)
+            self.histogram(self.sql_durations, key, DURATION_BUCKETS).observe(current.sql_duration)
+            self.histogram(self.sizes, key, SIZE_BUCKETS).observe(size)
+
+        if self.slow_request_ms is not None and duration * 1000 >= self.slow_request_ms:
+            message = (f"Slow request: {method} {route} {status} took {duration * 1000:.1f} ms "
+                       f"({current.statements} SQL statements, {current.sql_duration * 1000:.1f} ms)")
+            for statement_duration, statement in current.logged_statements:
+                message += f"\n  {statement_duration * 1000:.2f} ms: {statement}"
+            self.logger.warning(message)
+
+    def histogram(self, histograms, key, buckets):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(buckets)
+        return histogram
+
+    # Everything in the Prometheus text format
+    def render(self):
+        lines = []
+        with self.lock:
+            lines.append('# HELP clubreview_requests_total Requests by route, method and status.')
+            lines.append('# TYPE clubreview_requests_total counter')
+            for (route, method, status), count in sorted(self.requests.items()):
+                lines.append(f'clubreview_requests_total{{{labels(route, method)},status="{status}"}} {count}')
+
+            lines.append('# HELP clubreview_request_errors_total Requests that failed with a 5xx status.')
+            lines.append('# TYPE clubreview_request_errors_total counter')
+            for (route, method), count in sorted(self.errors.items()):
+                lines.append(f'clubreview_request_errors_total{{{labels(route, method)}}} {count}')
+
+            for name, description, histograms in (
+                ('clubreview_request_duration_seconds', 'Time to handle a request.', self.durations),
+                ('clubreview_request_sql_statements', 'SQL statements run by a request.', self.statements),
+                ('clubreview_request_sql_duration_seconds', 'Time a request spent running SQL statements.', self.sql_durations),
+                ('clubreview_response_size_bytes', 'Size of the response body.', self.sizes),
+            ):
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} histogram')
+                for (route, method), histogram in sorted(histograms.items()):
+                    lines.extend(histogram.render(name, labels(route, method)))
+
+        for prefix, function in self.stats:
+            for name, value in function().items():
+                if isinstance(value, (int, float)):
+                    lines.append(f'# TYPE {prefix}_{name} gauge')
+                    lines.append(f'{prefix}_{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def labels(route, method):
+    route = route.replace('\\', '\\\\').replace('"', '\\"')
+    return f'route="{route}",method="{method}"'
+
+
+metrics = Metrics()
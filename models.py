@@ -1,23 +1,28 @@
 from app import db
 from flask_login import UserMixin
+from sqlalchemy import event, DDL
+from favorites import favorite_buffer
 from datetime import datetime, timedelta
 
 
 # Establish many-to-many relationships between different tables based on their primary keys
+# Each pair is the primary key (so it can only be stored once, and looking up the second column by the first one is an
+# index search), and the second column has its own index for the lookups the other way around
 club_tag_association = db.Table(
     'club_tag_association',
-    db.Column('club_id', db.Integer, db.ForeignKey('club.id')),
-    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'))
+    db.Column('club_id', db.Integer, db.ForeignKey('club.id'), primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True, index=True)
 )
 user_club_association = db.Table(
     'user_club_association',
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('club_id', db.Integer, db.ForeignKey('club.id'))
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('club_id', db.Integer, db.ForeignKey('club.id'), primary_key=True, index=True),
+    db.Column('joined_at', db.DateTime, default=datetime.utcnow, index=True) # for exporting the memberships since a time
 )
 club_file_association = db.Table(
     'club_file_association',
-    db.Column('club_id', db.Integer, db.ForeignKey('club.id')),
-    db.Column('file_id', db.Integer, db.ForeignKey('file.id'))
+    db.Column('club_id', db.Integer, db.ForeignKey('club.id'), primary_key=True),
+    db.Column('file_id', db.Integer, db.ForeignKey('file.id'), primary_key=True, index=True)
 )
 
 
@@ -27,6 +32,10 @@ class Tag(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), unique=True, nullable=False)
 
+    # The number of clubs with this tag, kept up to date by the triggers on club_tag_association below
+    # so that counting the clubs for every tag doesn't need a join and group by over the whole association table
+    club_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     def __repr__(self):
         return '<Tag %r>' % self.name
 
@@ -34,11 +43,30 @@ class Tag(db.Model):
         return {'name': self.name}
 
 
+# Every time a club gains or loses a tag (creating, retagging or deleting a club, bootstrapping), the tag's club_count
+# is updated in the same transaction
+TAG_COUNT_DDL = [
+    "CREATE TRIGGER IF NOT EXISTS tag_count_insert AFTER INSERT ON club_tag_association BEGIN "
+    "UPDATE tag SET club_count = club_count + 1 WHERE id = new.tag_id; END",
+    "CREATE TRIGGER IF NOT EXISTS tag_count_delete AFTER DELETE ON club_tag_association BEGIN "
+    "UPDATE tag SET club_count = club_count - 1 WHERE id = old.tag_id; END",
+    "CREATE TRIGGER IF NOT EXISTS tag_count_update AFTER UPDATE OF tag_id ON club_tag_association BEGIN "
+    "UPDATE tag SET club_count = club_count - 1 WHERE id = old.tag_id; "
+    "UPDATE tag SET club_count = club_count + 1 WHERE id = new.tag_id; END",
+]
+for statement in TAG_COUNT_DDL:
+    event.listen(club_tag_association, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+
+
 # For uploading files
+# The contents themselves are stored on disk in the blob store (see blobstore.py) under their SHA-256 hash,
+# so the database only keeps the metadata and identical files are only stored once
 class File(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     path = db.Column(db.String(120), unique=True, nullable=False)
-    content = db.Column(db.LargeBinary, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    size = db.Column(db.Integer, nullable=False)
+    uploaded_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow) # when the current contents were uploaded
     content_type = db.Column(db.String(80), nullable=False, default="application/octet-stream") # sets the default as an arbitrary binary data
 
     def __repr__(self):
@@ -47,12 +75,21 @@ class File(db.Model):
 
 # Main class that stores all the information about clubs
 class Club(db.Model):
+    # AUTOINCREMENT so a deleted club's id is never given to a new club (likes still buffered for the old club in
+    # another worker, see favorites.py, would otherwise be added to the new one)
+    __table_args__ = {'sqlite_autoincrement': True}
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     code = db.Column(db.String(80), primary_key=False, unique=False)
     name = db.Column(db.String(80), unique=True, nullable=False) # A club needs to have a unique name
     description = db.Column(db.String(120), unique=False)
     favorite_count = db.Column(db.Integer, unique=False, nullable=False, default=0)
 
+    # When the club was added and last changed, so the exports can send only what changed since the last one.
+    # The likes don't count as a change (they're counters, and are written in batches by favorites.py).
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
     # Many to many relationship
     tags = db.relationship('Tag', secondary=club_tag_association, backref=db.backref('club', lazy=True))
     files = db.relationship('File', secondary=club_file_association, backref=db.backref('club', lazy='dynamic'))
@@ -61,13 +98,81 @@ class Club(db.Model):
     def __repr__(self):
         return '<Club %r>' % self.name
 
-    def to_json(self):
+    # The tag names and file paths can be passed in when they were loaded for many clubs at once (see changelog.py)
+    def to_json(self, tags=None, files=None):
         return {'code': self.code,
                 'name': self.name,
                 'description': self.description,
-                'likes': self.favorite_count,
-                'tags': [tag.name for tag in self.tags],
-                'files': [file.path for file in self.files]}
+                'likes': self.favorite_count + favorite_buffer.get(self.id), # includes the likes that haven't been written yet
+                'tags': tags if tags is not None else [tag.name for tag in self.tags],
+                'files': files if files is not None else [file.path for file in self.files]}
+
+
+# The clubs in order of their likes, most liked first, so the most liked clubs (the recommendations for someone who
+# hasn't joined any club yet, and the pages of the tag queries) are read from the start of the index
+club_favorites_index = db.Index('ix_club_favorite_count_id', Club.favorite_count.desc(), Club.id)
+
+
+# Full text search index over the clubs' names and descriptions (SQLite FTS5).
+# The index doesn't store a second copy of the text (content='club'), and the triggers keep it in sync with every
+# insert, update and delete on the club table, so the API routes and bootstrap don't have to do anything extra.
+# Matches in the name are ranked 10 times higher than matches in the description.
+CLUB_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS club_search USING fts5("
+    "name, description, content='club', content_rowid='id', prefix='2 3', tokenize='unicode61 remove_diacritics 2')",
+    "INSERT INTO club_search(club_search, rank) VALUES ('rank', 'bm25(10.0, 1.0)')",
+    "CREATE TRIGGER IF NOT EXISTS club_search_insert AFTER INSERT ON club BEGIN "
+    "INSERT INTO club_search(rowid, name, description) VALUES (new.id, new.name, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS club_search_delete AFTER DELETE ON club BEGIN "
+    "INSERT INTO club_search(club_search, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); END",
+    "CREATE TRIGGER IF NOT EXISTS club_search_update AFTER UPDATE OF name, description ON club BEGIN "
+    "INSERT INTO club_search(club_search, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); "
+    "INSERT INTO club_search(rowid, name, description) VALUES (new.id, new.name, new.description); END",
+]
+for statement in CLUB_SEARCH_DDL:
+    event.listen(Club.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(Club.__table__, 'before_drop', DDL("DROP TABLE IF EXISTS club_search").execute_if(dialect='sqlite'))
+
+
+# The most similar clubs of every club, precomputed by the recommendation index (see recommend.py)
+class ClubSimilarity(db.Model):
+    club_id = db.Column(db.Integer, primary_key=True)
+    neighbor_id = db.Column(db.Integer, primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return '<ClubSimilarity %r -> %r>' % (self.club_id, self.neighbor_id)
+
+
+# The clubs whose tags or members changed since their similarities were last computed.
+# Every change gets a higher version, so the index only clears the changes it has actually seen.
+# The version is indexed since the triggers below look up the highest one on every change.
+recommendation_dirty = db.Table(
+    'recommendation_dirty',
+    db.Column('club_id', db.Integer, primary_key=True),
+    db.Column('version', db.Integer, nullable=False, index=True)
+)
+
+# Whenever a club gains or loses a tag or a member, the club gets marked in recommendation_dirty in the same transaction
+MARK_DIRTY = "INSERT OR REPLACE INTO recommendation_dirty (club_id, version) " \
+             "VALUES ({}.club_id, (SELECT coalesce(max(version), 0) + 1 FROM recommendation_dirty)); "
+RECOMMENDATION_DIRTY_DDL = {
+    club_tag_association: [
+        "CREATE TRIGGER IF NOT EXISTS recommendation_tag_insert AFTER INSERT ON club_tag_association BEGIN "
+        + MARK_DIRTY.format('new') + "END",
+        "CREATE TRIGGER IF NOT EXISTS recommendation_tag_delete AFTER DELETE ON club_tag_association BEGIN "
+        + MARK_DIRTY.format('old') + "END",
+    ],
+    user_club_association: [
+        "CREATE TRIGGER IF NOT EXISTS recommendation_member_insert AFTER INSERT ON user_club_association BEGIN "
+        + MARK_DIRTY.format('new') + "END",
+        "CREATE TRIGGER IF NOT EXISTS recommendation_member_delete AFTER DELETE ON user_club_association BEGIN "
+        + MARK_DIRTY.format('old') + "END",
+    ],
+}
+for table, statements in RECOMMENDATION_DIRTY_DDL.items():
+    for statement in statements:
+        event.listen(table, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
 
 
 # Different users for when signing in
@@ -81,7 +186,7 @@ class User(db.Model, UserMixin):
     # Store graduation year as an integer instead of string for memory efficiency reasons
     graduation_year = db.Column(db.Integer, unique=False, nullable=True)
 
-    # To prevent brute force attacks
+    # To prevent brute force attacks (login_attempts isn't used anymore, the failures are counted in ratelimit.py)
     login_attempts = db.Column(db.Integer, default=0, nullable=False)
     locked_until = db.Column(db.DateTime, nullable=True)
 
@@ -106,12 +211,9 @@ class User(db.Model, UserMixin):
             return True
         return False
 
-    def increase_login_attempts(self):
-        self.login_attempts += 1
-        print("login attempts:", self.login_attempts)
-        if self.login_attempts >= 5:
-            self.locked_until = datetime.utcnow() + timedelta(minutes=10)
-            self.login_attempts = 0
+    # The failed logins are counted by the login rate limiter (see ratelimit.py), which locks the account once there are too many
+    def lock_account(self, minutes=10):
+        self.locked_until = datetime.utcnow() + timedelta(minutes=minutes)
 
 
 # For each comment
@@ -120,7 +222,12 @@ class Comment(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     club_id = db.Column(db.Integer, db.ForeignKey('club.id'), nullable=True)
     content = db.Column(db.String(120), unique=False, nullable=False)
-    parent_id = db.Column(db.Integer, db.ForeignKey('comment.id'))
+    parent_id = db.Column(db.Integer, db.ForeignKey('comment.id'), index=True) # for finding the replies of a comment
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True) # for the exports
+
+    # For finding a club's comments, and its top level comments (parent_id IS NULL) in order of their id
+    __table_args__ = (db.Index('ix_comment_club_id_parent_id', 'club_id', 'parent_id'),)
 
     def __repr__(self):
         return '<Comment %r>' % self.content
@@ -133,6 +240,22 @@ class Comment(db.Model):
                 'parent id': self.parent_id}
 
 
+# Every write to the clubs, comments and files, in the order they were committed (see changelog.py).
+# AUTOINCREMENT makes sure a sequence number is never used twice, even after the oldest changes are compacted away.
+class Change(db.Model):
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    seq = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)    # club, comment or file
+    action = db.Column(db.String(20), nullable=False)  # create, update, delete or favorite
+    object_id = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.Text, nullable=True)           # the JSON of the object after the change (a tombstone for deletes)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return '<Change %r>' % self.seq
+
+
 ## For OAUTH2 that I wasn't able to implement because of the domain names
 # class User(db.Model):
 #     id = db.Column(db.Integer, primary_key=True)
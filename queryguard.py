@@ -0,0 +1,237 @@
+import argparse, os, random, re, sys, tempfile, threading
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+
+# Checks that no route reads a whole table and that no route runs more SQL statements when there's more data (the
+# sign of an N+1 query, like loading every club's tags one club at a time). Every route gets the same requests against
+# a small and a large synthetic dataset (see synthetic.py), the plan of every statement is checked with
+# EXPLAIN QUERY PLAN, and the script exits with 1 if a route failed, so it can run before merging.
+#
+# Sample usage:
+#   python queryguard.py
+#   python queryguard.py --requests 50 --only comments
+
+
+# SQLite's plan for reading every row of a table: "SCAN club" ("SCAN TABLE club" before SQLite 3.36), followed by the
+# index it reads the table in the order of, if any
+SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?(.*)$')
+
+# The routes that read whole tables on purpose, and the tables they may scan
+ALLOWED_SCANS = {
+    ('GET', '/api/tags/count'): {'tag'},  # lists every tag with its count
+    ('GET', '/api/tags/query'): {'club'},  # loads the order of the likes, at most every TAG_QUERY_ORDER_TTL seconds
+}
+# The routes whose number of statements grows with the data on purpose
+ALLOWED_GROWTH = {
+    ('GET', '/api/clubs'),  # streams every club, CLUBS_STREAM_BATCH_SIZE clubs per query
+}
+
+# The datasets the routes run against. The large one has more of everything, and more comments and members per club.
+SMALL_DATASET = {'clubs': 50, 'users': 10, 'comments': 200, 'files': 5, 'tags': 5}
+LARGE_DATASET = {'clubs': 500, 'users': 100, 'comments': 5000, 'files': 10, 'tags': 20}
+# A user that isn't in any club (every generated user is), so all of their recommendations are the most liked clubs
+NO_CLUBS_USER = 'guard-no-clubs'
+
+
+# Records the SQL statements every request runs (by route), and which of them read a whole table.
+# The plans are looked up after the response is sent, so they don't count towards the route's statements.
+class QueryGuard:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}      # (method, route) -> {'requests', 'statements' (the most in one request), 'scans'}
+        self.tables = set()   # the tables a scan is reported for (not views, CTEs or virtual tables)
+
+    def init_app(self, app, db):
+        self.tables = set(db.metadata.tables)
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+        with app.app_context():
+            for engine in db.engines.values():
+                event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+
+    def start_request(self):
+        g.query_guard_statements = []
+
+    def before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        if statement.startswith('EXPLAIN') or not has_request_context():
+            return
+        statements = g.get('query_guard_statements')
+        if statements is not None:
+            # (the statements run with several sets of parameters are inserts, which have nothing to scan)
+            statements.append((connection.engine, statement, None if executemany else parameters))
+
+    def finish_request(self, response):
+        statements = g.get('query_guard_statements')
+        if statements is None:
+            return response
+
+        key = (request.method, request.url_rule.rule if request.url_rule else 'unmatched')
+        # Files are passed straight to the server, which never closes the response (see metrics.py), but they're done
+        # with the database already. Streamed responses keep running statements until they're sent.
+        if response.direct_passthrough:
+            self.record(key, statements)
+        else:
+            response.call_on_close(lambda: self.record(key, statements))
+        return response
+
+    def record(self, key, statements):
+        scans = set()
+        explained = set()
+        for engine, statement, parameters in statements:
+            if parameters is None or statement in explained:
+                continue
+            explained.add(statement)
+            for table, detail in self.full_scans(engine, statement, parameters):
+                scans.add((table, detail, statement))
+
+        with self.lock:
+            route = self.routes.setdefault(key, {'requests': 0, 'statements': 0, 'scans': set()})
+            route['requests'] += 1
+            route['statements'] = max(route['statements'], len(statements))
+            route['scans'] |= scans
+
+    # Yields (table, plan line) for every table the statement reads all the rows of
+    def full_scans(self, engine, statement, parameters):
+        with engine.connect() as connection:
+            plan = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+
+        limited = ' LIMIT ' in statement.upper()
+        for row in plan:
+            detail = row[-1]
+            match = SCAN.match(detail)
+            if not match or match.group(1) not in self.tables:
+                continue
+            # Reading a table in the order of an index stops at the LIMIT, so only a page of it is read
+            if limited and 'USING' in match.group(2):
+                continue
+            yield match.group(1), detail
+
+    def reset(self):
+        with self.lock:
+            routes, self.routes = self.routes, {}
+        return routes
+
+
+query_guard = QueryGuard()
+
+
+# Returns a function that picks a different item every time, so the same comment or club isn't deleted twice
+def pick_once(items):
+    remaining = list(items)
+    return lambda rng: remaining.pop(rng.randrange(len(remaining)))
+
+
+# The requests of the benchmark (see benchmark.py), plus the routes it leaves out because they delete data or are slow
+def make_scenarios(dataset):
+    from benchmark import make_scenarios as make_benchmark_scenarios
+
+    counter = iter(range(sys.maxsize))
+    comment = pick_once(dataset['comments'])
+    club = pick_once(dataset['clubs'])
+    return make_benchmark_scenarios(dataset) + [
+        ('DELETE /api/clubs/comments/<comment_id>', True, lambda rng: ('DELETE', f"/api/clubs/comments/{comment(rng)}", None, None)),
+        ('DELETE /api/clubs/<club_name>', True, lambda rng: ('DELETE', f"/api/clubs/{club(rng)}", None, None)),
+        ('POST /signup', False, lambda rng: ('POST', '/signup', {'username': f"guard-{next(counter)}", 'password': 'password'}, None)),
+        ('GET /api/users/<username>/recommendations (no clubs)', False,
+         lambda rng: ('GET', f"/api/users/{NO_CLUBS_USER}/recommendations", None, None)),
+    ]
+
+
+# Sends the same requests (same seed) for every scenario and returns what the guard recorded, and the requests that
+# didn't succeed (a route that fails would only be measuring its error path).
+# The scenarios that need a login log in once first, so those logins are what the guard shows for POST /login.
+def run_routes(app, dataset, requests, only, seed):
+    from benchmark import TestClient
+    from synthetic import PASSWORD
+
+    failures = []
+    for number, (name, needs_login, make_request) in enumerate(make_scenarios(dataset)):
+        if only and only not in name:
+            continue
+        rng = random.Random(seed + number)
+        client = TestClient(app)
+        if needs_login:
+            status, _, _ = client.request('POST', '/login', json={'username': dataset['users'][0], 'password': PASSWORD})
+            if not 200 <= status < 300:
+                failures.append(f"{name} couldn't log in (POST /login returned {status})")
+                continue
+        # Getting every club sends every club, so it gets fewer requests
+        for _ in range(max(1, requests // 10) if name == 'GET /api/clubs' else requests):
+            method, url, json_body, data = make_request(rng)
+            status, _, _ = client.request(method, url, json_body, data)
+            if not 200 <= status < 300:
+                failures.append(f"{name} returned {status} for {method} {url}")
+
+    return query_guard.reset(), failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that no route scans a whole table or runs more SQL statements with more data")
+    parser.add_argument('--requests', type=int, default=20, help="requests per route and dataset")
+    parser.add_argument('--only', default=None, help="only run the routes whose name contains this")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # The app has to be pointed at a new database before it's imported
+    directory = tempfile.mkdtemp(prefix='clubreview-queryguard-')
+    os.environ['CLUBREVIEW_DATABASE_URI'] = f"sqlite:///{os.path.join(directory, 'queryguard.db')}"
+
+    import app as clubreview
+    from blobstore import BlobStore
+    from cache import response_cache, TTLCache
+    from models import User
+    from recommend import recommendation_index
+    from synthetic import generate_dataset
+    from tagindex import tag_index
+
+    app, db = clubreview.app, clubreview.db
+    # Every request has to reach the database
+    response_cache.max_bytes = 0
+    query_guard.init_app(app, db)
+
+    results = []
+    failures = []
+    for number, sizes in enumerate((SMALL_DATASET, LARGE_DATASET)):
+        clubreview.blob_store = BlobStore(os.path.join(directory, f'blobs-{number}'))
+        # The logged in user is only loaded from the database once per dataset, so it doesn't depend on the timing
+        clubreview.user_cache = TTLCache(max_entries=1024, ttl=3600)
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            dataset = generate_dataset(db.engine, clubreview.blob_store, seed=args.seed, **sizes)
+            db.session.add(User(username=NO_CLUBS_USER, password=''))
+            db.session.commit()
+        recommendation_index.build()
+        tag_index.rebuild()
+        routes, failed_requests = run_routes(app, dataset, args.requests, args.only, args.seed)
+        results.append(routes)
+        failures.extend(failed_requests)
+
+    small, large = results
+    print(f"{'route':<60} {'requests':>8} {'sql small':>10} {'sql large':>10}")
+    for key in sorted(large):
+        method, route = key
+        name = f"{method} {route}"
+        before = small.get(key, {}).get('statements')
+        after = large[key]['statements']
+        print(f"{name:<60} {large[key]['requests']:>8} {before if before is not None else '-':>10} {after:>10}")
+
+        if before is not None and after > before and key not in ALLOWED_GROWTH:
+            failures.append(f"{name} ran {after} SQL statements with the large dataset and {before} with the small one")
+        allowed = ALLOWED_SCANS.get(key, set())
+        for table, detail, statement in sorted(large[key]['scans'] | small.get(key, {}).get('scans', set())):
+            if table not in allowed:
+                failures.append(f"{name} reads the whole {table} table ({detail}):\n    {' '.join(statement.split())}")
+
+    if failures:
+        print(f"\n{len(failures)} problem(s):")
+        for failure in failures:
+            print(f"- {failure}")
+        sys.exit(1)
+    print("\nNo route scans a whole table or runs more SQL statements with more data.")
+
+
+if __name__ == '__main__':
+    main()
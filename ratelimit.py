@@ -0,0 +1,198 @@
+import math, os, threading, time
+from sqlalchemy import create_engine, event, text
+from database import make_pragma_listener
+
+
+# How often (in seconds) the counts of windows that are over are deleted
+PRUNE_INTERVAL = 60
+
+# The side database only holds counters, so it doesn't need to survive a crash (that would only reset the limits)
+SIDE_DATABASE_PRAGMAS = {'journal_mode': 'WAL', 'synchronous': 'OFF', 'busy_timeout': 1000}
+
+CREATE_TABLE = text(
+    "CREATE TABLE IF NOT EXISTS login_failures (key TEXT NOT NULL, bucket INTEGER NOT NULL, count INTEGER NOT NULL, "
+    "expires REAL NOT NULL, PRIMARY KEY (key, bucket)) WITHOUT ROWID"
+)
+ADD_FAILURE = text(
+    "INSERT INTO login_failures (key, bucket, count, expires) VALUES (:key, :bucket, 1, :expires) "
+    "ON CONFLICT (key, bucket) DO UPDATE SET count = count + 1"
+)
+GET_COUNTS = text("SELECT bucket, count FROM login_failures WHERE key = :key AND bucket >= :bucket")
+CLEAR = text("DELETE FROM login_failures WHERE key = :key")
+PRUNE = text("DELETE FROM login_failures WHERE expires < :now")
+
+
+# Keeps the counts in this process only (e.g. with a single worker, or for debugging)
+class MemoryStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}  # (key, bucket) -> [count, expires]
+
+    def add(self, key, bucket, expires):
+        with self.lock:
+            self.counts.setdefault((key, bucket), [0, expires])[0] += 1
+
+    def get(self, key, buckets):
+        with self.lock:
+            return {bucket: self.counts[(key, bucket)][0] for bucket in buckets if (key, bucket) in self.counts}
+
+    def clear(self, key):
+        with self.lock:
+            for count_key in [count_key for count_key in self.counts if count_key[0] == key]:
+                del self.counts[count_key]
+
+    def prune(self, now):
+        with self.lock:
+            for count_key in [count_key for count_key, (_, expires) in self.counts.items() if expires < now]:
+                del self.counts[count_key]
+
+
+# Keeps the counts in a small SQLite database of its own, so that all the worker processes on the machine see the same
+# counts. It has its own file (and so its own write lock), which keeps the failed logins off the main database.
+class SQLiteStore:
+    def __init__(self, path):
+        self.engine = create_engine(f"sqlite:///{path}")
+        event.listen(self.engine, 'connect', make_pragma_listener(SIDE_DATABASE_PRAGMAS))
+        with self.engine.begin() as connection:
+            connection.execute(CREATE_TABLE)
+
+    def add(self, key, bucket, expires):
+        with self.engine.begin() as connection:
+            connection.execute(ADD_FAILURE, {'key': key, 'bucket': bucket, 'expires': expires})
+
+    def get(self, key, buckets):
+        with self.engine.connect() as connection:
+            rows = connection.execute(GET_COUNTS, {'key': key, 'bucket': min(buckets)}).all()
+        return {bucket: count for bucket, count in rows if bucket in buckets}
+
+    def clear(self, key):
+        with self.engine.begin() as connection:
+            connection.execute(CLEAR, {'key': key})
+
+    def prune(self, now):
+        with self.engine.begin() as connection:
+            connection.execute(PRUNE, {'now': now})
+
+
+# Counts events in a sliding window of `window` seconds and allows at most `limit` of them.
+# The time is split into fixed windows and only the counts of the current and the previous window are kept. The count
+# of the sliding window is the current count plus the part of the previous count that still overlaps it (assuming the
+# events of the previous window were spread evenly), which is close enough and needs two counters per key.
+class SlidingWindow:
+    def __init__(self, name, limit, window):
+        self.name = name
+        self.limit = limit
+        self.window = window
+
+    def key(self, value):
+        return f"{self.name}:{value}"
+
+    def bucket(self, now):
+        return int(now // self.window)
+
+    # The (current, previous) counts of the value
+    def counts(self, store, value, now):
+        bucket = self.bucket(now)
+        counts = store.get(self.key(value), (bucket - 1, bucket))
+        return counts.get(bucket, 0), counts.get(bucket - 1, 0)
+
+    def estimate(self, current, previous, now):
+        elapsed = (now % self.window) / self.window
+        return current + previous * (1 - elapsed)
+
+    # How many seconds until there's room for another event (0 if there's room now)
+    def retry_after(self, store, value, now):
+        current, previous = self.counts(store, value, now)
+        if self.estimate(current, previous, now) < self.limit:
+            return 0
+
+        until_next_window = self.window - now % self.window
+        if current >= self.limit:
+            # The current window's events still count fully until it's over, and then they start sliding out
+            previous, wait = current, until_next_window
+            current, now = 0, now + until_next_window
+        else:
+            wait = 0
+        # The share of the window that has to pass for the previous count to slide out far enough
+        elapsed = 1 - (self.limit - current) / previous
+        return max(1, math.ceil(wait + elapsed * self.window - now % self.window))
+
+    def add(self, store, value, now):
+        bucket = self.bucket(now)
+        # A window's count is needed until the end of the window after it
+        store.add(self.key(value), bucket, (bucket + 2) * self.window)
+
+
+# Limits failed logins by username and by client IP, and checks the limits before the password is hashed, so that
+# guessing passwords (or trying leaked ones against many accounts) is turned away without costing a hash or a write to
+# the main database. Failed logins used to be counted on the user row, which made every wrong password a write
+# transaction. Now they're counted here, and the user row is only written when the account actually gets locked.
+# The counts are shared between worker processes through a SQLite side file (LOGIN_RATE_LIMIT_DATABASE, or kept in
+# memory when it's None).
+class LoginRateLimiter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.store = MemoryStore()
+        self.user_limit = SlidingWindow('user', 5, 600)
+        self.ip_limit = SlidingWindow('ip', 20, 300)
+        self.lock_minutes = 10
+        self.last_prune = 0
+        self.rejected = 0
+        self.failures = 0
+        self.locks = 0
+
+    def init_app(self, app):
+        self.user_limit = SlidingWindow('user', app.config.setdefault('LOGIN_MAX_FAILURES_PER_USER', 5),
+                                        app.config.setdefault('LOGIN_USER_FAILURE_WINDOW', 600))
+        self.ip_limit = SlidingWindow('ip', app.config.setdefault('LOGIN_MAX_FAILURES_PER_IP', 20),
+                                      app.config.setdefault('LOGIN_IP_FAILURE_WINDOW', 300))
+        self.lock_minutes = app.config.setdefault('LOGIN_LOCK_MINUTES', 10)
+        path = app.config.setdefault('LOGIN_RATE_LIMIT_DATABASE', os.path.join(app.instance_path, 'ratelimit.db'))
+
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.store = SQLiteStore(path)
+        else:
+            self.store = MemoryStore()
+
+    # How many seconds the client has to wait before trying to log in again (0 if it can try now)
+    def check(self, username, ip):
+        now = time.time()
+        wait = max(self.ip_limit.retry_after(self.store, ip, now), self.user_limit.retry_after(self.store, username, now))
+        if wait:
+            with self.lock:
+                self.rejected += 1
+        return wait
+
+    # Counts a wrong password, and returns True when the username just went over its limit (so the account gets locked)
+    def record_failure(self, username, ip):
+        now = time.time()
+        self.ip_limit.add(self.store, ip, now)
+        self.user_limit.add(self.store, username, now)
+        with self.lock:
+            self.failures += 1
+            prune = now - self.last_prune >= PRUNE_INTERVAL
+            if prune:
+                self.last_prune = now
+        if prune:
+            self.store.prune(now)
+
+        current, previous = self.user_limit.counts(self.store, username, now)
+        return self.user_limit.estimate(current, previous, now) >= self.user_limit.limit
+
+    # Forgets the failed logins of the username (after it logged in, or once its account is locked, since the lock
+    # keeps it out from then on)
+    def reset(self, username):
+        self.store.clear(self.user_limit.key(username))
+
+    def account_locked(self, username):
+        with self.lock:
+            self.locks += 1
+        self.reset(username)
+
+    def stats(self):
+        with self.lock:
+            return {'rejected': self.rejected, 'failures': self.failures, 'locks': self.locks}
+
+
+login_rate_limiter = LoginRateLimiter()
@@ -0,0 +1,244 @@
+import atexit, threading
+import numpy as np
+from scipy import sparse
+from sqlalchemy import delete, insert, select, tuple_
+from models import Club, ClubSimilarity, club_tag_association, user_club_association, recommendation_dirty
+
+
+# How many of the most similar clubs are stored for every club
+TOP_K = 20
+# How much the shared tags and the shared members count towards the similarity of two clubs (they add up to 1)
+TAG_WEIGHT = 0.5
+MEMBER_WEIGHT = 0.5
+# Roughly how many similarity scores are computed at once (which bounds the memory of a batch)
+BATCH_CELLS = 4 * 1024 * 1024
+# How many ids go in one IN (...) list
+IN_CHUNK_SIZE = 500
+
+
+# Splits a list into lists of at most size items
+def chunks(items, size=IN_CHUNK_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+# Turns (row, column) pairs into a sparse 0/1 matrix whose rows have length 1 (so the dot product of two rows is
+# their cosine similarity), scaled by the square root of the weight (so it ends up multiplying the dot product)
+def normalized_matrix(pairs, rows, shape, weight):
+    pairs = [(rows[row], column) for row, column in pairs if row in rows]
+    matrix = sparse.coo_matrix(
+        (np.ones(len(pairs)), ([row for row, _ in pairs], [column for _, column in pairs])), shape=shape
+    ).tocsr()
+    matrix.data[:] = 1  # the same pair twice still counts once
+
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    scale = np.divide(np.sqrt(weight), norms, out=np.zeros_like(norms), where=norms > 0)
+    return sparse.diags(scale) @ matrix
+
+
+# Runs the statement with `column IN (...)` for every chunk of the values and returns all the rows
+def select_in(connection, statement, column, values):
+    rows = []
+    for chunk in chunks(values):
+        rows.extend(connection.execute(statement.where(column.in_(chunk))).all())
+    return rows
+
+
+# The given clubs and every club that shares a tag or a member with one of them (the other clubs' similarity to them is 0)
+def related_clubs(connection, club_ids):
+    tags, members = club_tag_association.c, user_club_association.c
+    tag_ids = set(row[0] for row in select_in(connection, select(tags.tag_id), tags.club_id, club_ids))
+    user_ids = set(row[0] for row in select_in(connection, select(members.user_id), members.club_id, club_ids))
+
+    related = set(club_ids)
+    related.update(row[0] for row in select_in(connection, select(tags.club_id), tags.tag_id, tag_ids))
+    related.update(row[0] for row in select_in(connection, select(members.club_id), members.user_id, user_ids))
+    return related
+
+
+# The feature vectors of the clubs: one row per club, with a column for every tag and every user.
+# The dot product of two rows is the weighted sum of the cosine similarity of the clubs' tags and of their members.
+# Only the given clubs are loaded (e.g. the ones related to the changed clubs), or all of them without club_ids.
+class ClubFeatures:
+    def __init__(self, connection, tag_weight=TAG_WEIGHT, member_weight=MEMBER_WEIGHT, club_ids=None):
+        tags, members = club_tag_association.c, user_club_association.c
+        if club_ids is None:
+            club_ids = connection.execute(select(Club.id)).scalars().all()
+            tag_pairs = connection.execute(select(tags.club_id, tags.tag_id)).all()
+            member_pairs = connection.execute(select(members.club_id, members.user_id)).all()
+        else:
+            club_ids = [row[0] for row in select_in(connection, select(Club.id), Club.id, club_ids)]
+            tag_pairs = select_in(connection, select(tags.club_id, tags.tag_id), tags.club_id, club_ids)
+            member_pairs = select_in(connection, select(members.club_id, members.user_id), members.club_id, club_ids)
+
+        self.club_ids = np.array(sorted(club_ids), dtype=np.int64)
+        self.rows = {int(club_id): row for row, club_id in enumerate(self.club_ids)}
+        tags = max((tag_id for _, tag_id in tag_pairs), default=0) + 1
+        users = max((user_id for _, user_id in member_pairs), default=0) + 1
+
+        self.matrix = sparse.hstack([
+            normalized_matrix(tag_pairs, self.rows, (len(self.club_ids), tags), tag_weight),
+            normalized_matrix(member_pairs, self.rows, (len(self.club_ids), users), member_weight),
+        ]).tocsr()
+
+    # Yields (club id, [(neighbor id, score), ...]) with the top_k most similar clubs of each of the given clubs,
+    # computing the scores of a batch of clubs against all the clubs with one sparse matrix product
+    def top_neighbors(self, club_ids, top_k=TOP_K):
+        rows = [self.rows[club_id] for club_id in club_ids if club_id in self.rows]
+        batch_size = max(1, BATCH_CELLS // max(len(self.club_ids), 1))
+
+        for batch in chunks(rows, batch_size):
+            scores = (self.matrix[batch] @ self.matrix.T).tocsr()
+            for i, row in enumerate(batch):
+                start, end = scores.indptr[i], scores.indptr[i + 1]
+                columns, values = scores.indices[start:end], scores.data[start:end]
+                keep = (columns != row) & (values > 0)
+                columns, values = columns[keep], values[keep]
+
+                if len(values) > top_k:
+                    best = np.argpartition(-values, top_k)[:top_k]
+                    columns, values = columns[best], values[best]
+                order = np.argsort(-values, kind='stable')
+                yield int(self.club_ids[row]), [(int(self.club_ids[column]), float(value))
+                                                for column, value in zip(columns[order], values[order])]
+
+    # Returns {club id: [(changed club id, score), ...]} with every club's scores against the changed clubs
+    def scores_against(self, changed_ids):
+        changed_rows = [self.rows[club_id] for club_id in changed_ids if club_id in self.rows]
+        scores = (self.matrix @ self.matrix[changed_rows].T).tocoo()
+
+        candidates = {}
+        for row, column, score in zip(scores.row, scores.col, scores.data):
+            club_id, changed_id = int(self.club_ids[row]), int(self.club_ids[changed_rows[column]])
+            if club_id != changed_id and score > 0:
+                candidates.setdefault(club_id, []).append((changed_id, float(score)))
+        return candidates
+
+
+# Keeps the club_similarity table (the top TOP_K most similar clubs of every club) up to date.
+# build() computes it from scratch. refresh() only does the work the changes since the last run need:
+# the clubs marked in recommendation_dirty (by the triggers in models.py) get their neighbors recomputed, and so do the
+# clubs that had one of them as a neighbor (their score may have gone down). Every other club's stored neighbors were
+# all unchanged, so only the changed clubs can push their way into its top TOP_K, and they're merged in directly.
+class RecommendationIndex:
+    def __init__(self):
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()  # only one build or refresh can run at a time
+        self.thread_lock = threading.Lock()
+        self.app = None
+        self.db = None
+        self.top_k = TOP_K
+        self.tag_weight = TAG_WEIGHT
+        self.member_weight = MEMBER_WEIGHT
+        self.on_change = []
+        self.interval = 0
+        self.thread = None
+
+    def init_app(self, app, db):
+        self.app = app
+        self.db = db
+        self.top_k = app.config.setdefault('RECOMMENDATION_TOP_K', TOP_K)
+        self.tag_weight = app.config.setdefault('RECOMMENDATION_TAG_WEIGHT', TAG_WEIGHT)
+        self.member_weight = app.config.setdefault('RECOMMENDATION_MEMBER_WEIGHT', MEMBER_WEIGHT)
+        # With an interval of 0, the index is only refreshed by the build-recommendations command
+        self.interval = app.config.setdefault('RECOMMENDATION_REFRESH_INTERVAL', 60)
+        atexit.register(self.stopped.set)
+
+    # Starts the periodic refreshes (called on every request, see start_background_threads in app.py)
+    def start(self):
+        if self.thread is None and self.interval:
+            with self.thread_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, args=(self.interval,), daemon=True)
+                    self.thread.start()
+
+    # Runs the function every time the index changes (e.g. to invalidate cached recommendations)
+    def add_change_listener(self, function):
+        self.on_change.append(function)
+
+    def build(self):
+        with self.lock, self.app.app_context():
+            engine = self.db.engine
+            with engine.connect() as connection:
+                dirty = connection.execute(select(recommendation_dirty)).all()
+                features = ClubFeatures(connection, self.tag_weight, self.member_weight)
+
+            neighbors = dict(features.top_neighbors([int(club_id) for club_id in features.club_ids], self.top_k))
+            with engine.begin() as connection:
+                connection.execute(delete(ClubSimilarity))
+                self.write(connection, neighbors, dirty)
+
+        self.changed()
+        return len(neighbors)
+
+    # Returns the number of clubs whose neighbors were rewritten
+    def refresh(self):
+        with self.lock, self.app.app_context():
+            engine = self.db.engine
+            with engine.connect() as connection:
+                dirty = connection.execute(select(recommendation_dirty)).all()
+                if not dirty:
+                    return 0
+                dirty_ids = set(row.club_id for row in dirty)
+
+                # The clubs that had a changed club as a neighbor
+                recompute = set(dirty_ids)
+                for chunk in chunks(dirty_ids):
+                    recompute.update(connection.execute(
+                        select(ClubSimilarity.club_id).where(ClubSimilarity.neighbor_id.in_(chunk)).distinct()
+                    ).scalars())
+
+                # Only the clubs related to the ones being scored can have a score above 0, so the rest aren't loaded
+                features = ClubFeatures(connection, self.tag_weight, self.member_weight,
+                                        club_ids=related_clubs(connection, recompute))
+                neighbors = dict(features.top_neighbors(recompute, self.top_k))
+                for club_id in recompute:
+                    neighbors.setdefault(club_id, [])  # e.g. a deleted club, whose rows just get removed
+
+                # Merge the changed clubs into the stored neighbors of every other club they're similar to
+                candidates = {club_id: scores for club_id, scores in features.scores_against(dirty_ids).items()
+                              if club_id not in recompute}
+                stored = {}
+                for chunk in chunks(candidates):
+                    for row in connection.execute(select(ClubSimilarity).where(ClubSimilarity.club_id.in_(chunk))):
+                        stored.setdefault(row.club_id, []).append((row.neighbor_id, row.score))
+                for club_id, scores in candidates.items():
+                    merged = sorted(stored.get(club_id, []) + scores, key=lambda neighbor: -neighbor[1])[:self.top_k]
+                    # Only rewrite the clubs where a changed club actually made it into the top TOP_K
+                    if merged != sorted(stored.get(club_id, []), key=lambda neighbor: -neighbor[1]):
+                        neighbors[club_id] = merged
+
+            with engine.begin() as connection:
+                for chunk in chunks(neighbors):
+                    connection.execute(delete(ClubSimilarity).where(ClubSimilarity.club_id.in_(chunk)))
+                self.write(connection, neighbors, dirty)
+
+        self.changed()
+        return len(neighbors)
+
+    # Stores the neighbors, and clears the changes that were seen (unless the club changed again in the meantime)
+    def write(self, connection, neighbors, dirty):
+        rows = [{'club_id': club_id, 'neighbor_id': neighbor_id, 'score': score}
+                for club_id, scores in neighbors.items() for neighbor_id, score in scores]
+        if rows:
+            connection.execute(insert(ClubSimilarity), rows)
+        for chunk in chunks(dirty):
+            connection.execute(delete(recommendation_dirty).where(
+                tuple_(recommendation_dirty.c.club_id, recommendation_dirty.c.version).in_([tuple(row) for row in chunk])
+            ))
+
+    def changed(self):
+        for function in self.on_change:
+            function()
+
+    # Refresh periodically until the server stops
+    def run(self, interval):
+        while not self.stopped.wait(interval):
+            try:
+                self.refresh()
+            except Exception:
+                self.app.logger.exception("Failed to refresh the recommendation index")
+
+
+recommendation_index = RecommendationIndex()
@@ -0,0 +1,85 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import requests
+from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Makes a session that keeps its connections open between pages and retries pages that failed or got rate limited
+def make_session(pool_size, retries):
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=('GET',))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# Turns the sources into the list of pages to scrape. A source can be:
+# - a URL, where "{page}" gets replaced with every page number from 1 to pages (for paginated directories)
+# - a local HTML file, or a directory of them (so the scraper can run against saved pages without the internet)
+def expand_sources(sources, pages=1):
+    expanded = []
+    for source in sources:
+        if '{page}' in source:
+            expanded.extend(source.format(page=page) for page in range(1, pages + 1))
+        elif os.path.isdir(source):
+            expanded.extend(sorted(
+                os.path.join(source, name) for name in os.listdir(source) if name.endswith(('.html', '.htm'))
+            ))
+        else:
+            expanded.append(source)
+    return expanded
+
+
+# Gets the HTML of one page from the web or from disk
+def fetch_page(session, source, timeout):
+    if source.startswith(('http://', 'https://')):
+        response = session.get(source, timeout=timeout)
+        response.raise_for_status()
+        return response.content
+
+    with open(source, 'rb') as f:
+        return f.read()
+
+
+# Finds all the clubs on a page. Every club is in a box with its name in bold, its tags (separated by commas)
+# in a span and its description in italics. The clubs come back in the same format as clubs.json.
+def parse_clubs(html):
+    soup = BeautifulSoup(html, 'html.parser')
+    clubs = []
+    for box_div in soup.find_all('div', class_='box'):
+        tags = box_div.find('span').text.split(',')
+        clubs.append({
+            'name': box_div.find('strong').text,
+            'description': box_div.find('em').text,
+            'tags': [tag.strip() for tag in tags if tag.strip()]
+        })
+    return clubs
+
+
+# Scrapes the clubs from all the sources. The pages are downloaded by fetch_workers threads and parsed by
+# parse_workers processes at the same time, and the clubs are yielded as soon as their page is parsed,
+# so they can go straight into the bulk importer (see importer.py). Pages that can't be retrieved are skipped.
+def scrape(sources, pages=1, fetch_workers=8, parse_workers=None, retries=3, timeout=10):
+    sources = expand_sources(sources, pages)
+    session = make_session(fetch_workers, retries)
+
+    with ThreadPoolExecutor(max_workers=fetch_workers) as fetchers, ProcessPoolExecutor(max_workers=parse_workers) as parsers:
+        downloads = {fetchers.submit(fetch_page, session, source, timeout): source for source in sources}
+
+        parses = set()
+        for download in as_completed(downloads):
+            try:
+                parses.add(parsers.submit(parse_clubs, download.result()))
+            except Exception as e:
+                print(f"Failed to retrieve {downloads[download]}: {e}")
+
+            # Hand over the clubs of the pages that are already parsed while the rest are still downloading
+            for parse in [parse for parse in parses if parse.done()]:
+                parses.discard(parse)
+                yield from parse.result()
+
+        for parse in as_completed(parses):
+            yield from parse.result()
@@ -0,0 +1,122 @@
+import random
+from sqlalchemy import insert, select, func
+from werkzeug.security import generate_password_hash
+from importer import import_clubs
+from models import Club, Comment, File, User, club_file_association, user_club_association
+
+
+# Words the synthetic club descriptions are made of (also used as search terms by the benchmark)
+WORDS = [
+    'juggling', 'robotics', 'debate', 'finance', 'consulting', 'dance', 'acapella', 'chess', 'coding', 'hackathon',
+    'volunteering', 'theatre', 'poetry', 'photography', 'climbing', 'sailing', 'cooking', 'film', 'music', 'gaming',
+    'research', 'medicine', 'law', 'startup', 'design', 'journalism', 'language', 'culture', 'service', 'sports'
+]
+
+# Every synthetic user has this password
+PASSWORD = 'password'
+
+
+# Picks k different items, where items with a bigger weight are picked more often
+def weighted_sample(rng, items, weights, k):
+    picked = []
+    for item in rng.choices(items, weights=weights, k=k * 2):
+        if item not in picked:
+            picked.append(item)
+        if len(picked) == k:
+            break
+    return picked
+
+
+# Weights that follow a Zipf-like distribution, so the first few items are a lot more popular than the rest
+def skewed_weights(count, exponent=1.1):
+    return [1 / (rank + 1) ** exponent for rank in range(count)]
+
+
+# Fills the database with a synthetic dataset that's big enough to show the performance problems a 3 club
+# clubs.json hides: clubs with a skewed tag distribution (a few tags are on most clubs), users who joined
+# some (mostly popular) clubs, comment threads that go many replies deep, and files of very different sizes.
+# Returns the names the benchmark needs to build its requests.
+def generate_dataset(engine, blob_store, clubs=1000, users=100, comments=5000, files=100, tags=None, seed=0):
+    rng = random.Random(seed)
+
+    # Clubs and tags (written with the bulk importer)
+    tag_names = [f"tag-{i}" for i in range(tags or max(10, clubs // 100))]
+    tag_weights = skewed_weights(len(tag_names))
+    records = ({
+        'code': f"club-{i}",
+        'name': f"Synthetic Club {i}",
+        'description': ' '.join(rng.choices(WORDS, k=8)),
+        'tags': weighted_sample(rng, tag_names, tag_weights, rng.randint(1, 5))
+    } for i in range(clubs))
+    import_clubs(records, engine, progress=None)
+
+    with engine.begin() as connection:
+        club_rows = connection.execute(select(Club.id, Club.name).order_by(Club.id)).all()
+        club_ids = [row.id for row in club_rows]
+        club_weights = skewed_weights(len(club_ids), exponent=0.8)
+
+        # Users (all with the same password, hashed once) and the clubs they joined
+        first_user_id = (connection.execute(select(func.max(User.id))).scalar() or 0) + 1
+        password_hash = generate_password_hash(PASSWORD)
+        usernames = [f"user-{seed}-{i}" for i in range(users)]
+        if usernames:
+            connection.execute(insert(User), [
+                {'id': first_user_id + i, 'username': username, 'password': password_hash, 'graduation_year': rng.randint(2024, 2028)}
+                for i, username in enumerate(usernames)
+            ])
+            memberships = [
+                {'user_id': first_user_id + i, 'club_id': club_id}
+                for i in range(users)
+                for club_id in weighted_sample(rng, club_ids, club_weights, rng.randint(1, 10))
+            ]
+            connection.execute(insert(user_club_association), memberships)
+
+        # Comments, where most of them reply to one of the latest comments of the club so the threads get deep
+        next_comment_id = (connection.execute(select(func.max(Comment.id))).scalar() or 0) + 1
+        comment_ids = []
+        comments_by_club = {}
+        batch = []
+        for i in range(comments):
+            club_id = rng.choices(club_ids, weights=club_weights)[0]
+            club_comments = comments_by_club.setdefault(club_id, [])
+            parent_id = None
+            if club_comments and rng.random() < 0.7:
+                parent_id = rng.choice(club_comments[-3:])
+
+            comment_id = next_comment_id + i
+            batch.append({
+                'id': comment_id,
+                'user_id': first_user_id + rng.randrange(users) if users else None,
+                'club_id': club_id,
+                'content': ' '.join(rng.choices(WORDS, k=6)),
+                'parent_id': parent_id
+            })
+            club_comments.append(comment_id)
+            comment_ids.append(comment_id)
+
+            if len(batch) == 5000:
+                connection.execute(insert(Comment), batch)
+                batch = []
+        if batch:
+            connection.execute(insert(Comment), batch)
+
+        # Files between 1 KB and 1 MB (most of them small), stored in the blob store
+        file_paths = []
+        for i in range(files):
+            club_id, club_name = rng.choice(club_rows)
+            size = int(2 ** rng.uniform(10, 20))
+            digest, size = blob_store.put(rng.getrandbits(8 * size).to_bytes(size, 'little'))
+            resource_path = f"file-{seed}-{i}.bin"
+            file_id = connection.execute(insert(File).values(
+                path=f"folders/{club_name}_{resource_path}", sha256=digest, size=size, content_type='application/octet-stream'
+            )).inserted_primary_key[0]
+            connection.execute(insert(club_file_association).values(club_id=club_id, file_id=file_id))
+            file_paths.append((club_name, resource_path))
+
+    return {
+        'clubs': [row.name for row in club_rows],
+        'tags': tag_names,
+        'users': usernames,
+        'comments': comment_ids,
+        'files': file_paths
+    }
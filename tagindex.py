@@ -0,0 +1,372 @@
+import atexit, heapq, json, re, threading, time
+from contextlib import nullcontext
+from flask import has_app_context
+from sqlalchemy import event, inspect, select, text
+from models import Club, Tag, club_tag_association
+
+
+# A bitmap chunk covers this many club ids
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+# The positions of the set bits of every byte value (for turning a bitmap back into club ids quickly)
+BYTE_BITS = [tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256)]
+
+
+# A set of club ids stored as bits. The ids are split into chunks of 65536 and each chunk is a Python int, so a tag that
+# only has clubs with high ids doesn't need the bits for all the ids below them, and empty chunks aren't stored at all.
+# AND, OR and AND NOT work on a whole chunk at a time.
+class Bitmap:
+    __slots__ = ('chunks',)
+
+    def __init__(self, chunks=None):
+        self.chunks = chunks or {}  # chunk number -> int with a bit set for every id in the chunk
+
+    @classmethod
+    def from_ids(cls, ids):
+        bitmap = cls()
+        for club_id in ids:
+            bitmap.add(club_id)
+        return bitmap
+
+    def add(self, club_id):
+        key = club_id >> CHUNK_BITS
+        self.chunks[key] = self.chunks.get(key, 0) | 1 << (club_id & CHUNK_MASK)
+
+    def discard(self, club_id):
+        key = club_id >> CHUNK_BITS
+        bits = self.chunks.get(key, 0) & ~(1 << (club_id & CHUNK_MASK))
+        if bits:
+            self.chunks[key] = bits
+        else:
+            self.chunks.pop(key, None)
+
+    def __and__(self, other):
+        chunks = {}
+        for key, bits in self.chunks.items():
+            both = bits & other.chunks.get(key, 0)
+            if both:
+                chunks[key] = both
+        return Bitmap(chunks)
+
+    def __or__(self, other):
+        chunks = dict(self.chunks)
+        for key, bits in other.chunks.items():
+            chunks[key] = chunks.get(key, 0) | bits
+        return Bitmap(chunks)
+
+    def __sub__(self, other):
+        chunks = {}
+        for key, bits in self.chunks.items():
+            left = bits & ~other.chunks.get(key, 0)
+            if left:
+                chunks[key] = left
+        return Bitmap(chunks)
+
+    def __len__(self):
+        return sum(bin(bits).count('1') for bits in self.chunks.values())
+
+    def __contains__(self, club_id):
+        return bool(self.chunks.get(club_id >> CHUNK_BITS, 0) >> (club_id & CHUNK_MASK) & 1)
+
+    # The club ids in increasing order
+    def __iter__(self):
+        for key in sorted(self.chunks):
+            bits = self.chunks[key]
+            base = key << CHUNK_BITS
+            for index, byte in enumerate(bits.to_bytes((bits.bit_length() + 7) // 8, 'little')):
+                if byte:
+                    for bit in BYTE_BITS[byte]:
+                        yield base + index * 8 + bit
+
+    def copy(self):
+        return Bitmap(dict(self.chunks))
+
+
+# Raised for a tag expression that can't be parsed
+class TagQueryError(ValueError):
+    pass
+
+
+# Quoted tag names ("Arts & Culture"), parentheses, commas, and everything else up to the next space or symbol
+TOKEN = re.compile(r'\s*(?:"((?:[^"\\]|\\.)*)"|([(),])|([^\s(),"]+))')
+KEYWORDS = ('AND', 'OR', 'NOT')
+
+
+# Splits a tag expression into ('tag', name), ('op', 'AND'/'OR'/'NOT') and ('symbol', '('/')'/',') tokens
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if not match or match.end() == position:
+            raise TagQueryError(f"Unexpected character at position {position}: {expression[position:position + 10]!r}")
+        quoted, symbol, word = match.groups()
+        if quoted is not None:
+            tokens.append(('tag', re.sub(r'\\(.)', r'\1', quoted)))
+        elif symbol is not None:
+            tokens.append(('symbol', symbol))
+        elif word.upper() in KEYWORDS:
+            tokens.append(('op', word.upper()))
+        else:
+            tokens.append(('tag', word))
+        position = match.end()
+    return tokens
+
+
+# Evaluates a tag expression against the index, e.g. 'Arts AND "Performing Arts", NOT Undergraduate'.
+# NOT binds tightest, then AND (a comma also means AND), then OR, and parentheses group.
+class TagQuery:
+    def __init__(self, expression, lookup, universe):
+        self.tokens = tokenize(expression)
+        self.position = 0
+        self.lookup = lookup        # tag name -> Bitmap
+        self.universe = universe    # every club (for NOT)
+
+    def evaluate(self):
+        if not self.tokens:
+            raise TagQueryError("The tag expression is empty")
+        result = self.parse_or()
+        if self.position < len(self.tokens):
+            raise TagQueryError(f"Unexpected {self.tokens[self.position][1]!r}")
+        return result
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def parse_or(self):
+        result = self.parse_and()
+        while self.peek() == ('op', 'OR'):
+            self.position += 1
+            result = result | self.parse_and()
+        return result
+
+    def parse_and(self):
+        result = self.parse_not()
+        while self.peek() in (('op', 'AND'), ('symbol', ',')):
+            self.position += 1
+            result = result & self.parse_not()
+        return result
+
+    def parse_not(self):
+        if self.peek() == ('op', 'NOT'):
+            self.position += 1
+            return self.universe - self.parse_not()
+        return self.parse_term()
+
+    def parse_term(self):
+        kind, value = self.peek()
+        self.position += 1
+        if kind == 'tag':
+            return self.lookup(value)
+        if (kind, value) == ('symbol', '('):
+            result = self.parse_or()
+            if self.peek() != ('symbol', ')'):
+                raise TagQueryError("Missing ')'")
+            self.position += 1
+            return result
+        raise TagQueryError("Expected a tag name" if kind is None else f"Expected a tag name, got {value!r}")
+
+
+# An in-memory inverted index from every tag to the bitmap of the clubs that have it, so boolean tag queries and
+# facet counts never have to touch the database.
+# Club writes that go through the ORM (creating, modifying and deleting clubs) update the index when they commit.
+# Writes from other processes and bulk imports are picked up by a full rebuild every TAG_INDEX_REBUILD_INTERVAL seconds.
+# The pages of a query come in order of likes, which is kept in memory too (reloaded at most every TAG_QUERY_ORDER_TTL
+# seconds), so a page only has to look up the names of its own clubs.
+class TagIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.app = None
+        self.db = None
+        self.tags = None            # tag name -> Bitmap of club ids
+        self.clubs = Bitmap()       # every club
+        self.club_tags = {}         # club id -> set of tag names
+        self.replay = None          # changes committed while a rebuild runs
+        self.interval = 0
+        self.thread = None
+        self.order_lock = threading.Lock()
+        self.order = []             # every club id, most liked first (then by id)
+        self.rank = {}              # club id -> its position in order
+        self.order_ttl = 10
+        self.order_loaded_at = None
+
+    def init_app(self, app, db):
+        self.app = app
+        self.db = db
+        self.interval = app.config.setdefault('TAG_INDEX_REBUILD_INTERVAL', 300)
+        self.order_ttl = app.config.setdefault('TAG_QUERY_ORDER_TTL', self.order_ttl)
+        atexit.register(self.stopped.set)
+
+        event.listen(db.session, 'after_flush', self.collect_changes)
+        event.listen(db.session, 'after_commit', self.apply_committed)
+        event.listen(db.session, 'after_soft_rollback', self.discard_changes)
+
+    # Starts the periodic rebuilds (called on every request, see start_background_threads in app.py)
+    def start(self):
+        if self.thread is None and self.interval:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, args=(self.interval,), daemon=True)
+                    self.thread.start()
+
+    # Loads the whole index from the database
+    def rebuild(self):
+        with self.build_lock:
+            with self.lock:
+                self.replay = []
+
+            try:
+                with self.app.app_context(), self.db.engine.connect() as connection:
+                    club_ids = connection.execute(select(Club.id)).scalars().all()
+                    pairs = connection.execute(
+                        select(club_tag_association.c.club_id, Tag.name).join(Tag, Tag.id == club_tag_association.c.tag_id)
+                    ).all()
+
+                tags, club_tags = {}, {}
+                for club_id, name in pairs:
+                    tags.setdefault(name, Bitmap()).add(club_id)
+                    club_tags.setdefault(club_id, set()).add(name)
+
+                with self.lock:
+                    self.tags, self.clubs, self.club_tags = tags, Bitmap.from_ids(club_ids), club_tags
+                    # Changes committed after the rows above were read
+                    for club_id, names in self.replay:
+                        self.set_club(club_id, names)
+                self.order_loaded_at = None  # the order of the likes is reloaded with the next page too
+            finally:
+                with self.lock:
+                    self.replay = None
+
+    def ensure_built(self):
+        if self.tags is None:
+            self.rebuild()
+
+    # Remember which clubs' tags a flush changed (the session state is only readable here, before the commit)
+    def collect_changes(self, session, flush_context):
+        changes = session.info.setdefault('tag_index_changes', {})
+        for club in session.new | session.dirty:
+            if isinstance(club, Club) and (club in session.new or inspect(club).attrs.tags.history.has_changes()):
+                changes[club.id] = set(tag.name for tag in club.tags)
+        for club in session.deleted:
+            if isinstance(club, Club):
+                changes[club.id] = None
+
+    def apply_committed(self, session):
+        changes = session.info.pop('tag_index_changes', None)
+        if not changes:
+            return
+        with self.lock:
+            for club_id, names in changes.items():
+                if self.tags is not None:
+                    self.set_club(club_id, names)
+                if self.replay is not None:
+                    self.replay.append((club_id, names))
+
+    def discard_changes(self, session, previous_transaction):
+        session.info.pop('tag_index_changes', None)
+
+    # Makes the index show the club with exactly these tags (None means the club was deleted)
+    def set_club(self, club_id, names):
+        old_names = self.club_tags.pop(club_id, set())
+        for name in old_names - (names or set()):
+            bitmap = self.tags.get(name)
+            if bitmap is not None:
+                bitmap.discard(club_id)
+        for name in (names or set()) - old_names:
+            self.tags.setdefault(name, Bitmap()).add(club_id)
+
+        if names is None:
+            self.clubs.discard(club_id)
+        else:
+            self.clubs.add(club_id)
+            self.club_tags[club_id] = set(names)
+
+    # The clubs with the tag
+    def get(self, name):
+        self.ensure_built()
+        with self.lock:
+            return self.tags.get(name, Bitmap()).copy()
+
+    # The clubs that match the tag expression (see TagQuery)
+    def query(self, expression):
+        self.ensure_built()
+        with self.lock:
+            empty = Bitmap()
+            # (copied, since the result can be one of the index's own bitmaps)
+            return TagQuery(expression, lambda name: self.tags.get(name, empty), self.clubs).evaluate().copy()
+
+    # The number of matching clubs with each tag, for the tags that have any (most clubs first)
+    def facets(self, clubs, limit=None):
+        self.ensure_built()
+        with self.lock:
+            counts = [(name, len(clubs & bitmap)) for name, bitmap in self.tags.items()]
+        counts = sorted((count for count in counts if count[1]), key=lambda count: (-count[1], count[0]))
+        return counts[:limit] if limit else counts
+
+    # The club ids in order of likes, and their positions in it
+    def favorite_order(self):
+        with self.order_lock:
+            now = time.monotonic()
+            if self.order_loaded_at is None or now - self.order_loaded_at >= self.order_ttl:
+                # (in the request's app context when there is one, so the query guard sees the query)
+                with nullcontext() if has_app_context() else self.app.app_context():
+                    with self.db.engine.connect() as connection:
+                        self.order = connection.execute(FAVORITE_ORDER).scalars().all()
+                self.rank = {club_id: position for position, club_id in enumerate(self.order)}
+                self.order_loaded_at = now
+            return self.order, self.rank
+
+    # The ids of one page of the clubs, most liked first
+    def page(self, clubs, limit, offset):
+        order, rank = self.favorite_order()
+        wanted = offset + limit
+        matched = len(clubs)
+
+        # When most clubs match, walking the order finds the page after a few clubs. When only a few match, sorting just
+        # those is quicker. (the clubs added since the order was loaded come last)
+        if wanted * len(order) < matched * matched:
+            page = []
+            for club_id in order:
+                if club_id in clubs:
+                    page.append(club_id)
+                    if len(page) == wanted:
+                        return page[offset:]
+            page.extend(sorted(club_id for club_id in clubs if club_id not in rank))
+            return page[offset:wanted]
+
+        last = len(order)
+        return heapq.nsmallest(wanted, clubs, key=lambda club_id: (rank.get(club_id, last), club_id))[offset:]
+
+    # Rebuild periodically until the server stops
+    def run(self, interval):
+        while not self.stopped.wait(interval):
+            try:
+                if self.tags is not None:
+                    self.rebuild()
+            except Exception:
+                self.app.logger.exception("Failed to rebuild the tag index")
+
+
+# Every club id, most liked first (read from the index on the likes)
+FAVORITE_ORDER = text("SELECT id FROM club ORDER BY favorite_count DESC, id")
+# The names of a page of clubs (the ids go to SQLite as a single JSON array parameter)
+PAGE_NAMES = text("SELECT id, name FROM club WHERE id IN (SELECT value FROM json_each(:ids))")
+
+
+# Puts the (id, name) rows in the order of the page (a club deleted since the index last saw it is left out)
+def order_page(page, rows):
+    names = dict(rows)
+    return [(club_id, names[club_id]) for club_id in page if club_id in names]
+
+
+# Returns one page of (id, name) pairs of the clubs, most liked first
+def page_by_favorites(session, clubs, limit, offset):
+    page = tag_index.page(clubs, limit, offset)
+    return order_page(page, session.execute(PAGE_NAMES, {'ids': json.dumps(page)}).all())
+
+
+tag_index = TagIndex()
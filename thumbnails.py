@@ -0,0 +1,197 @@
+import atexit, os, tempfile, threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+
+
+# The widths the variants are made in. A requested width is rounded up to the next one of these, so a few files per
+# image cover every size a client asks for (and a client can't fill the disk by asking for every width).
+VARIANT_WIDTHS = (64, 128, 256, 512, 1024, 2048)
+
+# The variants made in the background as soon as an image is uploaded (the others are made the first time they're asked for)
+PREGENERATED_WIDTHS = (128, 256)
+
+# The content types variants can be made of
+IMAGE_CONTENT_TYPES = {'image/png', 'image/jpeg', 'image/gif', 'image/webp', 'image/bmp'}
+
+# The formats a variant can be saved in, with the Pillow format and the content type of each
+FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+    'webp': ('WEBP', 'image/webp'),
+}
+
+# The format of a variant when none is asked for: the same as the original (other formats become PNGs)
+DEFAULT_FORMATS = {'image/jpeg': 'jpeg', 'image/webp': 'webp'}
+
+
+# Raised when a variant is asked for with a width or format that can't be made, or for a file that isn't an image
+class VariantError(ValueError):
+    pass
+
+
+# Makes smaller and recompressed versions (variants) of uploaded images, so clients that show a club's logo don't have
+# to download the full original. The variants are made by a pool of worker threads (Pillow does the resizing without
+# holding the GIL), are saved next to the blobs, and are named after the original's hash, width and format, so they
+# never go stale. The variants folder is kept under THUMBNAIL_CACHE_MAX_BYTES by deleting the variants that were used
+# least recently (they're made again the next time they're needed).
+class Thumbnailer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.root = None
+        self.max_bytes = 0
+        self.timeout = None
+        self.entries = OrderedDict()  # variant path -> size, least recently used first
+        self.total_bytes = 0
+        self.pending = {}             # variant path -> future of the variant being made
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def init_app(self, app, root):
+        self.root = root
+        self.max_bytes = app.config.setdefault('THUMBNAIL_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+        self.timeout = app.config.setdefault('THUMBNAIL_TIMEOUT', 30)
+        workers = app.config.setdefault('THUMBNAIL_WORKERS', 2)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnails')
+        atexit.register(self.executor.shutdown, wait=False)
+        self.load_entries()
+
+    # Picks up the variants made before the server (re)started, oldest first (using a variant updates its mtime)
+    def load_entries(self):
+        found = []
+        if os.path.isdir(self.root):
+            for directory, _, names in os.walk(self.root):
+                for name in names:
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    found.append((stat.st_mtime, path, stat.st_size))
+
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+            for _, path, size in sorted(found):
+                self.entries[path] = size
+                self.total_bytes += size
+
+    # Rounds the requested width up to one of VARIANT_WIDTHS, and checks the format (None means the original's format)
+    def variant_for(self, content_type, width, format):
+        if content_type not in IMAGE_CONTENT_TYPES:
+            raise VariantError("Only images have other sizes and formats")
+        if width is not None and width < 1:
+            raise VariantError("w has to be a positive integer")
+        if format is not None and format not in FORMATS:
+            raise VariantError(f"format has to be one of {', '.join(FORMATS)}")
+
+        if width:
+            width = next((size for size in VARIANT_WIDTHS if size >= width), VARIANT_WIDTHS[-1])
+        return width, format or DEFAULT_FORMATS.get(content_type, 'png')
+
+    # Variants are spread over sub folders like the blobs (e.g. "ab/cd/abcd1234...-256.webp")
+    def path_for(self, digest, width, format):
+        return os.path.join(self.root, digest[:2], digest[2:4], f"{digest}-{width or 'full'}.{format}")
+
+    # Returns the path of the variant, making it first if it doesn't exist yet (or waiting for the worker making it)
+    def get(self, source_path, digest, width, format):
+        path = self.path_for(digest, width, format)
+        try:
+            # Using a variant updates its mtime, which is its place in the LRU order after a restart
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            self.submit(source_path, digest, width, format).result(timeout=self.timeout)
+            return path
+
+        with self.lock:
+            self.hits += 1
+            if path in self.entries:
+                self.entries.move_to_end(path)
+                return path
+        # Made by another worker process
+        self.add_entry(path)
+        return path
+
+    # Makes the variants of a new image in the background
+    def queue(self, source_path, digest, content_type):
+        if content_type not in IMAGE_CONTENT_TYPES:
+            return
+        format = DEFAULT_FORMATS.get(content_type, 'png')
+        for width in PREGENERATED_WIDTHS:
+            if not os.path.exists(self.path_for(digest, width, format)):
+                self.submit(source_path, digest, width, format)
+
+    # Starts making the variant, unless a worker is already making it
+    def submit(self, source_path, digest, width, format):
+        path = self.path_for(digest, width, format)
+        with self.lock:
+            future = self.pending.get(path)
+            if future is None:
+                future = self.pending[path] = self.executor.submit(self.generate, source_path, path, width, format)
+                future.add_done_callback(lambda _: self.done(path))
+        return future
+
+    def done(self, path):
+        with self.lock:
+            self.pending.pop(path, None)
+
+    def generate(self, source_path, path, width, format):
+        pillow_format, _ = FORMATS[format]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written to a temporary file first, so nobody can see a half written variant
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f, Image.open(source_path) as image:
+                # Decode big JPEGs at a smaller scale right away instead of decoding the full size and shrinking it
+                # (square, so it's big enough whichever way the photo gets rotated below)
+                if width:
+                    image.draft(image.mode, (width, width))
+                image = ImageOps.exif_transpose(image)
+                if width and image.width > width:
+                    image.thumbnail((width, image.height), Image.LANCZOS)
+                if pillow_format == 'JPEG' and image.mode != 'RGB':
+                    image = image.convert('RGB')
+                elif image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+                    image = image.convert('RGBA')
+                image.save(f, pillow_format, quality=80, optimize=True)
+            os.replace(temp_path, path)
+        except BaseException as e:
+            os.remove(temp_path)
+            if isinstance(e, (OSError, Image.DecompressionBombError)):
+                raise VariantError("The file isn't an image that can be resized")
+            raise
+        self.add_entry(path)
+
+    def add_entry(self, path):
+        size = os.path.getsize(path)
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(path, 0)
+            self.entries[path] = size
+            evicted = self.evict()
+        for old_path in evicted:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+    # Drops the least recently used variants until the cache fits (called with the lock held)
+    def evict(self):
+        evicted = []
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            old_path, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            evicted.append(old_path)
+        return evicted
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.total_bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'pending': len(self.pending)}
+
+
+thumbnailer = Thumbnailer()